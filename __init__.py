@@ -1,18 +1,39 @@
-from .nodes import CLIPTextEncodeFormatter, TextOnlyFormatter, TextAppendFormatter
+from importlib.util import find_spec
 
 # ComfyUI required exports
 WEB_DIRECTORY = "js"
 
-NODE_CLASS_MAPPINGS = {
-    "CLIPTextEncodeFormatter": CLIPTextEncodeFormatter,
-    "TextOnlyFormatter": TextOnlyFormatter,
-    "TextAppendFormatter": TextAppendFormatter,
-}
+# Importing this package has no side effects: settings.json and the blacklist
+# are read (and created if missing) on first use, not here.
+if any(find_spec(name) is None for name in ("comfy", "server", "aiohttp")):
+    # Imported outside ComfyUI (e.g. by the bulk CLI), only the formatter modules are usable.
+    # Checked up front so the node modules and their imports aren't loaded for nothing.
+    NODE_CLASS_MAPPINGS = {}
+    NODE_DISPLAY_NAME_MAPPINGS = {}
+else:
+    from .nodes import (
+        CLIPTextEncodeFormatter, CLIPTextEncodeListFormatter, TextOnlyFormatter, TextListFormatter,
+        TextWildcardFormatter, TextAppendFormatter, TextAppendManyFormatter,
+    )
 
-NODE_DISPLAY_NAME_MAPPINGS = {
-    "CLIPTextEncodeFormatter": "CLIP Text Encode (Prompt Formatter)",
-    "TextOnlyFormatter": "Prompt Formatter (Only Text)",
-    "TextAppendFormatter": "Append String",
-}
+    NODE_CLASS_MAPPINGS = {
+        "CLIPTextEncodeFormatter": CLIPTextEncodeFormatter,
+        "CLIPTextEncodeListFormatter": CLIPTextEncodeListFormatter,
+        "TextOnlyFormatter": TextOnlyFormatter,
+        "TextListFormatter": TextListFormatter,
+        "TextWildcardFormatter": TextWildcardFormatter,
+        "TextAppendFormatter": TextAppendFormatter,
+        "TextAppendManyFormatter": TextAppendManyFormatter,
+    }
+
+    NODE_DISPLAY_NAME_MAPPINGS = {
+        "CLIPTextEncodeFormatter": "CLIP Text Encode (Prompt Formatter)",
+        "CLIPTextEncodeListFormatter": "CLIP Text Encode (Prompt Formatter, List)",
+        "TextOnlyFormatter": "Prompt Formatter (Only Text)",
+        "TextListFormatter": "Prompt Formatter (Text List)",
+        "TextWildcardFormatter": "Prompt Formatter (Wildcards)",
+        "TextAppendFormatter": "Append String",
+        "TextAppendManyFormatter": "Append Strings",
+    }
 
 __all__ = ['NODE_CLASS_MAPPINGS', 'NODE_DISPLAY_NAME_MAPPINGS']
\ No newline at end of file
@@ -1,55 +1,229 @@
 import os
 import json
-import re
+import logging
+import threading
+import time
+
+from .blacklist import Blacklist
+from .clip_tokens import CLIP_WINDOW, get_counter
+from .dedupe import DEDUPE_POLICIES
+from .tag_index import load_tag_index
 
 # Default configurations
 DEFAULT_CONFIG = {
     "BRACKET2WEIGHT": True,
     "COLLAPSE_LINEBREAKS": True,
     "CONV_SPACE_UNDERSCORE": "None",
+    "DEDUPE_POLICY": "Exact",
+    "CACHE_SIZE": 1024,
+    "STAGE_TIMING": False,
+    "CONDITIONING_CACHE_MB": 512,
+    "FORMAT_TIMEOUT": 0,
+    "TAG_DICTIONARY": "",
+    "TAG_ALIASES": True,
+    "TAG_UNKNOWN": "Keep",
+    "TAG_CATEGORIES": [],
+    "CLIP_CHUNK_TOKENS": 0,
+    "DISK_CACHE_MB": 0,
+    "DISK_CACHE_FILE": "prompt_cache.sqlite3",
     "BLACKLIST_FILE": "blacklisted_tags.txt"
 }
-DEFAULT_BLACKLIST = "tagme .*text .*_bubble onomatopoeia dialogue\n.*_(artwork) watermark signature 20\d\d"
+DEFAULT_BLACKLIST = "tagme .*text .*_bubble onomatopoeia dialogue\n.*_(artwork) watermark signature 20\\d\\d"
+
+# Settings that can be overridden for a single format_prompt call, with their allowed values
+FORMAT_OPTIONS = {
+    "BRACKET2WEIGHT": (True, False),
+    "COLLAPSE_LINEBREAKS": (True, False),
+    "CONV_SPACE_UNDERSCORE": ("None", "Spaces to underscores", "Underscores to spaces"),
+    "DEDUPE_POLICY": DEDUPE_POLICIES,
+    "CLIP_CHUNK_TOKENS": tuple(range(CLIP_WINDOW + 1)),
+}
+# Format options taking any number of seconds, 0 disables them
+TIMEOUT_OPTIONS = {"FORMAT_TIMEOUT"}
+
+# Seconds between checks of the settings and blacklist files for changes
+RELOAD_INTERVAL = 1.0
 
 # Paths
 base_dir = os.path.dirname(__file__)
 config_path = os.path.join(base_dir, "settings.json")
 
-# Load or create config file
-if os.path.exists(config_path):
-    with open(config_path, "r") as f:
-        config = json.load(f)
-    updated = False
-    for key, default_value in DEFAULT_CONFIG.items():
-        if key not in config:
-            config[key] = default_value
-            updated = True
-    if updated:
-        with open(config_path, "w") as f:
-            json.dump(config, f, indent=4)
-else:
-    config = DEFAULT_CONFIG.copy()
-    with open(config_path, "w") as f:
-        json.dump(config, f, indent=4)
-
-# Blacklist file handling
-blacklist_path = os.path.join(base_dir, config["BLACKLIST_FILE"])
-if not os.path.exists(blacklist_path):
-    with open(blacklist_path, "w") as f:
-        f.write(DEFAULT_BLACKLIST)
-
-# Load blacklist patterns
-with open(blacklist_path, "r") as f:
-    blacklist_content = f.read()
-
-# Load configurations globally
-BRACKET2WEIGHT = config["BRACKET2WEIGHT"]
-COLLAPSE_LINEBREAKS = config["COLLAPSE_LINEBREAKS"]
-CONV_SPACE_UNDERSCORE = config["CONV_SPACE_UNDERSCORE"]
-
-BLACKLISTED_TAGS = [
-    re.compile(pattern.strip())
-    for line in blacklist_content.splitlines()
-    for pattern in line.split()
-    if pattern.strip()
-]
+"""
+Loading
+"""
+
+def file_stamp(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def write_default(path: str, content: str):
+    # Creates or completes a file for the user to edit. On a read-only install
+    # (e.g. a container image) the defaults are only used in memory.
+    try:
+        with open(path, "w") as f:
+            f.write(content)
+    except OSError as e:
+        logging.warning(f"[Prompt Formatter] Couldn't write {path}, using the defaults: {e}")
+
+def load_settings(path: str):
+    # Load or create config file
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            config = json.load(f)
+        updated = False
+        for key, default_value in DEFAULT_CONFIG.items():
+            if key not in config:
+                config[key] = default_value
+                updated = True
+        if updated:
+            write_default(path, json.dumps(config, indent=4))
+    else:
+        config = DEFAULT_CONFIG.copy()
+        write_default(path, json.dumps(config, indent=4))
+    return config
+
+def dictionary_path(settings: dict):
+    # The tag dictionary CSV, None when disabled
+    return os.path.join(base_dir, settings["TAG_DICTIONARY"]) if settings["TAG_DICTIONARY"] else None
+
+def load_blacklist(path: str):
+    # Blacklist file handling
+    if not os.path.exists(path):
+        write_default(path, DEFAULT_BLACKLIST)
+        return DEFAULT_BLACKLIST
+    with open(path, "r") as f:
+        return f.read()
+
+"""
+Config
+"""
+
+class Config:
+    """Snapshot of settings.json and the compiled blacklist. Never modified once built."""
+
+    def __init__(self, settings: dict, blacklist_content: str, blacklist: Blacklist = None, tag_index=None):
+        self.settings = settings
+        self.BRACKET2WEIGHT = settings["BRACKET2WEIGHT"]
+        self.COLLAPSE_LINEBREAKS = settings["COLLAPSE_LINEBREAKS"]
+        self.CONV_SPACE_UNDERSCORE = settings["CONV_SPACE_UNDERSCORE"]
+        self.DEDUPE_POLICY = settings["DEDUPE_POLICY"]
+        self.CACHE_SIZE = settings["CACHE_SIZE"]
+        self.STAGE_TIMING = settings["STAGE_TIMING"]
+        self.CONDITIONING_CACHE_MB = settings["CONDITIONING_CACHE_MB"]
+        self.FORMAT_TIMEOUT = settings["FORMAT_TIMEOUT"]
+        self.TAG_DICTIONARY = settings["TAG_DICTIONARY"]
+        self.TAG_ALIASES = settings["TAG_ALIASES"]
+        self.TAG_UNKNOWN = settings["TAG_UNKNOWN"]
+        self.TAG_CATEGORIES = frozenset(settings["TAG_CATEGORIES"])
+        self.CLIP_CHUNK_TOKENS = settings["CLIP_CHUNK_TOKENS"]
+        self.DISK_CACHE_MB = settings["DISK_CACHE_MB"]
+        self.DISK_CACHE_FILE = settings["DISK_CACHE_FILE"]
+        self.blacklist_content = blacklist_content
+        self.blacklist = blacklist if blacklist is not None else Blacklist(blacklist_content)
+        if tag_index is None and self.TAG_DICTIONARY:
+            path = dictionary_path(settings)
+            try:
+                tag_index = load_tag_index(path)
+            except (OSError, ValueError) as e:
+                logging.warning(f"[Prompt Formatter] Couldn't load the tag dictionary {path}, formatting without it: {e}")
+        self.tag_index = tag_index
+
+        # Settings the output of format_prompt and convert_tags depend on
+        dictionary = (self.TAG_DICTIONARY, tag_index.stamp, self.TAG_ALIASES) if tag_index is not None else None
+        # Chunks planned from estimated token counts differ from those of CLIP's vocabulary
+        chunking = (self.CLIP_CHUNK_TOKENS, get_counter().exact) if self.CLIP_CHUNK_TOKENS else 0
+        self.format_key = (
+            self.BRACKET2WEIGHT, self.COLLAPSE_LINEBREAKS, self.CONV_SPACE_UNDERSCORE, self.DEDUPE_POLICY, dictionary,
+            chunking,
+        )
+        self.convert_key = (self.blacklist_content, dictionary, self.TAG_UNKNOWN, self.TAG_CATEGORIES)
+
+    def override(self, **options):
+        if not options:
+            return self
+        settings = dict(self.settings)
+        for key, value in options.items():
+            if key in TIMEOUT_OPTIONS:
+                if type(value) not in (int, float) or not 0 <= value < float("inf"):
+                    raise ValueError(f"Invalid value for {key}: {value!r}")
+                settings[key] = value
+                continue
+            if key not in FORMAT_OPTIONS:
+                raise KeyError(f"Unknown format option: {key}")
+            if value not in FORMAT_OPTIONS[key] or type(value) is not type(FORMAT_OPTIONS[key][0]):
+                raise ValueError(f"Invalid value for {key}: {value!r}")
+            settings[key] = value
+        return Config(settings, self.blacklist_content, self.blacklist, self.tag_index)
+
+class ConfigLoader:
+    """
+    Keeps the current Config in sync with the files on disk.
+
+    File stamps are checked at most once per RELOAD_INTERVAL. A new Config is
+    built completely before it replaces the old one, so callers always get a
+    consistent snapshot, and the blacklist is only recompiled when its contents
+    change. If a reload fails (e.g. settings.json is half written), the previous
+    Config stays in use.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.current = None
+        self.stamps = None
+        self.next_check = 0.0
+
+    def get(self):
+        if time.monotonic() >= self.next_check:
+            self.reload()
+        return self.current
+
+    def reload(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            if not force and now < self.next_check:
+                return
+            self.next_check = now + RELOAD_INTERVAL
+
+            current = self.current
+            if current is not None:
+                blacklist_path = os.path.join(base_dir, current.settings["BLACKLIST_FILE"])
+                tags_path = dictionary_path(current.settings)
+                stamps = (file_stamp(self.path), file_stamp(blacklist_path), tags_path and file_stamp(tags_path))
+                if not force and stamps == self.stamps:
+                    return
+
+            try:
+                settings_stamp = file_stamp(self.path)
+                settings = load_settings(self.path)
+                blacklist_path = os.path.join(base_dir, settings["BLACKLIST_FILE"])
+                blacklist_stamp = file_stamp(blacklist_path)
+                content = load_blacklist(blacklist_path)
+                reuse = current is not None and content == current.blacklist_content
+                tags_path = dictionary_path(settings)
+                tags_stamp = tags_path and file_stamp(tags_path)
+                reuse_tags = (
+                    current is not None and current.tag_index is not None
+                    and current.TAG_DICTIONARY == settings["TAG_DICTIONARY"] and self.stamps[2] == tags_stamp
+                )
+                config = Config(
+                    settings, content, current.blacklist if reuse else None, current.tag_index if reuse_tags else None
+                )
+            except Exception as e:
+                if current is None:
+                    raise
+                logging.warning(f"[Prompt Formatter] Failed to reload settings, keeping the previous ones: {e}")
+                # Try again once the files change
+                self.stamps = stamps
+                return
+
+            self.stamps = (settings_stamp, blacklist_stamp, tags_stamp)
+            self.current = config
+
+loader = ConfigLoader(config_path)
+
+def get_config(**overrides):
+    return loader.get().override(**overrides)
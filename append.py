@@ -0,0 +1,136 @@
+from collections import Counter
+
+from .dedupe import TagDeduper, drop_known
+
+# Appending prompt fragments the way the Append String node does: trailing and
+# leading commas/spaces around the seam are dropped, the fragments are joined
+# with ", " (or " " without comma), and tags of the appended fragment that the
+# text so far already has are left out when dedupe is on.
+
+def append_pair(string1: str, string2: str, comma=True, dedupe=True, policy="Exact"):
+    # Returns string1 with string2 appended, and the tags of string2 left out
+    appendstr = string2
+    removed = []
+
+    # Dedupe string2 tokens
+    if dedupe and string1 and string2:
+        appendstr, removed = drop_known(string2, string1, policy)
+
+    if not appendstr.strip(' ,'):
+        return string1, removed
+
+    s1_rstrip = string1.rstrip(' ,')
+    s2_lstrip = appendstr.lstrip(' ,')
+
+    # Empty string handling
+    if not s1_rstrip:
+        return s2_lstrip, removed
+    if not s2_lstrip:
+        return string1, removed
+
+    return f"{s1_rstrip}{', ' if comma else ' '}{s2_lstrip}", removed
+
+class Appender:
+    """
+    Appends any number of fragments in one pass, with the same result as
+    chaining append_pair over them.
+
+    The text so far is held as its comma-separated tokens: the complete ones in
+    `tokens` with a count of their dedupe keys, and the one after the last
+    comma in `tail`, which the next fragment can still extend. Every fragment
+    is only split and keyed once, and the output is joined once at the end.
+    """
+
+    def __init__(self, comma=True, dedupe=True, policy="Exact"):
+        self.separator = ", " if comma else " "
+        self.dedupe = dedupe
+        self.deduper = TagDeduper(policy)
+        self.tokens = []
+        self.token_keys = []
+        self.keys = Counter()
+        self.tail = None
+        self.removed = []
+
+    def key(self, token: str):
+        return self.deduper.key(normalized)[0] if (normalized := token.strip()) else None
+
+    def push(self, token: str):
+        key = self.key(token)
+        self.tokens.append(token)
+        self.token_keys.append(key)
+        if key is not None:
+            self.keys[key] += 1
+
+    def pop(self):
+        if (key := self.token_keys.pop()) is not None:
+            self.keys[key] -= 1
+        return self.tokens.pop()
+
+    def reset(self, parts: list):
+        self.tokens = []
+        self.token_keys = []
+        self.keys = Counter()
+        for part in parts[:-1]:
+            self.push(part)
+        self.tail = parts[-1]
+
+    def rstrip(self):
+        # The text so far with trailing spaces and commas removed
+        tail = self.tail.rstrip(" ")
+        while not tail and self.tokens:
+            tail = self.pop().rstrip(" ")
+        self.tail = tail
+
+    def append(self, fragment: str):
+        if self.tail is None:
+            self.reset(fragment.split(","))
+            return
+
+        parts = fragment.split(",")
+        # Dedupe against the text so far, like append_pair's drop_known
+        if self.dedupe and (self.tokens or self.tail) and fragment:
+            tail_key = self.key(self.tail)
+            kept = []
+            for part in parts:
+                if (key := self.key(part)) is not None and (self.keys[key] > 0 or key == tail_key):
+                    self.removed.append(part.strip())
+                else:
+                    kept.append(part)
+            parts = kept
+            if not parts:
+                return
+
+        # lstrip(' ,') of the fragment
+        first = 0
+        while first < len(parts) and not parts[first].strip(" "):
+            first += 1
+        if first == len(parts):
+            return
+        parts = parts[first:]
+        parts[0] = parts[0].lstrip(" ")
+
+        self.rstrip()
+        if not self.tail:
+            self.reset(parts)
+            return
+
+        if self.separator == ", ":
+            self.push(self.tail)
+            parts[0] = " " + parts[0]
+        else:
+            parts[0] = self.tail + " " + parts[0]
+        for part in parts[:-1]:
+            self.push(part)
+        self.tail = parts[-1]
+
+    def result(self):
+        if self.tail is None:
+            return ""
+        return ",".join(self.tokens + [self.tail])
+
+def append_all(fragments, comma=True, dedupe=True, policy="Exact"):
+    # Returns the fragments appended in order, and the tags left out
+    appender = Appender(comma, dedupe, policy)
+    for fragment in fragments:
+        appender.append(fragment)
+    return appender.result(), appender.removed
@@ -0,0 +1,92 @@
+import sys
+import time
+
+from common import config, load
+
+# Formats hostile prompts (long runs of brackets, ANDs, angle brackets,
+# underscores...) with every space/underscore setting, and fails
+# when one takes longer than the time budget. Every stage has to stay linear,
+# /prompt_formatter/format_prompt accepts any text. Also checks FORMAT_TIMEOUT
+# stops a call.
+#
+#   python benchmarks/adversarial.py [characters]
+
+# Seconds allowed per case at the default size of 100k characters
+BUDGET = 2.0
+
+
+def cases(size: int):
+    def repeat(unit: str):
+        return unit * (size // len(unit))
+
+    half = size // 2
+    return {
+        "nested brackets": "(" * half + "a" + ")" * half,
+        "nested bracket tags": "(" * half + "a, b" + ")" * half,
+        "groups before angles": repeat("(a)<"),
+        "open brackets": repeat("("),
+        "open square brackets": repeat("a ["),
+        "bracket groups": repeat("(a) "),
+        "escaped brackets": repeat("\\("),
+        "words without AND": repeat("word "),
+        "ANDs": repeat("a AND "),
+        "AND runs": repeat("AND"),
+        "spaces": " " * size,
+        "open angle brackets": repeat("<"),
+        "angle text": repeat("< a "),
+        "angle blocks": repeat("<lora:a:1> b "),
+        "brackets in angles": "<" + "(" * size + ">",
+        "underscores": repeat("_"),
+        "underscore words": repeat("a_b "),
+        "BREAKs": repeat("BREAK "),
+        "commas": repeat(", "),
+        "commas before BREAK": repeat(", ") + "\nx BREAK",
+        "line breaks": "a" + "\n" * size + "b",
+        "alternation": repeat("a|"),
+        "colons": repeat("a:1 "),
+        "lines": repeat("a,\n"),
+    }
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    budget = BUDGET * size / 100_000
+    pf = load("prompt_formatter")
+    settings = [
+        {"COLLAPSE_LINEBREAKS": collapse, "CONV_SPACE_UNDERSCORE": conversion}
+        for collapse in (True, False)
+        for conversion in ("None", "Spaces to underscores", "Underscores to spaces")
+    ]
+
+    failures = 0
+    for name, prompt in cases(size).items():
+        worst = 0.0
+        for options in settings:
+            start = time.perf_counter()
+            pf.format_prompt_uncached(prompt, config(**options))
+            worst = max(worst, time.perf_counter() - start)
+        start = time.perf_counter()
+        pf.convert_tags_uncached(prompt, config())
+        worst = max(worst, time.perf_counter() - start)
+
+        status = "ok" if worst <= budget else "OVER BUDGET"
+        failures += worst > budget
+        print(f"{name:22} {worst * 1000:8.1f} ms  {status}")
+
+    print(f"{failures} cases over the {budget:.1f} s budget")
+
+    # FORMAT_TIMEOUT gives up between stages
+    prompt = cases(size)["lines"]
+    start = time.perf_counter()
+    try:
+        pf.format_prompt_uncached(prompt, config(FORMAT_TIMEOUT=0.001))
+    except pf.FormatTimeout:
+        print(f"FORMAT_TIMEOUT=0.001: gave up after {(time.perf_counter() - start) * 1000:.1f} ms")
+    else:
+        print("FAIL: FORMAT_TIMEOUT didn't stop formatting")
+        failures += 1
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+import random
+import sys
+import time
+
+from common import load
+from golden import TAGS
+
+# Checks that append_all gives the same result as chaining append_pair (what a
+# chain of Append String nodes does) on random fragments, then times a 20
+# fragment assembly both ways.
+#
+#   python benchmarks/append_chain.py [cases]
+
+POLICIES = ("Exact", "First", "Strongest")
+
+
+def fragment(rng: random.Random):
+    roll = rng.random()
+    if roll < 0.1:
+        return rng.choice(("", " ", ",", " , ", ",,"))
+    tags = [rng.choice(TAGS) for _ in range(rng.randint(1, 6))]
+    tags = [f"({tag}:1.2)" if rng.random() < 0.1 else tag.replace(" ", "_") if rng.random() < 0.1 else tag for tag in tags]
+    text = rng.choice((", ", ",", " ,")).join(tags)
+    return rng.choice(("", " ", ", ")) + text + rng.choice(("", ",", ", ", " ", " ,  "))
+
+
+def chained(append, fragments, comma, dedupe, policy):
+    text, removed = fragments[0], []
+    for fragment in fragments[1:]:
+        text, dropped = append.append_pair(text, fragment, comma, dedupe, policy)
+        removed += dropped
+    return text, removed
+
+
+def check(cases: int, rng: random.Random):
+    append = load("append")
+    failures = 0
+    for _ in range(cases):
+        fragments = [fragment(rng) for _ in range(rng.randint(1, 12))]
+        for comma in (True, False):
+            for dedupe in (True, False):
+                for policy in POLICIES:
+                    expected = chained(append, fragments, comma, dedupe, policy)
+                    actual = append.append_all(fragments, comma, dedupe, policy)
+                    if actual != expected:
+                        failures += 1
+                        print(f"FAIL {comma=} {dedupe=} {policy=}")
+                        print(f"  fragments: {fragments!r}")
+                        print(f"  chained:   {expected!r}")
+                        print(f"  one pass:  {actual!r}")
+    print(f"{cases * 12} assemblies, {failures} failures")
+    return failures
+
+
+def time_assembly(rng: random.Random):
+    append = load("append")
+    fragments = [", ".join(rng.choice(TAGS) + str(rng.randint(0, 400)) for _ in range(40)) for _ in range(20)]
+    for name, func in (("chained", chained), ("one pass", lambda a, *args: a.append_all(*args))):
+        elapsed = 0.0
+        for i in range(200):
+            # A different first fragment every run, so the known-tags cache of append_pair can't help
+            inputs = [f"run {i}, {fragments[0]}"] + fragments[1:]
+            start = time.perf_counter()
+            func(append, inputs, True, True, "First")
+            elapsed += time.perf_counter() - start
+        print(f"20 fragments of 40 tags, {name}: {elapsed / 200 * 1e3:.3f} ms")
+
+
+def main():
+    cases = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rng = random.Random(14)
+    failures = check(cases, rng)
+    time_assembly(rng)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import random
+import re
+import sys
+import timeit
+
+from common import load
+
+# Compares the compiled blacklist matcher with the old per-tag loop over every
+# pattern, on a 10k-tag corpus and a few hundred blacklist patterns.
+#
+#   python benchmarks/blacklist_matcher.py
+
+TAG_COUNT = 10000
+LITERAL_COUNT = 300
+REGEX_COUNT = 100
+WORDS = ("hair", "eyes", "dress", "sky", "smile", "looking", "holding", "sitting", "outdoors", "night",
+         "blue", "red", "long", "short", "open", "closed", "white", "black", "from", "simple")
+
+
+def build_corpus(rng: random.Random):
+    tags = []
+    for _ in range(TAG_COUNT):
+        tag = "_".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+        if rng.random() < 0.1:
+            tag += f"_({rng.choice(WORDS)})"
+        tags.append(tag)
+    return tags
+
+
+def build_blacklist(rng: random.Random, tags):
+    literals = rng.sample(sorted(set(tags)), LITERAL_COUNT)
+    regexes = [f".*_{rng.choice(WORDS)}_{rng.choice(WORDS)}" for _ in range(REGEX_COUNT // 2)]
+    regexes += [f"{rng.choice(WORDS)}_.*_{rng.choice(WORDS)}\\d?" for _ in range(REGEX_COUNT - len(regexes))]
+    patterns = literals + regexes
+    rng.shuffle(patterns)
+    return "\n".join(" ".join(patterns[i:i + 8]) for i in range(0, len(patterns), 8))
+
+
+def legacy_filter(tags, content: str):
+    # The loop convert_tags used before the compiled matcher
+    remove_parens = str.maketrans({"(": "", ")": ""})
+    patterns = [re.compile(p.strip()) for line in content.splitlines() for p in line.split() if p.strip()]
+    return [tag for tag in tags if not any(pat.fullmatch(tag.translate(remove_parens)) for pat in patterns)]
+
+
+def compiled_filter(tags, content: str):
+    blacklist = load("blacklist").Blacklist(content)
+    return [tag for tag in tags if tag not in blacklist]
+
+
+def main():
+    rng = random.Random(0)
+    tags = build_corpus(rng)
+    content = build_blacklist(rng, tags)
+    Blacklist = load("blacklist").Blacklist
+
+    expected = legacy_filter(tags, content)
+    actual = compiled_filter(tags, content)
+    if expected != actual:
+        print(f"mismatch: {len(expected)} tags kept by the loop, {len(actual)} by the matcher")
+        return 1
+
+    warm = Blacklist(content)
+    [tag for tag in tags if tag not in warm]
+
+    timings = {
+        "loop": lambda: legacy_filter(tags, content),
+        "matcher (cold)": lambda: compiled_filter(tags, content),
+        "matcher (warm memo)": lambda: [tag for tag in tags if tag not in warm],
+        "compile only": lambda: Blacklist(content),
+    }
+    print(f"{len(tags)} tags, {LITERAL_COUNT + REGEX_COUNT} patterns, {len(tags) - len(expected)} blacklisted")
+    for name, func in timings.items():
+        seconds = min(timeit.repeat(func, number=1, repeat=5))
+        print(f"{name:>20} {seconds * 1e3:>10.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
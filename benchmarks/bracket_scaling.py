@@ -0,0 +1,49 @@
+import sys
+import timeit
+from functools import partial
+
+from common import config, load
+
+# Times bracket_to_weights on prompts with a growing number of bracket groups.
+# The time per group should stay flat as the prompt grows.
+#
+#   python benchmarks/bracket_scaling.py
+
+SIZES = (100, 200, 400, 800, 1600, 3200)
+GROUPS = ("((tag{i}))", "[tag{i}]", "(((tag{i}) detail{i}:1.2))", "[[a{i}:b{i}:0.5]]", "<lora:l{i}:0.8>", "plain{i}")
+
+
+def build(count: int):
+    return ", ".join(GROUPS[i % len(GROUPS)].format(i=i) for i in range(count))
+
+
+def build_nested(depth: int):
+    return "(" * depth + "tag" + ")" * depth + ", " + "[" * depth + "tag" + "]" * depth
+
+
+def measure(func, prompt: str):
+    number = max(1, 20000 // len(prompt))
+    return min(timeit.repeat(lambda: func(prompt), number=number, repeat=5)) / number
+
+
+def main():
+    pf = load("prompt_formatter")
+    bracket_to_weights = partial(pf.bracket_to_weights, config=config(BRACKET2WEIGHT=True))
+
+    print(f"{'groups':>8} {'chars':>8} {'ms':>10} {'us/group':>10}")
+    for size in SIZES:
+        prompt = build(size)
+        seconds = measure(bracket_to_weights, prompt)
+        print(f"{size:>8} {len(prompt):>8} {seconds * 1e3:>10.3f} {seconds * 1e6 / size:>10.2f}")
+
+    print()
+    print(f"{'depth':>8} {'chars':>8} {'ms':>10}")
+    for depth in (5, 10, 50, 250, 1000):
+        prompt = build_nested(depth)
+        seconds = measure(bracket_to_weights, prompt)
+        print(f"{depth:>8} {len(prompt):>8} {seconds * 1e3:>10.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+import sys
+import time
+
+from common import config, load
+from golden import read_golden
+
+# Checks the CLIP chunk planner (CLIP_CHUNK_TOKENS): BPE counts against a toy
+# vocabulary, every chunk of a formatted golden prompt fits the limit unless it
+# is a single tag, formatting the result again changes nothing, and planning
+# time grows linearly with the prompt length.
+#
+#   python benchmarks/chunk_planner.py
+
+# Allowed growth of the time per character from the smallest to the largest prompt
+LINEAR_SLACK = 3.0
+
+
+def check_bpe(clip_tokens):
+    merges = [("t", "a"), ("ta", "g</w>"), ("r", "e"), ("re", "d</w>"), ("h", "a")]
+    counter = clip_tokens.ClipTokenCounter(merges)
+    expected = {"tag": 1, "red": 1, "hat": 2, "(red tag:1.2)": 2, "red_tag": 3, "\\(red\\)": 3, "": 0}
+    failures = 0
+    for tag, tokens in expected.items():
+        if counter.count(tag) != tokens:
+            print(f"FAIL: {tag!r} counted {counter.count(tag)} tokens, expected {tokens}")
+            failures += 1
+    return failures
+
+
+def main():
+    clip_tokens = load("clip_tokens")
+    pf = load("prompt_formatter")
+    failures = check_bpe(clip_tokens)
+    counter = clip_tokens.get_counter()
+    print(f"vocabulary: {'CLIP' if counter.exact else 'estimate'}")
+
+    prompts = [entry["prompt"] for entry in read_golden()]
+    for limit in (20, 75):
+        cfg = config(CLIP_CHUNK_TOKENS=limit)
+        unchunked = config()
+        for prompt in prompts:
+            formatted = pf.format_prompt_uncached(prompt, cfg)
+            # Prompts that aren't stable without chunks either (e.g. dedupe across a moved line) don't count
+            stable = pf.format_prompt_uncached(prompt, unchunked)
+            if pf.format_prompt_uncached(stable, unchunked) == stable and \
+                    pf.format_prompt_uncached(formatted, cfg) != formatted:
+                print(f"FAIL: limit {limit} isn't stable for {prompt[:60]!r}")
+                failures += 1
+            for chunk in clip_tokens.count_chunks(formatted):
+                if chunk["tokens"] > limit and len(list(clip_tokens.split_tags(chunk["text"]))) > 1:
+                    print(f"FAIL: chunk of {chunk['tokens']} tokens over {limit}: {chunk['text'][:60]!r}")
+                    failures += 1
+
+    # Disabled, the stage changes nothing
+    plain = config()
+    if any(clip_tokens.chunk_prompt(prompt, plain) != prompt for prompt in prompts):
+        print("FAIL: CLIP_CHUNK_TOKENS=0 changed a prompt")
+        failures += 1
+
+    tags = [f"tag {i}, (weighted tag {i}:1.2), long_tag_name_{i % 50}" for i in range(20000)]
+    per_char = []
+    for size in (1000, 5000, 20000):
+        prompt = ", ".join(tags[:size])
+        start = time.perf_counter()
+        _, chunks = clip_tokens.plan_chunks(prompt, 75, counter)
+        elapsed = time.perf_counter() - start
+        per_char.append(elapsed / len(prompt))
+        print(f"{len(prompt):>9} characters: {elapsed * 1000:7.1f} ms, {len(chunks)} chunks")
+    if per_char[-1] > per_char[0] * LINEAR_SLACK:
+        print("FAIL: planning time grows faster than the prompt")
+        failures += 1
+
+    print(f"{failures} failures")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
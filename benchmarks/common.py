@@ -0,0 +1,27 @@
+import importlib
+import os
+import sys
+import types
+
+# Load the node's modules as a package without running its __init__.py, so
+# the formatter can be benchmarked without ComfyUI installed.
+PACKAGE_NAME = "prompt_formatter_bench"
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+
+def load(module: str):
+    if PACKAGE_NAME not in sys.modules:
+        package = types.ModuleType(PACKAGE_NAME)
+        package.__path__ = [ROOT_DIR]
+        sys.modules[PACKAGE_NAME] = package
+    return importlib.import_module(f"{PACKAGE_NAME}.{module}")
+
+
+def config(**options):
+    # Default settings and blacklist, independent of the local settings.json,
+    # with the given format options overridden
+    app_config = load("app_config")
+    defaults = app_config.Config(dict(app_config.DEFAULT_CONFIG), app_config.DEFAULT_BLACKLIST)
+    return defaults.override(**options)
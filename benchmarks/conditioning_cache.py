@@ -0,0 +1,99 @@
+import sys
+import time
+import uuid
+
+from common import load
+
+# Exercises the CLIPTextEncodeFormatter conditioning cache with a stub CLIP, no
+# ComfyUI or model needed: repeated prompts hit, a patched or different CLIP
+# misses, and the byte budget evicts least recently used entries.
+#
+#   python benchmarks/conditioning_cache.py
+
+ENCODE_SECONDS = 0.002
+
+
+class StubTensor:
+    def __init__(self, elements: int):
+        self.elements = elements
+
+    def element_size(self):
+        return 2
+
+    def nelement(self):
+        return self.elements
+
+
+class StubPatcher:
+    def __init__(self):
+        self.patches_uuid = uuid.uuid4()
+
+
+class StubCLIP:
+    def __init__(self):
+        self.patcher = StubPatcher()
+        self.layer_idx = None
+        self.tokenizer_options = {}
+        self.apply_hooks_to_conds = None
+        self.encodes = 0
+
+    def tokenize(self, text):
+        return text.split(",")
+
+    def encode_from_tokens_scheduled(self, tokens):
+        self.encodes += 1
+        time.sleep(ENCODE_SECONDS)
+        # SDXL sized: 77 x 2048 cond plus a 1280 pooled output
+        return [[StubTensor(77 * 2048), {"pooled_output": StubTensor(1280)}]]
+
+
+def expect(name, condition):
+    print(f"{'ok  ' if condition else 'FAIL'} {name}")
+    return not condition
+
+
+def main():
+    conditioning = load("conditioning")
+    cache = conditioning.conditioning_cache
+    failures = 0
+
+    clip = StubCLIP()
+    prompts = [f"prompt {i}, 1girl, solo" for i in range(24)]
+    queue = [prompts[i % len(prompts)] for i in range(2000)]
+
+    start = time.perf_counter()
+    for prompt in queue:
+        conditioning.encode(clip, prompt)
+    uncached = time.perf_counter() - start
+
+    clip.encodes = 0
+    start = time.perf_counter()
+    outputs = [conditioning.encode_cached(clip, prompt) for prompt in queue]
+    cached = time.perf_counter() - start
+    print(f"{len(queue)} jobs over {len(prompts)} prompts: uncached {uncached:.2f} s, cached {cached:.2f} s")
+    failures += expect("each prompt encoded once", clip.encodes == len(prompts))
+    failures += expect("repeats return the same conditioning", outputs[0] is outputs[len(prompts)])
+
+    clip.patcher.patches_uuid = uuid.uuid4()
+    conditioning.encode_cached(clip, prompts[0])
+    failures += expect("patched model is encoded again", clip.encodes == len(prompts) + 1)
+
+    other = StubCLIP()
+    conditioning.encode_cached(other, prompts[0])
+    failures += expect("another CLIP is encoded again", other.encodes == 1)
+
+    other.apply_hooks_to_conds = object()
+    conditioning.encode_cached(other, prompts[0])
+    failures += expect("CLIP with hooks is not cached", other.encodes == 2)
+
+    entry_bytes = conditioning.nbytes(outputs[0])
+    cache.resize(entry_bytes * 4)
+    failures += expect("budget evicts down to 4 entries", cache.stats()["size"] == 4)
+    failures += expect("budget is respected", cache.stats()["bytes"] <= cache.stats()["max_bytes"])
+
+    print(cache.stats())
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import BENCH_DIR, config, load
+from golden import read_golden
+
+# Exercises the disk cache (DISK_CACHE_MB) the way several ComfyUI processes
+# share it: worker processes format the same corpus at once through one file,
+# a fresh process then reads everything back, keys hash the same under
+# different PYTHONHASHSEEDs, and a small budget evicts down to its size.
+#
+#   python benchmarks/disk_cache.py [processes]
+
+KEY_SCRIPT = """
+import sys
+sys.path.insert(0, {bench!r})
+from common import config, load
+disk_cache = load("disk_cache")
+cfg = config()
+print(disk_cache.result_key("convert_tags", "a, b", cfg.convert_key[:3] + (frozenset(["general", "artist", "meta"]),)).hex())
+"""
+
+
+def with_disk_cache(path: str, mb: int):
+    app_config = load("app_config")
+    defaults = config()
+    settings = {**defaults.settings, "DISK_CACHE_MB": mb, "DISK_CACHE_FILE": path}
+    return app_config.Config(settings, defaults.blacklist_content, defaults.blacklist)
+
+
+def format_all(args):
+    path, prompts = args
+    pf = load("prompt_formatter")
+    cfg = with_disk_cache(path, 64)
+    start = time.perf_counter()
+    results = [(pf.format_prompt_cached(prompt, cfg), pf.convert_tags_cached(prompt, cfg)) for prompt in prompts]
+    cache = load("disk_cache").get_disk_cache(cfg)
+    return results, time.perf_counter() - start, cache.hits, cache.errors
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    pf = load("prompt_formatter")
+    prompts = [entry["prompt"] for entry in read_golden()]
+    expected = [(pf.format_prompt_uncached(prompt, config()), pf.convert_tags_uncached(prompt, config())) for prompt in prompts]
+    failures = 0
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "cache.sqlite3")
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes) as pool:
+            cold = pool.map(format_all, [(path, prompts)] * processes)
+        with context.Pool(1) as pool:
+            warm = pool.map(format_all, [(path, prompts)])[0]
+
+        for results, _, _, errors in cold + [warm]:
+            if results != expected:
+                print("FAIL: a process got results different from formatting without the cache")
+                failures += 1
+            if errors:
+                print(f"FAIL: {errors} SQLite errors")
+                failures += 1
+        cold_time = max(elapsed for _, elapsed, _, _ in cold)
+        print(f"{len(prompts)} prompts x 2 actions, {processes} processes at once: {cold_time:.2f} s")
+        print(f"restarted process: {warm[1]:.2f} s, {warm[2]} disk hits")
+        if warm[2] != 2 * len(set(prompts)):
+            print("FAIL: the restarted process didn't find every result")
+            failures += 1
+
+        # Eviction keeps the file's entries within the budget
+        small = with_disk_cache(os.path.join(folder, "small.sqlite3"), 1)
+        cache = load("disk_cache").get_disk_cache(small)
+        cache.put_many([(os.urandom(16), "x" * 1000) for _ in range(3000)])
+        stats = cache.stats()
+        print(f"1 MB budget after 3 MB of inserts: {stats['bytes'] / 2**20:.2f} MB, {stats['evictions']} evicted")
+        if stats["bytes"] > cache.max_bytes:
+            print("FAIL: the cache is over its budget")
+            failures += 1
+
+    keys = {
+        subprocess.run(
+            [sys.executable, "-c", KEY_SCRIPT.format(bench=BENCH_DIR)], capture_output=True, text=True, check=True,
+            env={**os.environ, "PYTHONHASHSEED": str(seed)},
+        ).stdout.strip()
+        for seed in (1, 2, 3)
+    }
+    if len(keys) != 1:
+        print("FAIL: keys differ between processes")
+        failures += 1
+
+    print(f"{failures} failures")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
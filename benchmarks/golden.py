@@ -0,0 +1,192 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+
+from common import BENCH_DIR, config, load
+
+# Golden corpus: every prompt with its expected format_prompt output under every
+# settings combination and its convert_tags output, using the default blacklist.
+#
+#   python benchmarks/golden.py            check the formatter against golden.jsonl
+#   python benchmarks/golden.py --update   rewrite the expected outputs
+#   python benchmarks/golden.py --update --regenerate
+#                                          also rebuild the generated prompts
+
+GOLDEN_PATH = os.path.join(BENCH_DIR, "golden.jsonl")
+CORPUS_PATH = os.path.join(BENCH_DIR, "corpus.jsonl")
+
+COMBINATIONS = list(itertools.product(
+    (True, False),                                              # BRACKET2WEIGHT
+    (True, False),                                              # COLLAPSE_LINEBREAKS
+    ("None", "Spaces to underscores", "Underscores to spaces"), # CONV_SPACE_UNDERSCORE
+))
+
+TAGS = ("1girl", "solo", "long hair", "short_hair", "blue eyes", "smile", "looking at viewer", "outdoors",
+        "night", "sky", "cloud", "dress", "school uniform", "thighhighs", "hat", "flower", "red eyes",
+        "open mouth", "upper body", "full body", "sitting", "standing", "ribbon", "holding", "blush",
+        "character \\(series\\)", "score_9", "masterpiece", "best quality", "depth of field")
+
+
+"""
+Corpus generation
+"""
+
+def noisy_join(rng: random.Random, parts):
+    separators = (", ", ",", " , ", ",, ", ",\n", " ,  ")
+    return "".join(part + rng.choice(separators) for part in parts[:-1]) + parts[-1]
+
+
+def decorate(rng: random.Random, tag: str):
+    roll = rng.random()
+    if roll < 0.1:
+        return "(" * rng.randint(1, 3) + tag + ")" * rng.randint(1, 3)
+    if roll < 0.15:
+        return "[" * rng.randint(1, 2) + tag + "]" * rng.randint(1, 2)
+    if roll < 0.2:
+        return f"({tag}:{rng.choice(('0.8', '1.1', '1.25', '1.5'))})"
+    return tag
+
+
+def short_tags(rng: random.Random):
+    return noisy_join(rng, [decorate(rng, rng.choice(TAGS)) for _ in range(rng.randint(3, 12))])
+
+
+def wildcard_prompt(rng: random.Random):
+    parts = []
+    while sum(map(len, parts)) < 5000:
+        roll = rng.random()
+        if roll < 0.15:
+            parts.append("{" + "|".join(rng.sample(TAGS, rng.randint(2, 4))) + "}")
+        elif roll < 0.25:
+            parts.append(f"__{rng.choice(('hair', 'outfit', 'pose', 'scene'))}_{rng.randint(1, 9)}__")
+        elif roll < 0.3:
+            parts.append(f"[{rng.choice(TAGS)}:{rng.choice(TAGS)}:{rng.choice(('0.2', '0.5', '0.8'))}]")
+        else:
+            parts.append(decorate(rng, rng.choice(TAGS)))
+    return noisy_join(rng, parts)
+
+
+def deep_nesting(rng: random.Random):
+    parts = []
+    for _ in range(rng.randint(3, 8)):
+        depth = rng.randint(4, 12)
+        opening = rng.choice("([")
+        closing = ")" if opening == "(" else "]"
+        inner = rng.choice(TAGS)
+        if rng.random() < 0.3:
+            inner = f"{inner}, (({rng.choice(TAGS)}))"
+        parts.append(opening * depth + inner + closing * depth)
+    return noisy_join(rng, parts)
+
+
+def many_loras(rng: random.Random):
+    parts = []
+    for i in range(rng.randint(20, 60)):
+        if rng.random() < 0.5:
+            parts.append(f"<lora:{rng.choice(('detail', 'style', 'char'))}_{i}:{rng.choice(('0.4', '0.6', '1'))}>")
+        else:
+            parts.append(decorate(rng, rng.choice(TAGS)))
+    return noisy_join(rng, parts)
+
+
+def break_and(rng: random.Random):
+    segments = [short_tags(rng) for _ in range(rng.randint(3, 10))]
+    prompt = segments[0]
+    for segment in segments[1:]:
+        prompt += rng.choice((" BREAK ", "\nBREAK\n", " AND ", "  AND ", ", BREAK, ", "\n\nAND\n")) + segment
+    return prompt
+
+
+GENERATORS = {
+    "short_tags": (short_tags, 20),
+    "wildcard_5k": (wildcard_prompt, 3),
+    "deep_nesting": (deep_nesting, 10),
+    "many_loras": (many_loras, 6),
+    "break_and": (break_and, 10),
+}
+
+
+def build_corpus():
+    rng = random.Random(9)
+    corpus = []
+    with open(CORPUS_PATH, "r", encoding="utf-8") as f:
+        corpus += [{"category": "handwritten", "prompt": json.loads(line)["prompt"]} for line in f if line.strip()]
+    for category, (generate, count) in GENERATORS.items():
+        corpus += [{"category": category, "prompt": generate(rng)} for _ in range(count)]
+    return corpus
+
+
+"""
+Golden outputs
+"""
+
+def combination_key(bracket2weight, collapse, underscore):
+    return f"BRACKET2WEIGHT={bracket2weight}|COLLAPSE_LINEBREAKS={collapse}|CONV_SPACE_UNDERSCORE={underscore}"
+
+
+def expected_outputs(prompt: str):
+    pf = load("prompt_formatter")
+    formatted = {}
+    for bracket2weight, collapse, underscore in COMBINATIONS:
+        options = config(
+            BRACKET2WEIGHT=bracket2weight,
+            COLLAPSE_LINEBREAKS=collapse,
+            CONV_SPACE_UNDERSCORE=underscore,
+        )
+        formatted[combination_key(bracket2weight, collapse, underscore)] = pf.format_prompt_uncached(prompt, options)
+    return formatted, pf.convert_tags_uncached(prompt, config())
+
+
+def read_golden(path: str = GOLDEN_PATH):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def update(regenerate: bool):
+    if regenerate or not os.path.exists(GOLDEN_PATH):
+        corpus = build_corpus()
+    else:
+        corpus = [{"category": entry["category"], "prompt": entry["prompt"]} for entry in read_golden()]
+
+    with open(GOLDEN_PATH, "w", encoding="utf-8", newline="\n") as f:
+        for entry in corpus:
+            entry["format_prompt"], entry["convert_tags"] = expected_outputs(entry["prompt"])
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    print(f"Wrote {len(corpus)} prompts to {GOLDEN_PATH}")
+    return 0
+
+
+def check():
+    failures = checks = 0
+    for i, entry in enumerate(read_golden()):
+        formatted, converted = expected_outputs(entry["prompt"])
+        for key, output in formatted.items():
+            checks += 1
+            if output != entry["format_prompt"][key]:
+                failures += 1
+                print(f"FAIL #{i} [{entry['category']}] format_prompt {key}")
+                print(f"  prompt:   {entry['prompt'][:200]!r}")
+                print(f"  expected: {entry['format_prompt'][key][:200]!r}")
+                print(f"  actual:   {output[:200]!r}")
+        checks += 1
+        if converted != entry["convert_tags"]:
+            failures += 1
+            print(f"FAIL #{i} [{entry['category']}] convert_tags")
+
+    print(f"{checks} checks, {failures} failures")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the formatter against the golden corpus.")
+    parser.add_argument("--update", action="store_true", help="Rewrite the expected outputs.")
+    parser.add_argument("--regenerate", action="store_true", help="With --update, rebuild the generated prompts.")
+    args = parser.parse_args()
+    return update(args.regenerate) if args.update else check()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
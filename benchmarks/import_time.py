@@ -0,0 +1,87 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+from common import ROOT_DIR
+
+# Imports the package the way a Python process outside ComfyUI does (the bulk
+# CLI, a worker) with python -X importtime, reports what the import costs,
+# and checks it has no side effects: no file in the package folder is created
+# or modified and no settings are loaded until the formatter is first used.
+#
+#   python benchmarks/import_time.py [runs]
+
+PACKAGE = "prompt_formatter_import"
+# Milliseconds the package's own modules may take to import, without the standard library
+OWN_BUDGET_MS = 15.0
+
+IMPORT_SCRIPT = f"""
+import {PACKAGE}.prompt_formatter as pf
+assert pf.get_config.__module__ == "{PACKAGE}.app_config"
+from {PACKAGE}.app_config import loader
+assert loader.current is None, "settings were loaded at import"
+"""
+
+
+def snapshot(folder: str):
+    files = {}
+    for root, dirs, names in os.walk(folder):
+        dirs[:] = [name for name in dirs if name not in ("__pycache__", ".git")]
+        for name in names:
+            path = os.path.join(root, name)
+            files[path] = os.stat(path).st_mtime_ns
+    return files
+
+
+def import_times(folder: str):
+    # {module: (self us, cumulative us)} of one fresh interpreter. Bytecode is
+    # written under the temporary folder, so later runs measure the import and
+    # not the compilation, even with PYTHONDONTWRITEBYTECODE set.
+    env = {name: value for name, value in os.environ.items() if name != "PYTHONDONTWRITEBYTECODE"}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-X", f"pycache_prefix={os.path.join(folder, 'pycache')}", "-c", IMPORT_SCRIPT],
+        cwd=folder, capture_output=True, text=True, env=env,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    before = snapshot(ROOT_DIR)
+    with tempfile.TemporaryDirectory() as folder:
+        os.symlink(ROOT_DIR, os.path.join(folder, PACKAGE))
+        samples = [import_times(folder) for _ in range(runs)]
+    if snapshot(ROOT_DIR) != before:
+        print("FAIL: importing the package created or modified files")
+        return 1
+
+    # The fastest run, the first one also compiles the bytecode
+    best = min(samples, key=lambda times: times[f"{PACKAGE}.prompt_formatter"][1])
+    total = best[PACKAGE][1] + best[f"{PACKAGE}.prompt_formatter"][1]
+    own = [(name, times[0]) for name, times in best.items() if name.startswith(PACKAGE)]
+    own_ms = sum(us for _, us in own) / 1000
+    print(f"package + prompt_formatter: {total / 1000:.1f} ms cumulative, own modules {own_ms:.1f} ms")
+    for name, us in sorted(own, key=lambda item: -item[1]):
+        print(f"  {name:45} {us / 1000:6.2f} ms")
+    slowest = sorted(
+        ((name, times[0]) for name, times in best.items() if not name.startswith(PACKAGE)), key=lambda item: -item[1]
+    )[:5]
+    print("slowest other imports: " + ", ".join(f"{name} {us / 1000:.1f} ms" for name, us in slowest))
+
+    if own_ms > OWN_BUDGET_MS:
+        print(f"FAIL: own modules take longer than {OWN_BUDGET_MS} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
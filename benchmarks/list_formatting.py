@@ -0,0 +1,55 @@
+import random
+import sys
+import time
+
+from common import load
+from golden import read_golden
+
+# Formats a prompt list the way the list nodes do (coalesced, cached items
+# skipped) and checks it against formatting every item one after another
+# without the caches. The list is formatted twice, the second run finds every
+# item in the format caches.
+#
+#   python benchmarks/list_formatting.py [items]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    pf = load("prompt_formatter")
+    lists = load("lists")
+    rng = random.Random(15)
+
+    prompts = [entry["prompt"] for entry in read_golden() if entry["prompt"]]
+    # Items repeat, like a wildcard list with few choices
+    choices = [rng.choice(prompts) + f", variant {i}" for i in range(count // 3)]
+    texts = [rng.choice(choices) for _ in range(count)]
+    print(f"{len(texts)} items, {len(set(texts))} unique, {sum(map(len, texts)) / 1e6:.2f} Mchars")
+
+    config = pf.get_config()
+    uncached = {"format_prompt": pf.format_prompt_uncached, "convert_tags": pf.convert_tags_uncached}
+    for action, func in uncached.items():
+        start = time.perf_counter()
+        expected = [func(text, config) for text in texts]
+        sequential = time.perf_counter() - start
+
+        pf.format_cache.clear()
+        pf.convert_cache.clear()
+        timings = []
+        for _ in range(2):
+            start = time.perf_counter()
+            actual = lists.format_list(texts, action)
+            timings.append(time.perf_counter() - start)
+            if actual != expected:
+                print(f"FAIL: {action} results differ")
+                return 1
+
+        cold, warm = timings
+        print(
+            f"{action}: one by one {sequential:.2f} s, format_list {cold:.2f} s ({sequential / cold:.1f}x), "
+            f"cached {warm * 1000:.1f} ms"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+import asyncio
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import config, load
+from golden import read_golden
+
+# Replays simulated typing from several editors into a LiveSession, the way
+# /prompt_formatter/live receives it, and compares with formatting every
+# keystroke. Checks every editor's last response is the formatted final text,
+# sequence numbers only grow, and stale or out of order edits are never answered.
+#
+#   python benchmarks/live_session.py [editors]
+
+# Seconds between keystrokes of one editor, a fast typist
+KEYSTROKE_INTERVAL = 0.01
+
+
+def typing(prompt: str, rng: random.Random):
+    # The text after every keystroke, with a few backspaces
+    text = ""
+    for c in prompt:
+        if text and rng.random() < 0.05:
+            text = text[:-1]
+            yield text
+        text += c
+        yield text
+
+
+async def replay(live, pf, edits, cfg):
+    executor = ThreadPoolExecutor(max_workers=2)
+    responses = []
+    formatted = 0
+
+    async def process(request):
+        nonlocal formatted
+        formatted += 1
+        loop = asyncio.get_running_loop()
+        return {"success": True, "formatted_prompt": await loop.run_in_executor(
+            executor, pf.format_prompt_uncached, request["text"], cfg
+        )}
+
+    async def send(response):
+        responses.append(response)
+
+    session = live.LiveSession(process, send)
+    worker = asyncio.create_task(session.run())
+
+    async def editor(key, texts):
+        for seq, text in enumerate(texts, 1):
+            session.submit({"id": key, "seq": seq, "text": text})
+            # A reordered message from earlier, must be ignored
+            if seq > 2 and seq % 7 == 0 and session.submit({"id": key, "seq": seq - 2, "text": "stale"}):
+                raise AssertionError("out of order edit accepted")
+            await asyncio.sleep(KEYSTROKE_INTERVAL)
+
+    await asyncio.gather(*(editor(key, texts) for key, texts in edits.items()))
+    while session.pending or session.wakeup.is_set():
+        await asyncio.sleep(session.coalesce)
+    await asyncio.sleep(session.coalesce * 4)
+    worker.cancel()
+    executor.shutdown()
+    return responses, formatted, session
+
+
+def main():
+    editors = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    live = load("live")
+    pf = load("prompt_formatter")
+    cfg = config()
+    rng = random.Random(20)
+    prompts = [entry["prompt"] for entry in read_golden() if entry["category"] == "handwritten"]
+    edits = {f"node{i}": list(typing(rng.choice(prompts)[:300], rng)) for i in range(editors)}
+    keystrokes = sum(map(len, edits.values()))
+
+    start = time.perf_counter()
+    for texts in edits.values():
+        for text in texts:
+            pf.format_prompt_uncached(text, cfg)
+    every = time.perf_counter() - start
+
+    start = time.perf_counter()
+    responses, formatted, session = asyncio.run(replay(live, pf, edits, cfg))
+    elapsed = time.perf_counter() - start
+    print(f"{editors} editors, {keystrokes} keystrokes")
+    print(f"every keystroke: {keystrokes} formats, {every * 1000:.0f} ms of formatting")
+    print(f"live session: {formatted} formats, {len(responses)} responses, {session.dropped} dropped "
+          f"({elapsed:.2f} s of typing)")
+
+    failures = 0
+    last = {}
+    for response in responses:
+        if response["seq"] <= last.get(response["id"], 0):
+            print(f"FAIL: {response['id']} got seq {response['seq']} after {last[response['id']]}")
+            failures += 1
+        last[response["id"]] = response["seq"]
+    for key, texts in edits.items():
+        final = [response for response in responses if response["id"] == key][-1:]
+        expected = {"seq": len(texts), "formatted_prompt": pf.format_prompt_uncached(texts[-1], cfg)}
+        if not final or {name: final[0][name] for name in expected} != expected:
+            print(f"FAIL: {key} didn't get its final text formatted")
+            failures += 1
+    if formatted >= keystrokes:
+        print("FAIL: bursts weren't coalesced")
+        failures += 1
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
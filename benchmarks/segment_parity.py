@@ -0,0 +1,99 @@
+import random
+import statistics
+import sys
+import time
+
+from common import config, load
+from golden import COMBINATIONS, read_golden
+
+# Checks that the segmented formatter gives exactly the format_prompt output on
+# multi-line templates built from the golden corpus, under every settings
+# combination, then times a series of one-line edits of a 200-line template
+# against a full reformat, and fails if the segmented format isn't faster.
+#
+#   python benchmarks/segment_parity.py [templates]
+
+LINES_PER_TEMPLATE = 40
+# Cuts the segmenter has gotten wrong before
+EDGE_CASES = [
+    "a, b_\nc, d",
+    "a, b_,\nc, d",
+    "a, b\n_c, d",
+    "a, b_ \n\n_c_, d_\ne",
+]
+
+
+def build_templates(count: int, rng: random.Random):
+    lines = [line for entry in read_golden() for line in entry["prompt"].split("\n")]
+    lines = [line for line in lines if len(line) < 400]
+    templates = []
+    for _ in range(count):
+        picked = rng.sample(lines, LINES_PER_TEMPLATE)
+        templates.append("\n".join(line if rng.random() < 0.9 else "" for line in picked))
+    return templates, lines
+
+
+def check(templates, lines, rng: random.Random):
+    pf = load("prompt_formatter")
+    segments = load("segments")
+    failures = segmented = 0
+    for bracket2weight, collapse, underscore in COMBINATIONS:
+        options = config(BRACKET2WEIGHT=bracket2weight, COLLAPSE_LINEBREAKS=collapse, CONV_SPACE_UNDERSCORE=underscore)
+        for template in templates:
+            # The template itself, then the same template after a one-line edit
+            edited = template.split("\n")
+            edited[rng.randrange(len(edited))] = rng.choice(lines)
+            for prompt in (template, "\n".join(edited)):
+                expected = pf.format_prompt_uncached(prompt, options)
+                actual = segments.format_segmented(prompt, options)
+                pre = segments.run_stages(prompt, segments.PRE_STAGES, options)
+                segmented += len(segments.split_segments(pre, options)[0]) > 1
+                if actual != expected:
+                    failures += 1
+                    print(f"FAIL {bracket2weight=} {collapse=} {underscore=}")
+                    print(f"  prompt:    {prompt!r}")
+                    print(f"  expected:  {expected!r}")
+                    print(f"  segmented: {actual!r}")
+    total = 2 * len(templates) * len(COMBINATIONS)
+    print(f"{total} formats, {segmented} split into several segments, {failures} failures")
+    return failures
+
+
+def time_edit(lines, rng: random.Random, edits: int = 30):
+    # Median over a series of one-line edits, every edit keeping the ones before it like an editor does
+    pf = load("prompt_formatter")
+    segments = load("segments")
+    options = config()
+    template = [rng.choice(lines) for _ in range(200)]
+    segments.format_segmented("\n".join(template), options)
+
+    full = []
+    incremental = []
+    for _ in range(edits):
+        template[rng.randrange(len(template))] = rng.choice(lines)
+        prompt = "\n".join(template)
+        start = time.perf_counter()
+        segments.format_segmented(prompt, options)
+        incremental.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        pf.format_prompt_uncached(prompt, options)
+        full.append(time.perf_counter() - start)
+    full, incremental = statistics.median(full), statistics.median(incremental)
+    print(f"200-line template, one line edited: full {full * 1e3:.2f} ms, segmented {incremental * 1e3:.2f} ms (median of {edits})")
+    if incremental >= full:
+        print("FAIL: the segmented format is no faster than a full reformat")
+        return 1
+    return 0
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rng = random.Random(11)
+    templates, lines = build_templates(count, rng)
+    failures = check(templates + EDGE_CASES, lines, rng)
+    failures += time_edit(lines, rng)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import json
+import os
+import re
+import sys
+import timeit
+from functools import partial
+
+from common import BENCH_DIR, config, load
+
+# Times the regex-based stage functions against their previous versions, which
+# built or looked up their patterns on every call, over the benchmark corpus.
+#
+#   python benchmarks/stage_functions.py [corpus.jsonl]
+
+"""
+Previous versions
+"""
+
+LEGACY_BRACKET_PATTERN = r'(?<!\\)(?:\([^)]*\)|\[[^\]]*\])(?=(?:\s*(?:,|BREAK|<[^>]+>)|\s*$))'
+
+def legacy_space_and(prompt: str):
+    return re.sub(r"(.*?)\s*(AND)\s*(.*?)", lambda m: " ".join(m.groups()), prompt)
+
+
+def legacy_align_alternating(prompt: str):
+    return re.sub(r"\s*(\|)\s*", lambda match: match.group(1), prompt)
+
+
+def legacy_comma_before_bracket(prompt: str):
+    return re.sub(r',\s*(<)', r' \1', prompt)
+
+
+def legacy_remove_weight_one(prompt: str):
+    return re.sub(r'(?<!\\)\(([^:]+):1(?:\.0*)?\)', r'\1', prompt)
+
+
+def legacy_space_to_underscore(prompt: str):
+    match = re.compile(r"(?<!BREAK) +(?!BREAK|[^<]*>)")
+    tokens = [t.strip() for t in prompt.split(",")]
+    return ",".join(re.sub(match, "_", t) for t in tokens)
+
+
+def legacy_dedupe_tokens(prompt: str, bracket_pattern: str):
+    separators = [',', r"\s*BREAK\s*", r'<[^>]+>']
+    dedupe_pattern = re.compile(f'({bracket_pattern}|(?:{"|".join(separators)}))')
+    processed_lines = []
+    seen = set()
+    for line in prompt.splitlines():
+        if not re.search(f'(?:{"|".join(separators)})', line):
+            processed_lines.append(line)
+            continue
+        result = []
+        for part in [p for p in dedupe_pattern.split(line) if p is not None]:
+            normalized = part.strip()
+            if not normalized:
+                continue
+            if any(re.fullmatch(sep, normalized) for sep in separators):
+                if normalized == "BREAK":
+                    result.append(" BREAK ")
+                elif re.fullmatch(r'<[^>]+>', normalized):
+                    result.append(f" {normalized} ")
+                else:
+                    result.append(f" {normalized} ")
+            elif normalized not in seen:
+                seen.add(normalized)
+                result.append(part)
+        output = re.sub(r"\s*BREAK\s*", ' BREAK ', ''.join(result)).strip()
+        processed_lines.append(' '.join(output.split()))
+    return '\n'.join(processed_lines).strip()
+
+
+"""
+Benchmark
+"""
+
+def read_corpus(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line)["prompt"] for line in f if line.strip()]
+
+
+def measure(func, prompts):
+    def run():
+        for prompt in prompts:
+            func(prompt)
+    timer = timeit.Timer(run)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / (number * len(prompts))
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(BENCH_DIR, "corpus.jsonl")
+    prompts = read_corpus(path)
+    pf = load("prompt_formatter")
+    underscores = config(CONV_SPACE_UNDERSCORE="Spaces to underscores")
+
+    pairs = {
+        "space_and": (legacy_space_and, pf.space_and),
+        "align_alternating": (legacy_align_alternating, pf.align_alternating),
+        "comma_before_bracket": (legacy_comma_before_bracket, pf.comma_before_bracket),
+        "remove weight 1": (legacy_remove_weight_one, pf.remove_weight_one),
+        "space_to_underscore": (legacy_space_to_underscore, partial(pf.space_to_underscore, config=underscores)),
+        "dedupe_tokens": (partial(legacy_dedupe_tokens, bracket_pattern=LEGACY_BRACKET_PATTERN), partial(pf.dedupe_tokens, config=config())),
+    }
+
+    print(f"{len(prompts)} prompts")
+    print(f"{'function':>22} {'before us':>10} {'after us':>10} {'speedup':>8}")
+    for name, (before, after) in pairs.items():
+        for prompt in prompts:
+            if before(prompt) != after(prompt):
+                print(f"{name}: output differs for {prompt!r}")
+                return 1
+        before_seconds = measure(before, prompts)
+        after_seconds = measure(after, prompts)
+        print(f"{name:>22} {before_seconds * 1e6:>10.2f} {after_seconds * 1e6:>10.2f} {before_seconds / after_seconds:>7.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
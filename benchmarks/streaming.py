@@ -0,0 +1,94 @@
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from common import load
+from golden import read_golden
+
+# Formats a multi-megabyte caption dump with format_prompt / convert_tags on
+# the whole string and with the streaming format_prompt_iter / convert_tags_iter,
+# checks the streamed lines match formatting every line on its own, and
+# compares peak memory.
+#
+#   python benchmarks/streaming.py [lines]
+
+
+def build_document(count: int, rng: random.Random):
+    prompts = [entry["prompt"] for entry in read_golden() if entry["category"] in ("handwritten", "short_tags")]
+    lines = [line for prompt in prompts for line in prompt.split("\n") if line.strip()]
+    return "\n".join(f"{rng.choice(lines)}, caption {i}" for i in range(count)) + "\n"
+
+
+def peak(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak_bytes
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    pf = load("prompt_formatter")
+    document = build_document(count, random.Random(16))
+    print(f"{count} lines, {len(document) / 1e6:.2f} MB")
+
+    expected = [pf.format_prompt(line) for line in document.splitlines()]
+    streamed = list(pf.format_prompt_iter(io.StringIO(document)))
+    if streamed != expected:
+        print("FAIL: format_prompt_iter differs from formatting line by line")
+        return 1
+    converted = list(pf.convert_tags_iter(io.StringIO(document)))
+    if "\n".join(converted) + "\n" != pf.convert_tags_uncached(document, pf.get_config()):
+        print("FAIL: convert_tags_iter differs from convert_tags")
+        return 1
+
+    # Carried over, no tag is left twice in the document (angle blocks are separators, not tags)
+    dedupe = load("dedupe")
+    carried = "\n".join(pf.format_prompt_iter(io.StringIO(document), carry_seen=True, DEDUPE_POLICY="First"))
+    tags = [tag.strip() for tag in carried.replace("\n", ",").split(",") if tag.strip() and "<" not in tag]
+    keys = [dedupe.tag_key(tag)[0] for tag in tags]
+    if len(keys) != len(set(keys)):
+        print("FAIL: carry_seen left duplicate tags")
+        return 1
+
+    def consume(lines):
+        # Like writing the output to a file, nothing kept
+        for _ in lines:
+            pass
+
+    def stream(func, **options):
+        with open(path, "r", encoding="utf-8") as f:
+            consume(func(f, **options))
+
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt", delete=False) as f:
+        f.write(document)
+        path = f.name
+    try:
+        for name, whole, streaming in (
+            ("format_prompt", lambda: pf.format_prompt_uncached(document, pf.get_config()),
+             lambda: stream(pf.format_prompt_iter, carry_seen=True)),
+            ("convert_tags", lambda: pf.convert_tags_uncached(document, pf.get_config()),
+             lambda: stream(pf.convert_tags_iter)),
+        ):
+            pf.format_cache.clear()
+            pf.convert_cache.clear()
+            _, whole_seconds, whole_peak = peak(whole)
+            pf.format_cache.clear()
+            pf.convert_cache.clear()
+            _, stream_seconds, stream_peak = peak(streaming)
+            print(f"{name}: whole string {whole_seconds:.2f} s, peak {whole_peak / 1e6:.1f} MB; "
+                  f"streamed from file {stream_seconds:.2f} s, peak {stream_peak / 1e6:.1f} MB")
+    finally:
+        os.remove(path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
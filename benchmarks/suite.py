@@ -0,0 +1,125 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+from collections import defaultdict
+from functools import partial
+
+from common import ROOT_DIR, config, load
+from golden import read_golden
+
+# Times every pipeline stage and the whole format_prompt / convert_tags per
+# corpus category, and writes a JSON report that can be compared between commits.
+#
+#   python benchmarks/suite.py --output before.json
+#   python benchmarks/suite.py --output after.json --compare before.json
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(func, inputs, repeat: int):
+    def run():
+        for value in inputs:
+            func(value)
+    timer = timeit.Timer(run)
+    number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat=repeat, number=number)) / number
+    return {
+        "us_per_prompt": seconds * 1e6 / len(inputs),
+        "mchars_per_s": sum(map(len, inputs)) / seconds / 1e6,
+    }
+
+
+def stage_inputs(prompts, options):
+    # Feed every stage what the stage before it produced, like format_prompt does
+    pf = load("prompt_formatter")
+    inputs = defaultdict(list)
+    for prompt in prompts:
+        for stage, configured in pf.PIPELINE:
+            inputs[stage].append(prompt)
+            prompt = stage(prompt, options) if configured else stage(prompt)
+    return inputs
+
+
+def run(repeat: int):
+    pf = load("prompt_formatter")
+    defaults = config()
+    # Stage timings use underscores so space_to_underscore does real work
+    stage_config = config(CONV_SPACE_UNDERSCORE="Spaces to underscores")
+
+    categories = defaultdict(list)
+    for entry in read_golden():
+        if entry["prompt"]:
+            categories[entry["category"]].append(entry["prompt"])
+
+    results = {}
+    for category, prompts in categories.items():
+        print(f"{category} ({len(prompts)} prompts)", file=sys.stderr)
+        results[f"format_prompt/{category}"] = measure(
+            lambda prompt: pf.format_prompt_uncached(prompt, defaults), prompts, repeat
+        )
+        results[f"convert_tags/{category}"] = measure(
+            lambda prompt: pf.convert_tags_uncached(prompt, defaults), prompts, repeat
+        )
+
+        configured_stages = {stage for stage, configured in pf.PIPELINE if configured}
+        for stage, inputs in stage_inputs(prompts, stage_config).items():
+            if stage in configured_stages:
+                stage = partial(stage, config=stage_config)
+                name = stage.func.__name__
+            else:
+                name = stage.__name__
+            results[f"{name}/{category}"] = measure(stage, inputs, repeat)
+
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+
+
+def compare(report, baseline):
+    print(f"{'benchmark':>48} {'before us':>11} {'after us':>11} {'ratio':>7}")
+    for name, result in report["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["us_per_prompt"]
+        after = result["us_per_prompt"]
+        print(f"{name:>48} {before:>11.2f} {after:>11.2f} {after / before:>6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the formatter over the golden corpus.")
+    parser.add_argument("--output", help="Write the JSON report to this file.")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare against.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repeats, the fastest is kept (default: 3).")
+    args = parser.parse_args()
+
+    report = run(args.repeat)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(report, json.load(f))
+    else:
+        for name, result in report["results"].items():
+            print(f"{name:>48} {result['us_per_prompt']:>11.2f} us {result['mchars_per_s']:>8.2f} Mchars/s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+from common import config, load
+
+# Builds a synthetic tag dictionary CSV the size of a full booru export,
+# times compiling and opening its index, lookups, and convert_tags /
+# format_prompt with the dictionary enabled, and checks aliases are resolved.
+#
+#   python benchmarks/tag_dictionary.py [tags]
+
+
+def write_csv(path: str, count: int, rng: random.Random):
+    words = [f"w{i}" for i in range(2000)]
+    tags = []
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        for i in range(count):
+            tag = f"{rng.choice(words)}_{rng.choice(words)}_{i}"
+            aliases = ",".join(f"alias_{i}_{j}" for j in range(rng.randrange(3) if i else 1))
+            f.write(f'{tag},{rng.choice((0, 1, 3, 4, 5))},{rng.randrange(100000)},"{aliases}"\n')
+            tags.append(tag)
+    return tags
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tag_index = load("tag_index")
+    pf = load("prompt_formatter")
+    rng = random.Random(17)
+
+    with tempfile.TemporaryDirectory() as folder:
+        csv_path = os.path.join(folder, "tags.csv")
+        tags = write_csv(csv_path, count, rng)
+        print(f"{count} tags, CSV {os.path.getsize(csv_path) / 1e6:.1f} MB")
+
+        start = time.perf_counter()
+        index = tag_index.load_tag_index(csv_path)
+        print(f"build index: {time.perf_counter() - start:.2f} s, "
+              f"{os.path.getsize(tag_index.index_path_for(csv_path)) / 1e6:.1f} MB, {len(index)} keys")
+        start = time.perf_counter()
+        index = tag_index.load_tag_index(csv_path)
+        print(f"open index: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+        queries = [rng.choice(tags) for _ in range(50000)]
+        start = time.perf_counter()
+        for tag in queries:
+            index.find(tag.encode("utf-8"))
+        print(f"uncached lookups: {len(queries) / (time.perf_counter() - start):,.0f}/s")
+
+        defaults = config()
+        settings = {**defaults.settings, "TAG_DICTIONARY": csv_path, "TAG_UNKNOWN": "Remove"}
+        app_config = load("app_config")
+        with_dictionary = app_config.Config(settings, defaults.blacklist_content, defaults.blacklist, index)
+
+        # Aliases become their tag, unknown tags are dropped by convert_tags
+        expected = pf.convert_tags_uncached(f"{tags[0]} {tags[1]}", defaults)
+        if pf.convert_tags_uncached(f"alias_0_0 not_a_tag {tags[1]}", with_dictionary) != expected:
+            print("FAIL: convert_tags didn't resolve the alias or kept an unknown tag")
+            return 1
+        if pf.format_prompt_uncached("alias 0 0, other", with_dictionary) != pf.format_prompt_uncached(
+            f"{tags[0].replace('_', ' ')}, other", defaults
+        ):
+            print("FAIL: format_prompt didn't resolve the alias")
+            return 1
+
+        lines = [" ".join(rng.choice(tags) for _ in range(30)) for _ in range(2000)]
+        for name, cfg in (("without dictionary", defaults), ("with dictionary", with_dictionary)):
+            start = time.perf_counter()
+            for line in lines:
+                pf.convert_tags_uncached(line, cfg)
+            convert = time.perf_counter() - start
+            start = time.perf_counter()
+            for line in lines:
+                pf.format_prompt_uncached(line.replace(" ", ", "), cfg)
+            fmt = time.perf_counter() - start
+            print(f"{name}: convert_tags {convert * 1000:.0f} ms, format_prompt {fmt * 1000:.0f} ms ({len(lines)} prompts)")
+        index.data.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+
+from common import load
+from golden import read_golden
+
+# Checks wildcard expansion against building every combination with
+# itertools.product, then compares formatting a sweep variant by variant with
+# expand_formatted, and samples from a template with more combinations than
+# could ever be listed.
+#
+#   python benchmarks/wildcards.py [count]
+
+
+def naive(text: str):
+    # Flat templates only: every combination, in order
+    pieces = []
+    rest = text
+    while "{" in rest:
+        before, _, rest = rest.partition("{")
+        options, _, rest = rest.partition("}")
+        pieces.extend(([before], options.split("|")))
+    pieces.append([rest])
+    return ["".join(combination) for combination in itertools.product(*pieces)]
+
+
+def build_template(rng: random.Random, lines: int):
+    prompts = [entry["prompt"] for entry in read_golden() if entry["category"] == "handwritten"]
+    tags = sorted({tag.strip() for prompt in prompts for tag in prompt.replace("\n", ",").split(",")
+                   if tag.strip() and not any(c in tag for c in "{}|\\")})
+    template = []
+    for i in range(lines):
+        line = [rng.choice(tags) for _ in range(8)]
+        if i % 4 == 0:
+            line[rng.randrange(8)] = "{" + "|".join(rng.sample(tags, 3)) + "}"
+        template.append(", ".join(line) + ",")
+    return "\n".join(template)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    wildcards = load("wildcards")
+    pf = load("prompt_formatter")
+    rng = random.Random(22)
+    failures = 0
+
+    for text in ("{red|blue|green} hair, {1girl|2girls}, {a|b|c|d}", "no choices", "{a|} x {b|c}"):
+        template = wildcards.Template(text)
+        if list(template.expand(template.total)) != naive(text):
+            print(f"FAIL: {text!r} expanded differently than itertools.product")
+            failures += 1
+    nested = wildcards.Template("{a|{b|c} d|e}")
+    if list(nested.expand(10)) != ["a", "b d", "c d", "e"]:
+        print("FAIL: nested choices")
+        failures += 1
+    sample = list(wildcards.Template("{a|b|c|d|e}").expand(10, "sample", seed=3))
+    if sorted(sample) != list("abcde") or sample != list(wildcards.Template("{a|b|c|d|e}").expand(10, "sample", seed=3)):
+        print("FAIL: a sample isn't every variant once, or differs for the same seed")
+        failures += 1
+
+    text = build_template(rng, 40)
+    template = wildcards.Template(text)
+    print(f"40-line template, {template.total} variants, formatting {count}")
+    variants = list(template.expand(count, "sample", seed=1))
+    pf.format_cache.clear()
+    start = time.perf_counter()
+    expected = [pf.format_prompt(variant) for variant in variants]
+    one_by_one = time.perf_counter() - start
+    pf.format_cache.clear()
+    start = time.perf_counter()
+    _, results = wildcards.expand_formatted(text, count, mode="sample", seed=1)
+    shared = time.perf_counter() - start
+    print(f"format_prompt per variant {one_by_one:.2f} s, expand_formatted {shared:.2f} s")
+    if results != expected:
+        print("FAIL: expand_formatted differs from formatting every variant")
+        failures += 1
+    if len(pf.format_cache.data):
+        print("FAIL: expand_formatted filled the format cache")
+        failures += 1
+
+    # 100 choices of 10 options each: 10^100 variants
+    huge = ", ".join("{" + "|".join(f"tag{i}_{j}" for j in range(10)) + "}" for i in range(100))
+    tracemalloc.start()
+    start = time.perf_counter()
+    _, results = wildcards.expand_formatted(huge, 1000, action="none", mode="sample", seed=5)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"10^100 variants: sampled 1000 in {elapsed * 1000:.0f} ms, peak {peak / 1e6:.1f} MB")
+    if len(set(results)) != 1000:
+        print("FAIL: the sample repeats variants")
+        failures += 1
+
+    print(f"{failures} failures")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
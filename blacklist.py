@@ -0,0 +1,101 @@
+import re
+
+from .cache import LazyPattern
+
+# Characters that make a blacklist entry a regular expression rather than a plain tag
+REGEX_CHARS = set(".^$*+?{}[]\\|()")
+# Backreferences and global inline flags can't be part of a shared alternation
+re_standalone = LazyPattern(r"\\[1-9]|\(\?P=|^\(\?[aiLmsux]+\)")
+
+LINE_OPTIONS = {"@icase", "@literal"}
+VERDICT_MEMO_SIZE = 65536
+
+remove_parens = str.maketrans({"(": "", ")": ""})
+
+"""
+Matcher
+"""
+
+class PatternSet:
+    def __init__(self):
+        self.literals = set()
+        self.literals_icase = set()
+        self.patterns = []
+        self.regex = None
+        self.separate = []
+
+    def add(self, pattern: str, icase=False, literal=False):
+        if literal or not REGEX_CHARS.intersection(pattern):
+            if icase:
+                self.literals_icase.add(pattern.lower())
+            else:
+                self.literals.add(pattern)
+        else:
+            # Compile on its own first so a bad entry is reported as itself
+            re.compile(pattern)
+            self.patterns.append(f"(?i:{pattern})" if icase else pattern)
+
+    def compile(self):
+        combined = []
+        for pattern in self.patterns:
+            if re_standalone.search(pattern):
+                self.separate.append(re.compile(pattern))
+            else:
+                combined.append(pattern)
+        if combined:
+            try:
+                self.regex = re.compile("|".join(f"(?:{p})" for p in combined))
+            except re.error:
+                self.separate.extend(re.compile(p) for p in combined)
+
+    def match(self, tag: str):
+        return (
+            tag in self.literals
+            or (self.literals_icase and tag.lower() in self.literals_icase)
+            or (self.regex is not None and self.regex.fullmatch(tag) is not None)
+            or any(pattern.fullmatch(tag) for pattern in self.separate)
+        )
+
+class Blacklist:
+    """
+    Compiled blacklist file contents.
+
+    Each line holds whitespace-separated patterns matched against the whole tag
+    (with parentheses removed). `#` starts a comment, a `!` prefix turns a
+    pattern into a whitelist override, and `@icase` / `@literal` on a line make
+    its patterns case-insensitive / plain text.
+    """
+
+    def __init__(self, content: str):
+        self.blocked = PatternSet()
+        self.allowed = PatternSet()
+        self.verdicts = {}
+
+        for line in content.splitlines():
+            patterns = []
+            options = set()
+            for token in line.split():
+                if token.startswith("#"):
+                    break
+                if token in LINE_OPTIONS:
+                    options.add(token)
+                else:
+                    patterns.append(token)
+
+            for pattern in patterns:
+                target = self.blocked
+                if pattern.startswith("!") and len(pattern) > 1:
+                    target, pattern = self.allowed, pattern[1:]
+                target.add(pattern, icase="@icase" in options, literal="@literal" in options)
+
+        self.blocked.compile()
+        self.allowed.compile()
+
+    def __contains__(self, tag: str):
+        if (verdict := self.verdicts.get(tag)) is None:
+            key = tag.translate(remove_parens)
+            verdict = bool(self.blocked.match(key) and not self.allowed.match(key))
+            if len(self.verdicts) >= VERDICT_MEMO_SIZE:
+                self.verdicts.clear()
+            self.verdicts[tag] = verdict
+        return verdict
@@ -0,0 +1,135 @@
+import re
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe, size-bounded least-recently-used cache with counters."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def resize(self, maxsize: int):
+        if maxsize == self.maxsize:
+            return
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.data) > max(maxsize, 0):
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class MemoryLRUCache:
+    """Thread-safe least-recently-used cache bounded by the total byte size of its values."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size: int):
+        # Values larger than the whole budget are not stored
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if (previous := self.data.pop(key, None)) is not None:
+                self.bytes -= previous[1]
+            self.data[key] = (value, size)
+            self.bytes += size
+            self.evict()
+
+    def evict(self):
+        while self.bytes > self.max_bytes and self.data:
+            _, (_, size) = self.data.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def resize(self, max_bytes: int):
+        if max_bytes == self.max_bytes:
+            return
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.data),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class LazyPattern:
+    """A regular expression compiled on first use, so importing its module doesn't pay for it."""
+
+    def __init__(self, pattern: str, flags: int = 0):
+        self.source = pattern
+        self.source_flags = flags
+
+    def __getattr__(self, name):
+        # Only reached until the attribute is cached on the instance, a race compiles twice
+        value = getattr(re.compile(self.source, self.source_flags), name)
+        setattr(self, name, value)
+        return value
@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import sys
+import time
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
+
+from .app_config import get_config
+from .disk_cache import get_disk_cache
+from .prompt_formatter import format_prompt, convert_tags
+
+ACTIONS = {
+    "format_prompt": format_prompt,
+    "convert_tags": convert_tags,
+}
+
+# Number of JSONL records handed to the pool between checkpoints
+JSONL_WINDOW = 4096
+
+"""
+Helpers
+"""
+
+class Stats:
+    def __init__(self):
+        self.items = 0
+        self.chars = 0
+        self.changed = 0
+        self.errors = 0
+        self.start = time.perf_counter()
+
+    def add(self, chars, changed, error):
+        self.items += 1
+        self.chars += chars
+        self.changed += changed
+        self.errors += error is not None
+
+    def report(self, unit):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return (
+            f"Processed {self.items} {unit} ({self.changed} changed, {self.errors} errors), "
+            f"{self.chars / 1e6:.2f}M chars in {elapsed:.2f}s: "
+            f"{self.items / elapsed:.0f} {unit}/s, {self.chars / 1e6 / elapsed:.2f}M chars/s"
+        )
+
+def apply_actions(text, actions):
+    for action in actions:
+        text = ACTIONS[action](text)
+    return text
+
+def write_atomic(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8", newline="") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def iter_files(root, extension, exclude=None):
+    for dirpath, dirnames, filenames in os.walk(root):
+        # Don't descend into a mirrored output tree placed inside the input tree
+        dirnames[:] = sorted(d for d in dirnames if os.path.abspath(os.path.join(dirpath, d)) != exclude)
+        for filename in sorted(filenames):
+            if filename.endswith(extension):
+                yield os.path.relpath(os.path.join(dirpath, filename), root)
+
+"""
+Workers
+"""
+
+def process_file(rel_path, src_root, dst_root, actions):
+    src = os.path.join(src_root, rel_path)
+    dst = os.path.join(dst_root, rel_path)
+    try:
+        with open(src, "r", encoding="utf-8", newline="") as f:
+            text = f.read()
+        result = apply_actions(text, actions)
+        # Keep the caption file's final newline
+        if text.endswith("\n") and not result.endswith("\n"):
+            result += "\n"
+        if dst != src or result != text:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            write_atomic(dst, result)
+        return rel_path, len(text), result != text, None
+    except Exception as e:
+        return rel_path, 0, False, f"{type(e).__name__}: {e}"
+
+def process_record(line, field, actions):
+    if not line.strip():
+        return line, 0, False, None
+    try:
+        record = json.loads(line)
+        text = record[field]
+        if not isinstance(text, str):
+            raise TypeError(f"'{field}' is not a string")
+        result = apply_actions(text, actions)
+        if result == text:
+            return line, len(text), False, None
+        record[field] = result
+        return json.dumps(record, ensure_ascii=False), len(text), True, None
+    except Exception as e:
+        return line, 0, False, f"{type(e).__name__}: {e}"
+
+def warm_text(text, actions):
+    try:
+        result = apply_actions(text, actions)
+        return len(text), result != text, None
+    except Exception as e:
+        return 0, False, f"{type(e).__name__}: {e}"
+
+def iter_corpus(path, extension, field):
+    # Prompts of a caption directory or a JSONL file, for --warm-cache
+    if os.path.isdir(path):
+        for rel_path in iter_files(path, extension):
+            with open(os.path.join(path, rel_path), "r", encoding="utf-8", newline="") as f:
+                yield f.read()
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                text = json.loads(line)[field]
+            except (ValueError, KeyError, TypeError):
+                continue
+            if isinstance(text, str):
+                yield text
+
+"""
+Runners
+"""
+
+def run_directory(args, actions, pool):
+    src_root = args.input
+    dst_root = src_root if args.in_place else args.output
+    stats = Stats()
+
+    # Directory checkpoints list one finished relative path per line
+    done = set()
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        with open(args.checkpoint, "r", encoding="utf-8") as f:
+            done = set(f.read().splitlines())
+
+    exclude = None if args.in_place else os.path.abspath(dst_root)
+    paths = [p for p in iter_files(src_root, args.extension, exclude) if p not in done]
+    worker = partial(process_file, src_root=src_root, dst_root=dst_root, actions=actions)
+
+    checkpoint = open(args.checkpoint, "a", encoding="utf-8", buffering=1) if args.checkpoint else None
+    try:
+        for rel_path, chars, changed, error in pool.imap_unordered(worker, paths, chunksize=32):
+            stats.add(chars, changed, error)
+            if error is not None:
+                print(f"{rel_path}: {error}", file=sys.stderr)
+            elif checkpoint:
+                checkpoint.write(rel_path + "\n")
+    finally:
+        if checkpoint:
+            checkpoint.close()
+
+    print(stats.report("files"), file=sys.stderr)
+    return 1 if stats.errors else 0
+
+def run_jsonl(args, actions, pool):
+    src = args.input
+    dst = src + ".partial" if args.in_place else args.output
+    stats = Stats()
+
+    # JSONL checkpoints hold the number of records written and the output size at that point
+    state = {"lines": 0, "offset": 0, "complete": False}
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        with open(args.checkpoint, "r", encoding="utf-8") as f:
+            state.update(json.load(f))
+    if state["complete"]:
+        print(f"{src} was already processed according to {args.checkpoint}", file=sys.stderr)
+        return 0
+
+    def save_checkpoint():
+        if args.checkpoint:
+            write_atomic(args.checkpoint, json.dumps(state))
+
+    worker = partial(process_record, field=args.field, actions=actions)
+    with open(src, "r", encoding="utf-8") as fin, open(dst, "r+b" if state["lines"] else "wb") as fout:
+        # Drop anything written after the last checkpoint
+        fout.truncate(state["offset"])
+        fout.seek(state["offset"])
+        lines = (line.rstrip("\r\n") for line in islice(fin, state["lines"], None))
+
+        while window := list(islice(lines, JSONL_WINDOW)):
+            chunksize = max(1, len(window) // (args.workers * 4))
+            results = pool.map(worker, window, chunksize=chunksize)
+            for i, (line, chars, changed, error) in enumerate(results, state["lines"] + 1):
+                stats.add(chars, changed, error)
+                if error is not None:
+                    print(f"{src}:{i}: {error}", file=sys.stderr)
+                fout.write(line.encode("utf-8") + b"\n")
+            fout.flush()
+            state["lines"] += len(window)
+            state["offset"] = fout.tell()
+            save_checkpoint()
+
+    if args.in_place:
+        os.replace(dst, src)
+    state["complete"] = True
+    save_checkpoint()
+
+    print(stats.report("records"), file=sys.stderr)
+    return 1 if stats.errors else 0
+
+def run_warm_cache(args, actions, pool):
+    # Formats the corpus to fill the disk cache, writes nothing else
+    stats = Stats()
+    worker = partial(warm_text, actions=actions)
+    for chars, changed, error in pool.imap_unordered(worker, iter_corpus(args.input, args.extension, args.field), chunksize=64):
+        stats.add(chars, changed, error)
+        if error is not None:
+            print(error, file=sys.stderr)
+
+    print(stats.report("prompts"), file=sys.stderr)
+    print(get_disk_cache(get_config()).stats(), file=sys.stderr)
+    return 1 if stats.errors else 0
+
+"""
+Entry point
+"""
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m comfyui_prompt_formatter",
+        description="Format a directory tree of caption files or a JSONL prompt file.",
+    )
+    parser.add_argument("input", help="Directory of caption files or a .jsonl file.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("-o", "--output", help="Mirrored output directory, or output file for JSONL input.")
+    target.add_argument("--in-place", action="store_true", help="Overwrite the input files.")
+    target.add_argument(
+        "--warm-cache", action="store_true",
+        help="Only format the input to fill the disk cache (DISK_CACHE_MB in settings.json), write nothing.",
+    )
+    parser.add_argument(
+        "-a", "--action", action="append", choices=list(ACTIONS),
+        help="Formatter to run, repeat to chain them in order (default: format_prompt).",
+    )
+    parser.add_argument("--field", default="prompt", help="JSONL field holding the prompt (default: prompt).")
+    parser.add_argument("--extension", default=".txt", help="Caption file extension (default: .txt).")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="Worker processes (default: all cores).")
+    parser.add_argument("--checkpoint", help="Progress file, rerun with the same file to resume.")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    actions = tuple(args.action or ["format_prompt"])
+    args.workers = max(1, args.workers)
+
+    if args.warm_cache:
+        if get_disk_cache(get_config()) is None:
+            print("The disk cache is disabled, set DISK_CACHE_MB in settings.json", file=sys.stderr)
+            return 2
+        if not os.path.exists(args.input):
+            print(f"{args.input} does not exist", file=sys.stderr)
+            return 2
+        runner = run_warm_cache
+    elif os.path.isdir(args.input):
+        runner = run_directory
+    elif os.path.isfile(args.input):
+        runner = run_jsonl
+    else:
+        print(f"{args.input} does not exist", file=sys.stderr)
+        return 2
+
+    with Pool(args.workers) as pool:
+        return runner(args, actions, pool)
@@ -0,0 +1,230 @@
+import importlib.util
+import logging
+import os
+import re
+import threading
+
+from .cache import LazyPattern, LRUCache
+
+# CLIP token counting and the chunk planner. CLIP sees a prompt through a
+# 75-token window (77 with the start and end tokens); ComfyUI and A1111 start a
+# new window at BREAK. With CLIP_CHUNK_TOKENS set, format_prompt packs whole
+# tags into chunks of at most that many tokens and puts a BREAK between them,
+# so a tag is never split across two windows.
+#
+# Tokens are counted with CLIP's byte-level BPE, using the merges of the CLIP
+# tokenizer bundled with ComfyUI, so nothing is downloaded. Outside ComfyUI the
+# count is estimated from the text length, which errs on the high side. Counts
+# are memoized per tag and per word in tables shared by every call.
+
+# Tokens of one CLIP window, without the start and end tokens
+CLIP_WINDOW = 75
+TAG_COUNT_CACHE_SIZE = 65536
+PIECE_COUNT_MEMO_SIZE = 65536
+# Longer runs of letters are counted in blocks, BPE is quadratic in the length of a word
+MAX_BPE_PIECE = 64
+# Merges in CLIP's vocabulary: 49152 tokens, less 256 bytes and the start and end tokens
+CLIP_MERGES = 49152 - 256 - 2
+
+# CLIP's pre-tokenizer, with Python classes for \p{L} and \p{N}
+re_clip_piece = LazyPattern(r"'s|'t|'re|'ve|'m|'ll|'d|[^\W\d_]+|\d|(?:[^\s\w]|_)+", re.IGNORECASE)
+# Weight syntax isn't tokenized: unescaped brackets and the ":1.2" before a closing one
+re_weight_syntax = LazyPattern(r"(?<!\\)[()\[\]]|:\s*-?[\d.]+\s*(?=(?<!\\)[)\]])")
+re_escaped = LazyPattern(r"\\([()\[\]])")
+# Where tags end: separators and brackets at the top level, BREAK resets the count
+re_chunk_event = LazyPattern(r"\\.|[()\[\]]|[,\n]|(?<![^\s,])BREAK(?![^\s,])")
+re_separator_run = LazyPattern(r"[\s,]*")
+
+"""
+Tokenizer
+"""
+
+def bytes_to_unicode():
+    # CLIP's printable stand-ins for the 256 byte values
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    chars = printable[:]
+    extra = 0
+    for b in range(256):
+        if b not in printable:
+            printable.append(b)
+            chars.append(256 + extra)
+            extra += 1
+    return dict(zip(printable, map(chr, chars)))
+
+def bundled_merges_path():
+    # merges.txt of ComfyUI's SD1 tokenizer, found without importing ComfyUI
+    try:
+        spec = importlib.util.find_spec("comfy")
+    except (ImportError, ValueError):
+        return None
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    for folder in spec.submodule_search_locations:
+        path = os.path.join(folder, "sd1_tokenizer", "merges.txt")
+        if os.path.isfile(path):
+            return path
+    return None
+
+def read_merges(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        lines = f.read().split("\n")
+    # The first line is a version header
+    return [tuple(line.split()) for line in lines[1:CLIP_MERGES + 1] if len(line.split()) == 2]
+
+class ClipTokenCounter:
+    """
+    Counts the CLIP tokens of tags. Without merges every word is estimated at
+    one token per four bytes.
+    """
+    def __init__(self, merges=None):
+        self.ranks = {pair: rank for rank, pair in enumerate(merges)} if merges else None
+        self.byte_encoder = bytes_to_unicode()
+        self.tag_counts = LRUCache(TAG_COUNT_CACHE_SIZE)
+        self.piece_counts = {}
+
+    @property
+    def exact(self):
+        return self.ranks is not None
+
+    def bpe(self, word: str):
+        # Number of tokens CLIP's BPE splits a pre-tokenized word into
+        parts = list(word[:-1]) + [word[-1] + "</w>"]
+        ranks = self.ranks
+        while len(parts) > 1:
+            best = None
+            best_rank = None
+            for pair in zip(parts, parts[1:]):
+                rank = ranks.get(pair)
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best, best_rank = pair, rank
+            if best is None:
+                break
+            merged = []
+            i = 0
+            while i < len(parts):
+                if i + 1 < len(parts) and parts[i] == best[0] and parts[i + 1] == best[1]:
+                    merged.append(parts[i] + parts[i + 1])
+                    i += 2
+                else:
+                    merged.append(parts[i])
+                    i += 1
+            parts = merged
+        return len(parts)
+
+    def count_piece(self, piece: str):
+        if (count := self.piece_counts.get(piece)) is not None:
+            return count
+        encoded = piece.encode("utf-8")
+        if self.ranks is None:
+            count = (len(encoded) + 3) // 4
+        else:
+            word = "".join(self.byte_encoder[b] for b in encoded)
+            count = sum(self.bpe(word[i:i + MAX_BPE_PIECE]) for i in range(0, len(word), MAX_BPE_PIECE))
+        if len(self.piece_counts) >= PIECE_COUNT_MEMO_SIZE:
+            self.piece_counts.clear()
+        self.piece_counts[piece] = count
+        return count
+
+    def count(self, tag: str):
+        # Tokens of a tag as ComfyUI tokenizes it, weight syntax left out
+        if (count := self.tag_counts.get(tag)) is not None:
+            return count
+        text = re_escaped.sub(r"\1", re_weight_syntax.sub(" ", tag)).lower()
+        count = sum(map(self.count_piece, re_clip_piece.findall(text)))
+        self.tag_counts.put(tag, count)
+        return count
+
+counter = None
+counter_lock = threading.Lock()
+
+def get_counter():
+    # Loads the merges on first use
+    global counter
+    if counter is None:
+        with counter_lock:
+            if counter is None:
+                merges = None
+                if (path := bundled_merges_path()) is not None:
+                    try:
+                        merges = read_merges(path)
+                    except OSError as e:
+                        logging.warning(f"[Prompt Formatter] Couldn't read the CLIP vocabulary {path}: {e}")
+                if not merges:
+                    logging.warning("[Prompt Formatter] CLIP vocabulary not found, token counts are estimated")
+                counter = ClipTokenCounter(merges)
+    return counter
+
+"""
+Chunk planning
+"""
+
+def split_tags(prompt: str):
+    """
+    Yields (separator start, tag start, tag end, is_break) for the tags of a
+    prompt: text between commas and line breaks outside brackets. The
+    separator before a tag runs from separator start to tag start.
+    """
+    depth = 0
+    start = 0
+    separator = 0
+    is_break = False
+    for match in re_chunk_event.finditer(prompt):
+        event = match.group()
+        if event in "([":
+            depth += 1
+        elif event in ")]":
+            depth = max(depth - 1, 0)
+        elif depth == 0 and (event in ",\n" or event == "BREAK") and match.start() >= start:
+            yield separator, start, match.start(), is_break
+            separator = match.start()
+            start = re_separator_run.match(prompt, match.end()).end()
+            is_break = event == "BREAK"
+            # BREAK is a separator of its own, so is everything around it
+            while prompt.startswith("BREAK", start) and not prompt[start + 5:start + 6].strip(" ,\n"):
+                is_break = True
+                start = re_separator_run.match(prompt, start + 5).end()
+    yield separator, start, len(prompt), is_break
+
+def plan_chunks(prompt: str, limit: int, counter: ClipTokenCounter):
+    """
+    Packs the tags of a prompt into chunks of at most limit tokens, starting
+    a new chunk with a BREAK before a tag that doesn't fit. Existing BREAKs are
+    kept. Returns the prompt and the text and token count of every chunk; a
+    single tag longer than limit gets a chunk of its own.
+    """
+    pieces = []
+    chunks = []
+    chunk_start = 0
+    tokens = 0
+    for separator, start, end, is_break in split_tags(prompt):
+        tag = prompt[start:end]
+        count = counter.count(tag) if tag.strip() else 0
+        # The comma before a tag is a token of its own
+        cost = count + (tokens > 0 and "," in prompt[separator:start])
+        if is_break or (tokens and count and tokens + cost > limit):
+            if not is_break:
+                gap = prompt[separator:start]
+                pieces.append("\nBREAK\n" if "\n" in gap else " BREAK ")
+            else:
+                pieces.append(prompt[separator:start])
+            chunks.append((chunk_start, len(pieces) - 1, tokens))
+            chunk_start = len(pieces)
+            tokens = count
+        else:
+            pieces.append(prompt[separator:start])
+            tokens += cost
+        pieces.append(tag)
+    chunks.append((chunk_start, len(pieces), tokens))
+
+    report = [("".join(pieces[first:last]).strip(" ,\n"), count) for first, last, count in chunks]
+    return "".join(pieces), [{"text": text, "tokens": count} for text, count in report if text]
+
+def chunk_prompt(prompt: str, config):
+    # Format stage, BREAKs between chunks of CLIP_CHUNK_TOKENS tokens
+    if not config.CLIP_CHUNK_TOKENS or not prompt.strip():
+        return prompt
+    return plan_chunks(prompt, config.CLIP_CHUNK_TOKENS, get_counter())[0]
+
+def count_chunks(prompt: str):
+    # The chunks a prompt has now, split at its BREAKs, with their token counts
+    return plan_chunks(prompt, float("inf"), get_counter())[1]
@@ -0,0 +1,87 @@
+import hashlib
+import sys
+import weakref
+
+from .app_config import DEFAULT_CONFIG, get_config
+from .cache import LazyPattern, MemoryLRUCache
+
+# Conditioning produced by CLIPTextEncodeFormatter, reused when the same text is
+# encoded again by the same CLIP in the same state. Nothing here imports
+# ComfyUI: a CLIP is anything with tokenize() and encode_from_tokens_scheduled().
+
+# Encoded conditioning, keyed by CLIP state and text hash, bounded by CONDITIONING_CACHE_MB
+conditioning_cache = MemoryLRUCache(DEFAULT_CONFIG["CONDITIONING_CACHE_MB"] * 2**20)
+
+re_break = LazyPattern(r"(?<![^\s,])BREAK(?![^\s,])")
+
+def text_hash(text: str):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+def clip_state(clip):
+    """
+    What an encoding depends on besides the text: the CLIP object, the patches
+    applied to its model (LoRAs change patches_uuid), the clip skip layer and
+    the tokenizer options. Returns None for a CLIP with hooks attached, since
+    those are applied to the conditioning and can change without a trace here.
+    """
+    if getattr(clip, "apply_hooks_to_conds", None) is not None:
+        return None
+    patcher = getattr(clip, "patcher", None)
+    return (
+        id(clip),
+        getattr(patcher, "patches_uuid", None),
+        getattr(clip, "layer_idx", None),
+        repr(getattr(clip, "tokenizer_options", None)),
+    )
+
+def nbytes(value):
+    # Size of a conditioning: tensor storage plus the containers holding it
+    if hasattr(value, "element_size") and hasattr(value, "nelement"):
+        return value.element_size() * value.nelement()
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+def tokenize_chunks(clip, text: str):
+    # Every chunk between BREAKs starts a new CLIP window, as planned by CLIP_CHUNK_TOKENS
+    tokens = None
+    for chunk in re_break.split(text):
+        if not (chunk := chunk.strip(" ,\n")):
+            continue
+        part = clip.tokenize(chunk)
+        if tokens is None:
+            tokens = part
+            continue
+        # Tokenizers that don't return lists of windows get the text as it is
+        if not isinstance(part, dict) or not all(isinstance(windows, list) and isinstance(tokens.get(key), list) for key, windows in part.items()):
+            return clip.tokenize(text)
+        tokens = {key: tokens[key] + windows for key, windows in part.items()}
+    return tokens if tokens is not None else clip.tokenize(text)
+
+def encode(clip, text: str, chunked=None):
+    if chunked is None:
+        chunked = bool(get_config().CLIP_CHUNK_TOKENS)
+    tokens = tokenize_chunks(clip, text) if chunked and re_break.search(text) else clip.tokenize(text)
+    return clip.encode_from_tokens_scheduled(tokens)
+
+def encode_cached(clip, text: str):
+    config = get_config()
+    conditioning_cache.resize(config.CONDITIONING_CACHE_MB * 2**20)
+    if (state := clip_state(clip)) is None:
+        return encode(clip, text)
+    try:
+        clip_ref = weakref.ref(clip)
+    except TypeError:
+        return encode(clip, text)
+
+    chunked = bool(config.CLIP_CHUNK_TOKENS)
+    key = (state, chunked, text_hash(text))
+    # The weak reference guards against a new CLIP reusing the id of a freed one
+    if (entry := conditioning_cache.get(key)) is not None and entry[0]() is clip:
+        return entry[1]
+
+    conditioning = encode(clip, text, chunked)
+    conditioning_cache.put(key, (clip_ref, conditioning), nbytes(conditioning))
+    return conditioning
@@ -0,0 +1,159 @@
+from .cache import LazyPattern, LRUCache
+
+# Policies for duplicate tags:
+# - "Exact": tags are duplicates when their stripped text is identical, the first is kept
+# - "First": tags are duplicates when their canonical keys match, the first is kept
+# - "Strongest": canonical keys, the occurrence with the highest weight is kept
+DEDUPE_POLICIES = ("Exact", "First", "Strongest")
+
+KEY_MEMO_SIZE = 65536
+KNOWN_TAGS_CACHE_SIZE = 256
+# Weight of one level of () or [] emphasis
+BRACKET_WEIGHT = 1.1
+
+re_weight_value = LazyPattern(r"\s*(-?(?:\d+(?:\.\d*)?|\.\d+))\s*")
+re_escaped_bracket = LazyPattern(r"\\([()\[\]])")
+
+# Canonical keys and weights of tags seen before, cleared when full
+key_memo = {}
+# Keys of the comma-separated tags of recent texts, see drop_known
+known_tags_cache = LRUCache(KNOWN_TAGS_CACHE_SIZE)
+
+"""
+Canonical keys
+"""
+
+def wrapped_in(tag: str, opening: str, closing: str):
+    # Whether the whole tag is one bracket group, e.g. "(a)" but not "(a) (b)"
+    if len(tag) < 2 or tag[0] != opening or tag[-1] != closing or tag[-2] == "\\":
+        return False
+    depth = 0
+    escaped = False
+    for i, c in enumerate(tag):
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c in "([":
+            depth += 1
+        elif c in ")]":
+            depth -= 1
+            if depth == 0 and i < len(tag) - 1:
+                return False
+    return depth == 0
+
+def split_weight(inner: str):
+    # "blue eyes:1.2" -> ("blue eyes", 1.2), None without an explicit weight
+    head, colon, value = inner.rpartition(":")
+    if not colon or (match := re_weight_value.fullmatch(value)) is None:
+        return None
+    return head, float(match.group(1))
+
+def parse_tag(tag: str):
+    """
+    Returns the canonical key and the weight of a tag. The key has emphasis
+    brackets and explicit weights removed, escapes undone, underscores turned
+    into spaces, whitespace collapsed and case folded, so "(Blue_Eyes:1.2)",
+    "((blue eyes))" and "blue eyes" share a key. Prompt editing such as
+    "[a:b:0.5]" and wildcards such as "__hair__" keep their text.
+    """
+    weight = 1.0
+    key = tag.strip()
+    while True:
+        if wrapped_in(key, "(", ")"):
+            if (split := split_weight(key[1:-1])) is not None:
+                key, value = split
+                weight *= value
+            else:
+                key = key[1:-1]
+                weight *= BRACKET_WEIGHT
+        elif wrapped_in(key, "[", "]") and ":" not in key:
+            key = key[1:-1]
+            weight /= BRACKET_WEIGHT
+        else:
+            break
+        key = key.strip()
+
+    key = re_escaped_bracket.sub(r"\1", key).casefold()
+    if not (key.startswith("__") and key.endswith("__")):
+        key = key.replace("_", " ")
+    return " ".join(key.split()), weight
+
+def tag_key(tag: str):
+    if (parsed := key_memo.get(tag)) is None:
+        parsed = parse_tag(tag)
+        if len(key_memo) >= KEY_MEMO_SIZE:
+            key_memo.clear()
+        key_memo[tag] = parsed
+    return parsed
+
+"""
+Deduplication
+"""
+
+class TagDeduper:
+    """
+    Decides which occurrence of every tag survives, in a single pass.
+
+    Callers offer tags in order together with the index of the slot the tag
+    would occupy in their output. A later, stronger occurrence under the
+    "Strongest" policy returns the slot of the earlier one, which the caller
+    empties. Slots below `sealed` belong to output that was already handed
+    out, those occurrences stay and the later one is dropped instead. Removed
+    tags are collected in `removed`.
+    """
+
+    def __init__(self, policy: str = "Exact"):
+        if policy not in DEDUPE_POLICIES:
+            raise ValueError(f"Unknown dedupe policy: {policy!r}")
+        self.policy = policy
+        self.kept = {}
+        self.removed = []
+        self.sealed = 0
+
+    def key(self, tag: str):
+        return (tag, 1.0) if self.policy == "Exact" else tag_key(tag)
+
+    def __contains__(self, tag: str):
+        return self.key(tag)[0] in self.kept
+
+    def offer(self, tag: str, slot=None, key=None):
+        # Returns whether the tag is kept, and the slot of an earlier occurrence it replaces.
+        # key is self.key(tag) when the caller already has it.
+        key, weight = key or self.key(tag)
+        if (previous := self.kept.get(key)) is None:
+            self.kept[key] = (slot, weight, tag)
+            return True, None
+        if self.policy == "Strongest" and weight > previous[1] and previous[0] is not None and previous[0] >= self.sealed:
+            self.kept[key] = (slot, weight, tag)
+            self.removed.append(previous[2])
+            return True, previous[0]
+        self.removed.append(tag)
+        return False, None
+
+def known_tags(text: str, policy: str):
+    # Keys of the comma-separated tags of text, memoized since the same base prompt is appended to repeatedly
+    cache_key = (text, policy)
+    if (keys := known_tags_cache.get(cache_key)) is None:
+        deduper = TagDeduper(policy)
+        keys = frozenset(deduper.key(token.strip())[0] for token in text.split(",") if token.strip())
+        known_tags_cache.put(cache_key, keys)
+    return keys
+
+def drop_known(text: str, known_text: str, policy: str = "Exact"):
+    """
+    Removes the comma-separated tags of text that known_text already has, and
+    returns what is left (separators kept as they were) and the tags removed.
+    Tags already in known_text always win, whatever their weight.
+    """
+    keys = known_tags(known_text, policy)
+    deduper = TagDeduper(policy)
+    kept = []
+    removed = []
+    for token in text.split(","):
+        normalized = token.strip()
+        if normalized and deduper.key(normalized)[0] in keys:
+            removed.append(normalized)
+        else:
+            kept.append(token)
+    return ",".join(kept), removed
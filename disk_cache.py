@@ -0,0 +1,238 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# Optional disk cache of format_prompt and convert_tags results, shared by
+# every process using the same file (several ComfyUI instances, the bulk CLI
+# and its workers) and kept across restarts. It is a SQLite database in WAL
+# mode: readers never block, writers wait their turn up to BUSY_TIMEOUT.
+#
+# Entries are keyed by a hash of the action, the formatter version (a hash of
+# the source of the modules the results depend on), the settings the result
+# depends on (format_key / convert_key) and the text. A key's value never
+# changes, so writers only insert. The total size of the entries is kept by
+# triggers, and once it passes DISK_CACHE_MB the least recently used entries
+# are deleted. Lookups only read: the last uses of the entries they found are
+# written by the next insert of the same process, in its transaction. A SQLite
+# error (a locked or read-only file) only costs the lookup or insert at hand,
+# the result is formatted as if the cache was off.
+
+# Modules whose changes can change results
+FORMATTER_MODULES = (
+    "prompt_formatter.py", "weights.py", "segments.py", "dedupe.py", "blacklist.py", "tag_index.py", "clip_tokens.py",
+)
+# Seconds a writer waits for another process' write
+BUSY_TIMEOUT = 5.0
+# Seconds between updates of an entry's last use, a lookup doesn't write every time
+TOUCH_INTERVAL = 60.0
+# Last uses kept for the next insert at most, past it new ones are dropped
+TOUCH_PENDING_MAX = 65536
+# Eviction deletes down to this share of the budget, so it doesn't run on every insert
+EVICT_TARGET = 0.9
+EVICT_BATCH = 512
+# Bytes counted per entry besides key and value
+ROW_OVERHEAD = 48
+PREFIX_MEMO_SIZE = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_used ON results (used);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta VALUES ('bytes', 0);
+CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results
+    BEGIN UPDATE meta SET value = value + new.size WHERE name = 'bytes'; END;
+CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results
+    BEGIN UPDATE meta SET value = value - old.size WHERE name = 'bytes'; END;
+"""
+
+base_dir = os.path.dirname(__file__)
+version = None
+prefixes = {}
+caches = {}
+caches_lock = threading.Lock()
+
+"""
+Keys
+"""
+
+def formatter_version():
+    # Computed once per process
+    global version
+    if version is None:
+        digest = hashlib.blake2b(digest_size=16)
+        for name in FORMATTER_MODULES:
+            digest.update(name.encode("utf-8"))
+            try:
+                with open(os.path.join(base_dir, name), "rb") as f:
+                    digest.update(f.read())
+            except OSError:
+                pass
+        version = digest.hexdigest()
+    return version
+
+def result_key(action: str, text: str, settings_key):
+    # settings_key is config.format_key or config.convert_key, sets are sorted to hash the same in every process
+    memo_key = (action, settings_key)
+    if (prefix := prefixes.get(memo_key)) is None:
+        if len(prefixes) >= PREFIX_MEMO_SIZE:
+            prefixes.clear()
+        prefix = prefixes[memo_key] = json.dumps([action, formatter_version(), settings_key], default=sorted).encode("utf-8")
+    digest = hashlib.blake2b(prefix, digest_size=16)
+    digest.update(b"\0")
+    digest.update(text.encode("utf-8", "surrogatepass"))
+    return digest.digest()
+
+"""
+Cache
+"""
+
+class DiskCache:
+    """A SQLite result cache, one connection per thread and process."""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        # {key: time} of entries found stale by lookups, written by put_many
+        self.touched = {}
+        self.touched_lock = threading.Lock()
+
+    def connection(self):
+        # Connections can't cross a fork, a forked worker opens its own
+        local = self.local
+        if getattr(local, "pid", None) != os.getpid():
+            import sqlite3  # only loaded when the cache is enabled
+
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            local.connection, local.pid, local.error = connection, os.getpid(), sqlite3.Error
+        return local.connection
+
+    def failed(self, error: Exception):
+        self.errors += 1
+        # The first error and then one in a thousand are logged, a broken cache shouldn't flood the log
+        if self.errors % 1000 == 1:
+            logging.warning(f"[Prompt Formatter] Disk cache {self.path} failed, formatting without it: {error}")
+
+    def run(self, func, *args):
+        try:
+            connection = self.connection()
+        except Exception as e:
+            self.failed(e)
+            return None
+        try:
+            return func(connection, *args)
+        except self.local.error as e:
+            if connection.in_transaction:
+                connection.rollback()
+            self.failed(e)
+            return None
+
+    def get_many(self, keys: list):
+        # Returns {key: value} for the keys found
+        def lookup(connection, keys):
+            found = {}
+            stale = []
+            now = time.time()
+            cutoff = now - TOUCH_INTERVAL
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                query = f"SELECT key, value, used FROM results WHERE key IN ({','.join('?' * len(batch))})"
+                for key, value, used in connection.execute(query, batch):
+                    found[key] = value
+                    if used < cutoff:
+                        stale.append(key)
+            if stale:
+                with self.touched_lock:
+                    for key in stale[:TOUCH_PENDING_MAX - len(self.touched)]:
+                        self.touched[key] = now
+            return found
+
+        found = self.run(lookup, list(keys)) or {}
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key: bytes):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items: list):
+        # items are (key, value) pairs
+        def insert(connection, items):
+            now = time.time()
+            with self.touched_lock:
+                touched, self.touched = self.touched, {}
+            connection.execute("BEGIN IMMEDIATE")
+            # Before eviction, so entries just looked up aren't deleted as unused
+            connection.executemany("UPDATE results SET used = ? WHERE key = ?", [(used, key) for key, used in touched.items()])
+            connection.executemany(
+                "INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?)",
+                [(key, value, len(key) + len(value.encode("utf-8", "surrogatepass")) + ROW_OVERHEAD, now) for key, value in items],
+            )
+            total = connection.execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+            if total > self.max_bytes:
+                while total > self.max_bytes * EVICT_TARGET:
+                    deleted = connection.execute(
+                        "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used LIMIT ?)", (EVICT_BATCH,)
+                    ).rowcount
+                    if not deleted:
+                        break
+                    self.evictions += deleted
+                    total = connection.execute("SELECT value FROM meta WHERE name = 'bytes'").fetchone()[0]
+            connection.execute("COMMIT")
+
+        if items:
+            self.run(insert, items)
+
+    def put(self, key: bytes, value: str):
+        self.put_many([(key, value)])
+
+    def clear(self):
+        def delete(connection):
+            connection.execute("DELETE FROM results")
+        self.run(delete)
+
+    def stats(self):
+        def size(connection):
+            return connection.execute("SELECT count(*), (SELECT value FROM meta WHERE name = 'bytes') FROM results").fetchone()
+        entries, total = self.run(size) or (None, None)
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "errors": self.errors,
+        }
+
+def get_disk_cache(config):
+    # The cache of the configured file, None while DISK_CACHE_MB is 0
+    if not config.DISK_CACHE_MB:
+        return None
+    path = os.path.join(base_dir, config.DISK_CACHE_FILE)
+    max_bytes = config.DISK_CACHE_MB * 2**20
+    with caches_lock:
+        if (cache := caches.get(path)) is None:
+            cache = caches[path] = DiskCache(path, max_bytes)
+        cache.max_bytes = max_bytes
+    return cache
+
+def disk_get(action: str, text: str, config, settings_key):
+    if (cache := get_disk_cache(config)) is None:
+        return None
+    return cache.get(result_key(action, text, settings_key))
+
+def disk_put(action: str, text: str, config, settings_key, result: str):
+    if (cache := get_disk_cache(config)) is not None:
+        cache.put(result_key(action, text, settings_key), result)
@@ -28,16 +28,197 @@ async function handlePromptRequest(action, text) {
     }
 }
 
+// Lines and formatted lines the server has seen, by text and by id
+const MAX_REMEMBERED_LINES = 4096;
+
+async function requestSegments(state, text) {
+    const response = await fetch("/prompt_formatter/format_segments", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({
+            lines: text.split("\n").map((line) => state.lineIds.get(line) ?? { text: line }),
+            known: [...state.outputs.keys()]
+        })
+    });
+    if (!response.ok) {
+        throw new Error(`Error: ${response.status} - ${response.statusText}`);
+    }
+    return await response.json();
+}
+
+async function handleSegmentedFormat(node, text) {
+    // Only lines the server hasn't seen are sent as text, the rest go by id
+    if (!node.segmentState || node.segmentState.lineIds.size > MAX_REMEMBERED_LINES) {
+        node.segmentState = { lineIds: new Map(), outputs: new Map() };
+    }
+    try {
+        let result = await requestSegments(node.segmentState, text);
+        if (!result.success && result.missing) {
+            // The server dropped some lines, start over with the full text
+            node.segmentState = { lineIds: new Map(), outputs: new Map() };
+            result = await requestSegments(node.segmentState, text);
+        }
+        if (!result.success) {
+            throw new Error(result.error ?? "Failed to format segments");
+        }
+
+        const state = node.segmentState;
+        text.split("\n").forEach((line, i) => state.lineIds.set(line, result.line_ids[i]));
+        for (const segment of result.segments) {
+            if (segment.text !== undefined) {
+                state.outputs.set(segment.id, segment.text);
+            }
+        }
+        return result.segments.map((segment) => state.outputs.get(segment.id)).join("\n");
+    } catch (error) {
+        console.error("Segmented formatting failed, formatting the whole prompt:", error);
+        node.segmentState = null;
+        return await handlePromptRequest("format_prompt", text);
+    }
+}
+
+// Live preview: edits are streamed over one websocket, each with a sequence
+// number per node, and only the answer to a node's newest edit is shown
+const LIVE_DEBOUNCE_MS = 100;
+const liveNodes = new Map();
+let liveSocket = null;
+let liveUnavailable = false;
+
+function liveMessage(node) {
+    const text = findWidgetByName(node, "text")?.value ?? "";
+    return JSON.stringify({ id: String(node.id), seq: node.liveSeq, action: "format_prompt", text: text });
+}
+
+function showLiveResult(node, seq, result) {
+    if (seq !== node.liveSeq || !node.livePreview) {
+        return;
+    }
+    node.livePreview.value = result;
+}
+
+function getLiveSocket() {
+    if (liveSocket && liveSocket.readyState <= WebSocket.OPEN) {
+        return liveSocket;
+    }
+    const protocol = location.protocol === "https:" ? "wss:" : "ws:";
+    const socket = new WebSocket(`${protocol}//${location.host}/prompt_formatter/live`);
+    socket.addEventListener("open", () => {
+        socket.opened = true;
+        // Edits made while connecting, only the newest of each node is sent
+        for (const node of liveNodes.values()) {
+            if (node.liveSeq) {
+                socket.send(liveMessage(node));
+            }
+        }
+    });
+    socket.addEventListener("message", (event) => {
+        const result = JSON.parse(event.data);
+        const node = liveNodes.get(result.id);
+        if (node) {
+            showLiveResult(node, result.seq, result.success ? result.formatted_prompt : "");
+        }
+    });
+    socket.addEventListener("close", () => {
+        // A server without the live route never opens the socket, fall back to POST requests
+        if (!socket.opened) {
+            liveUnavailable = true;
+        }
+        if (liveSocket === socket) {
+            liveSocket = null;
+        }
+    });
+    liveSocket = socket;
+    return socket;
+}
+
+async function sendLiveEdit(node) {
+    node.liveSeq = (node.liveSeq ?? 0) + 1;
+    if (liveUnavailable) {
+        const seq = node.liveSeq;
+        const text = findWidgetByName(node, "text")?.value ?? "";
+        showLiveResult(node, seq, await handlePromptRequest("format_prompt", text));
+        return;
+    }
+    const socket = getLiveSocket();
+    if (socket.readyState === WebSocket.OPEN) {
+        socket.send(liveMessage(node));
+    }
+}
+
+function setLivePreview(node, enabled) {
+    const textWidget = findWidgetByName(node, "text");
+    if (!enabled) {
+        liveNodes.delete(String(node.id));
+        if (node.livePreview) {
+            node.livePreview.value = "";
+        }
+        return;
+    }
+    if (!node.livePreview) {
+        node.livePreview = document.createElement("textarea");
+        node.livePreview.className = "comfy-multiline-input";
+        node.livePreview.readOnly = true;
+        node.livePreview.placeholder = "Live preview";
+        node.addDOMWidget("live_preview", "preview", node.livePreview, { serialize: false });
+        textWidget?.inputEl?.addEventListener("input", () => {
+            if (!liveNodes.has(String(node.id))) {
+                return;
+            }
+            // Bursts of keystrokes are sent as one edit, the server coalesces the rest
+            clearTimeout(node.liveTimer);
+            node.liveTimer = setTimeout(() => sendLiveEdit(node), LIVE_DEBOUNCE_MS);
+        });
+    }
+    liveNodes.set(String(node.id), node);
+    sendLiveEdit(node);
+}
+
+// Must match APPEND_MAX_INPUTS in nodes.py
+const APPEND_MAX_INPUTS = 64;
+
+function updateAppendInputs(node) {
+    // Keep the string inputs up to the last connected one, plus one free input to connect next
+    const stringInputs = (node.inputs ?? []).filter((input) => /^string\d+$/.test(input.name));
+    let lastConnected = -1;
+    stringInputs.forEach((input, i) => {
+        if (input.link != null) {
+            lastConnected = i;
+        }
+    });
+    for (let i = stringInputs.length - 1; i > lastConnected + 1; i--) {
+        node.removeInput(node.inputs.indexOf(stringInputs[i]));
+    }
+    if (stringInputs.length <= lastConnected + 1 && lastConnected + 1 < APPEND_MAX_INPUTS) {
+        node.addInput(`string${lastConnected + 2}`, "STRING");
+    }
+}
+
 app.registerExtension({
     name: "prompt.formatter",
     nodeCreated(node) {
+        if (node.comfyClass === "TextAppendManyFormatter") {
+            const onConnectionsChange = node.onConnectionsChange;
+            node.onConnectionsChange = function (...args) {
+                const result = onConnectionsChange?.apply(this, args);
+                updateAppendInputs(this);
+                return result;
+            };
+            const onConfigure = node.onConfigure;
+            node.onConfigure = function (...args) {
+                const result = onConfigure?.apply(this, args);
+                updateAppendInputs(this);
+                return result;
+            };
+            updateAppendInputs(node);
+        }
+
         if (node.comfyClass === "CLIPTextEncodeFormatter" || node.comfyClass === "TextOnlyFormatter") {
             node.previousTextValue = findWidgetByName(node, "text")?.value || ""; 
 
             node.addWidget("button", "💫 Format Prompt", "", async () => {
                 const textWidget = findWidgetByName(node, "text");
                 node.previousTextValue = textWidget.value; 
-                const formattedPrompt = await handlePromptRequest("format_prompt", textWidget.value);
+                const formattedPrompt = await handleSegmentedFormat(node, textWidget.value);
                 textWidget.value = formattedPrompt;
             });
             
@@ -52,6 +233,14 @@ app.registerExtension({
                 const textWidget = findWidgetByName(node, "text");
                 textWidget.value = node.previousTextValue; 
             });
+
+            const liveToggle = node.addWidget("toggle", "👁️ Live Preview", false, (value) => setLivePreview(node, value));
+            liveToggle.serialize = false;
+            const onRemoved = node.onRemoved;
+            node.onRemoved = function (...args) {
+                setLivePreview(this, false);
+                return onRemoved?.apply(this, args);
+            };
         }
     },
 });
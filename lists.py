@@ -0,0 +1,63 @@
+from .app_config import get_config
+from .disk_cache import get_disk_cache, result_key
+from .prompt_formatter import format_prompt, convert_tags, format_cache, convert_cache
+
+# Formatting of whole prompt lists for the list nodes. Identical items are
+# formatted once, items already in the format caches (or the disk cache, in
+# one query) aren't formatted at all, and the rest is formatted in process.
+#
+# There are no worker processes: a worker forked from the ComfyUI server
+# inherits its threads' locks and can hang on them, and a spawned one imports
+# ComfyUI's main.py again. Most of a list's savings come from the coalescing
+# and the caches anyway.
+
+ACTIONS = {
+    "format_prompt": format_prompt,
+    "convert_tags": convert_tags,
+}
+
+"""
+Lists
+"""
+
+def cache_for(action: str, config):
+    # The cache and key function format_prompt / convert_tags use
+    if action == "format_prompt":
+        return format_cache, lambda text: (text, config.format_key)
+    return convert_cache, lambda text: (text, config.convert_key)
+
+def settings_key_for(action: str, config):
+    return config.format_key if action == "format_prompt" else config.convert_key
+
+def format_list(texts: list, action: str = "format_prompt", **overrides):
+    """
+    Formats every text of the list with format_prompt or convert_tags and
+    returns the results in the same order.
+    """
+    func = ACTIONS[action]
+    config = get_config(**overrides)
+    cache, cache_key = cache_for(action, config)
+
+    results = {}
+    pending = []
+    for text in dict.fromkeys(texts):
+        if (formatted := cache.get(cache_key(text))) is not None:
+            results[text] = formatted
+        else:
+            pending.append(text)
+
+    # Texts other processes formatted before, looked up in one query
+    disk_cache = get_disk_cache(config)
+    if pending and disk_cache is not None:
+        settings_key = settings_key_for(action, config)
+        keys = {text: result_key(action, text, settings_key) for text in pending}
+        found = disk_cache.get_many(list(keys.values()))
+        for text, key in keys.items():
+            if (formatted := found.get(key)) is not None:
+                results[text] = formatted
+                cache.put(cache_key(text), formatted)
+        pending = [text for text in pending if text not in results]
+
+    for text in pending:
+        results[text] = func(text, **overrides)
+    return [results[text] for text in texts]
@@ -0,0 +1,62 @@
+import asyncio
+
+# Live formatting for the editor. The client streams every edit of a text
+# widget with a sequence number that grows per editor, and only wants the
+# result of its newest edit back. A session queues at most one request per
+# editor: a newer edit replaces one still waiting, edits older than one already
+# received are ignored, and when an edit arrives while the previous one is being
+# formatted that result is dropped instead of sent (formatting runs on a worker
+# thread and can't be interrupted, but it only costs a few milliseconds).
+
+# Seconds a burst of edits may settle before the newest one is formatted
+LIVE_COALESCE_SECONDS = 0.05
+# Editors a session keeps sequence numbers of
+LIVE_MAX_EDITORS = 256
+
+class LiveSession:
+    """
+    The live formatting requests of one client. `process(request)` formats a
+    request and returns the response, `send(response)` delivers it. Requests
+    are dicts with at least an "id" (the editor) and a "seq".
+    """
+    def __init__(self, process, send, coalesce=LIVE_COALESCE_SECONDS):
+        self.process = process
+        self.send = send
+        self.coalesce = coalesce
+        self.pending = {}
+        self.latest = {}
+        self.wakeup = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+
+    def submit(self, request):
+        # Returns False if the request is older than one received before
+        key, seq = request["id"], request["seq"]
+        if key in self.latest and seq <= self.latest[key]:
+            return False
+        if key not in self.latest and len(self.latest) >= LIVE_MAX_EDITORS:
+            self.latest.pop(next(iter(self.latest)))
+        self.latest[key] = seq
+        if key in self.pending:
+            self.dropped += 1
+        self.pending[key] = request
+        self.wakeup.set()
+        return True
+
+    def is_stale(self, request):
+        return self.latest.get(request["id"]) != request["seq"]
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            if self.coalesce:
+                await asyncio.sleep(self.coalesce)
+            self.wakeup.clear()
+            requests, self.pending = self.pending, {}
+            for request in requests.values():
+                response = await self.process(request)
+                if self.is_stale(request):
+                    self.dropped += 1
+                    continue
+                self.sent += 1
+                await self.send({"id": request["id"], "seq": request["seq"], **response})
@@ -1,8 +1,77 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 from comfy.comfy_types import IO, ComfyNodeABC, InputTypeDict
 from server import PromptServer
-from aiohttp import web
+from aiohttp import web, WSMsgType
+
+from .app_config import get_config
+from .prompt_formatter import FormatTimeout, format_prompt, convert_tags, format_cache, convert_cache, stage_timings
+from .segments import format_lines
+from .conditioning import conditioning_cache, encode, encode_cached
+from .append import append_all, append_pair
+from .lists import format_list
+from .tag_index import check_tags
+from .live import LiveSession
+from .clip_tokens import count_chunks, get_counter
+from .wildcards import expand_formatted
+from .disk_cache import get_disk_cache
+
+ACTIONS = {
+    "format_prompt": format_prompt,
+    "convert_tags": convert_tags,
+}
+
+# Actions of CLIP Text Encode (Prompt Formatter, List), "none" only encodes
+ENCODE_LIST_ACTIONS = [*ACTIONS, "none"]
+
+# Inputs of the Append Strings node
+APPEND_MAX_INPUTS = 64
+
+# Limits for a single /prompt_formatter/format_batch request
+BATCH_MAX_ITEMS = 1000
+BATCH_MAX_CHARS = 2_000_000
+
+# Variants the Wildcards node can output
+WILDCARD_MAX_COUNT = 10000
+WILDCARD_MODES = ["enumerate", "sample"]
+
+# Formatting is CPU-bound, keep it off the event loop so the server stays responsive
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prompt_formatter")
+
+async def run_in_executor(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
+
+async def current_config(**options):
+    # get_config can reload settings.json and rebuild the tag dictionary index, so it runs off the event loop
+    return await run_in_executor(get_config, **options)
+
+async def check_options(options):
+    # Per-request overrides of the settings.json format options, returns an error message if invalid
+    if not isinstance(options, dict):
+        return "options must be an object"
+    try:
+        await current_config(**options)
+    except (KeyError, ValueError) as e:
+        return str(e)
+    return None
+
+def format_items(func, texts, options):
+    results = []
+    for text in texts:
+        if not isinstance(text, str):
+            results.append({"success": False, "error": "text must be a string"})
+            continue
+        try:
+            results.append({"success": True, "formatted_prompt": func(text, **options)})
+        except Exception as e:
+            results.append({"success": False, "error": f"{type(e).__name__}: {e}"})
+    return results
 
-from .prompt_formatter import format_prompt, convert_tags
+def is_line(line):
+    # A line of /prompt_formatter/format_segments, the id of a line sent before or {"text": ...}
+    return isinstance(line, str) or (isinstance(line, dict) and isinstance(line.get("text"), str))
 
 # Route to handle text requests
 @PromptServer.instance.routes.post("/prompt_formatter/format_prompt")
@@ -10,9 +79,16 @@ async def route_format_prompt(request):
     json_data = await request.json()
     result = {"success": False}
     
+    options = json_data.get("options", {})
+    if (error := await check_options(options)) is not None:
+        return web.json_response({"success": False, "error": error})
+
     if (text := json_data.get("text")) is not None:
         # Perform the text formatting
-        formatted_prompt = format_prompt(text)
+        try:
+            formatted_prompt = await run_in_executor(format_prompt, text, **options)
+        except FormatTimeout as e:
+            return web.json_response({"success": False, "error": str(e)}, status=503)
         result = {
             "success": True,
             "formatted_prompt": formatted_prompt
@@ -27,7 +103,10 @@ async def route_convert_tags(request):
     
     if (text := json_data.get("text")) is not None:
         # Perform the tag conversion
-        converted_prompt = convert_tags(text)
+        try:
+            converted_prompt = await run_in_executor(convert_tags, text)
+        except FormatTimeout as e:
+            return web.json_response({"success": False, "error": str(e)}, status=503)
         result = {
             "success": True,
             "formatted_prompt": converted_prompt
@@ -35,6 +114,197 @@ async def route_convert_tags(request):
     
     return web.json_response(result)
 
+@PromptServer.instance.routes.post("/prompt_formatter/format_batch")
+async def route_format_batch(request):
+    json_data = await request.json()
+    texts = json_data.get("texts")
+    action = json_data.get("action", "format_prompt")
+    options = json_data.get("options", {})
+
+    if not isinstance(texts, list) or action not in ACTIONS:
+        return web.json_response(
+            {"success": False, "error": f"expected a 'texts' list and an action out of {list(ACTIONS)}"},
+            status=400,
+        )
+    if (error := await check_options(options)) is not None:
+        return web.json_response({"success": False, "error": error}, status=400)
+    total_chars = sum(len(text) for text in texts if isinstance(text, str))
+    if len(texts) > BATCH_MAX_ITEMS or total_chars > BATCH_MAX_CHARS:
+        return web.json_response(
+            {"success": False, "error": f"batch exceeds {BATCH_MAX_ITEMS} items or {BATCH_MAX_CHARS} characters"},
+            status=413,
+        )
+
+    # Errors are reported per item, in the same order as the request
+    results = await run_in_executor(format_items, ACTIONS[action], texts, options)
+    return web.json_response({"success": True, "results": results})
+
+@PromptServer.instance.routes.post("/prompt_formatter/format_segments")
+async def route_format_segments(request):
+    json_data = await request.json()
+    lines = json_data.get("lines")
+    known = json_data.get("known", [])
+    options = json_data.get("options", {})
+
+    if not isinstance(lines, list) or not isinstance(known, list) or not all(map(is_line, lines)):
+        return web.json_response(
+            {"success": False, "error": "expected a 'lines' list of line ids or {'text': ...} objects"},
+            status=400,
+        )
+    if (error := await check_options(options)) is not None:
+        return web.json_response({"success": False, "error": error}, status=400)
+    total_chars = sum(len(line["text"]) for line in lines if isinstance(line, dict))
+    if total_chars > BATCH_MAX_CHARS:
+        return web.json_response({"success": False, "error": f"lines exceed {BATCH_MAX_CHARS} characters"}, status=413)
+
+    # Unknown line ids come back as "missing", the client then resends their text
+    known = {line_id for line_id in known if isinstance(line_id, str)}
+    try:
+        result = await run_in_executor(format_lines, lines, known, **options)
+    except FormatTimeout as e:
+        return web.json_response({"success": False, "error": str(e)}, status=503)
+    return web.json_response(result)
+
+@PromptServer.instance.routes.post("/prompt_formatter/check_tags")
+async def route_check_tags(request):
+    json_data = await request.json()
+    text = json_data.get("text")
+
+    if not isinstance(text, str):
+        return web.json_response({"success": False, "error": "expected a 'text' string"}, status=400)
+    if len(text) > BATCH_MAX_CHARS:
+        return web.json_response({"success": False, "error": f"text exceeds {BATCH_MAX_CHARS} characters"}, status=413)
+
+    result = await run_in_executor(check_tags, text, await current_config())
+    if result is None:
+        return web.json_response({"success": False, "error": "no TAG_DICTIONARY configured"}, status=404)
+    return web.json_response({"success": True, **result})
+
+@PromptServer.instance.routes.post("/prompt_formatter/expand")
+async def route_expand(request):
+    json_data = await request.json()
+    text = json_data.get("text")
+    count = json_data.get("count", 1)
+    seed = json_data.get("seed", 0)
+    offset = json_data.get("offset", 0)
+    action = json_data.get("action", "format_prompt")
+    mode = json_data.get("mode", "enumerate")
+    options = json_data.get("options", {})
+
+    if not isinstance(text, str) or any(type(value) is not int or value < 0 for value in (count, seed, offset)):
+        return web.json_response(
+            {"success": False, "error": "expected a 'text' string and non-negative 'count', 'seed' and 'offset' integers"},
+            status=400,
+        )
+    if action not in ENCODE_LIST_ACTIONS or mode not in WILDCARD_MODES:
+        return web.json_response(
+            {"success": False, "error": f"action must be one of {ENCODE_LIST_ACTIONS} and mode one of {WILDCARD_MODES}"},
+            status=400,
+        )
+    if (error := await check_options(options)) is not None:
+        return web.json_response({"success": False, "error": error}, status=400)
+    if count > BATCH_MAX_ITEMS or len(text) > BATCH_MAX_CHARS:
+        return web.json_response(
+            {"success": False, "error": f"request exceeds {BATCH_MAX_ITEMS} variants or {BATCH_MAX_CHARS} characters"},
+            status=413,
+        )
+
+    try:
+        total, results = await run_in_executor(
+            expand_formatted, text, count, action, mode, seed, offset, max_chars=BATCH_MAX_CHARS, **options
+        )
+    except FormatTimeout as e:
+        return web.json_response({"success": False, "error": str(e)}, status=503)
+    except ValueError as e:
+        return web.json_response({"success": False, "error": str(e)}, status=413)
+    # total can exceed what JSON numbers hold exactly
+    return web.json_response({"success": True, "total": str(total), "results": results})
+
+@PromptServer.instance.routes.post("/prompt_formatter/token_counts")
+async def route_token_counts(request):
+    json_data = await request.json()
+    text = json_data.get("text")
+
+    if not isinstance(text, str):
+        return web.json_response({"success": False, "error": "expected a 'text' string"}, status=400)
+    if len(text) > BATCH_MAX_CHARS:
+        return web.json_response({"success": False, "error": f"text exceeds {BATCH_MAX_CHARS} characters"}, status=413)
+
+    # The chunks between the BREAKs of the text as sent, with their CLIP token counts
+    chunks = await run_in_executor(count_chunks, text)
+    return web.json_response({"success": True, "exact": get_counter().exact, "chunks": chunks})
+
+async def parse_live_request(data):
+    # A message of /prompt_formatter/live, returns an error message if invalid
+    if not isinstance(data, dict) or not isinstance(data.get("id"), str) or type(data.get("seq")) is not int:
+        return "expected an object with an 'id' string and a 'seq' integer"
+    if data.setdefault("action", "format_prompt") not in ACTIONS:
+        return f"action must be one of {list(ACTIONS)}"
+    if not isinstance(data.get("text"), str):
+        return "expected a 'text' string"
+    if len(data["text"]) > BATCH_MAX_CHARS:
+        return f"text exceeds {BATCH_MAX_CHARS} characters"
+    return await check_options(data.setdefault("options", {}))
+
+async def format_live(request):
+    try:
+        formatted_prompt = await run_in_executor(ACTIONS[request["action"]], request["text"], **request["options"])
+    except Exception as e:
+        return {"success": False, "error": f"{type(e).__name__}: {e}"}
+    return {"success": True, "formatted_prompt": formatted_prompt}
+
+# Live formatting while typing, see live.py. Each message is
+# {"id": editor, "seq": n, "action": ..., "text": ..., "options": {...}},
+# only the result of the newest seq of an editor is sent back.
+@PromptServer.instance.routes.get("/prompt_formatter/live")
+async def route_live(request):
+    ws = web.WebSocketResponse(heartbeat=30, max_msg_size=4 * BATCH_MAX_CHARS)
+    await ws.prepare(request)
+
+    session = LiveSession(format_live, ws.send_json)
+    worker = asyncio.create_task(session.run())
+    try:
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            try:
+                data = message.json()
+            except ValueError:
+                data = None
+            if (error := await parse_live_request(data)) is not None:
+                data = data if isinstance(data, dict) else {}
+                await ws.send_json({"id": data.get("id"), "seq": data.get("seq"), "success": False, "error": error})
+                continue
+            session.submit(data)
+    finally:
+        worker.cancel()
+    return ws
+
+@PromptServer.instance.routes.get("/prompt_formatter/cache")
+async def route_cache_stats(request):
+    # Counting the disk cache's entries reads the database, off the event loop
+    disk_cache = get_disk_cache(await current_config())
+    return web.json_response({
+        "success": True,
+        "format_prompt": format_cache.stats(),
+        "convert_tags": convert_cache.stats(),
+        "conditioning": conditioning_cache.stats(),
+        "disk": await run_in_executor(disk_cache.stats) if disk_cache is not None else None,
+    })
+
+@PromptServer.instance.routes.get("/prompt_formatter/stats")
+async def route_stage_stats(request):
+    return web.json_response({
+        "success": True,
+        "enabled": (await current_config()).STAGE_TIMING,
+        "stages": stage_timings.stats(),
+    })
+
+@PromptServer.instance.routes.delete("/prompt_formatter/stats")
+async def route_reset_stage_stats(request):
+    stage_timings.clear()
+    return web.json_response({"success": True})
+
 # Nodes
 class CLIPTextEncodeFormatter(ComfyNodeABC):
     @classmethod
@@ -42,7 +312,10 @@ class CLIPTextEncodeFormatter(ComfyNodeABC):
         return {
             "required": {
                 "text": (IO.STRING, {"multiline": True, "dynamicPrompts": True, "tooltip": "The text to be encoded."}),
-                "clip": (IO.CLIP, {"tooltip": "The CLIP model used for encoding the text."})
+                "clip": (IO.CLIP, {"tooltip": "The CLIP model used for encoding the text."}),
+            },
+            "optional": {
+                "cache": (IO.BOOLEAN, {"default": False, "tooltip": "Reuse the conditioning when the same text was already encoded by this CLIP. Memory is limited by CONDITIONING_CACHE_MB in settings.json."}),
             }
         }
     RETURN_TYPES = (IO.CONDITIONING,)
@@ -52,12 +325,46 @@ class CLIPTextEncodeFormatter(ComfyNodeABC):
     CATEGORY = "prompt_formatter"
     DESCRIPTION = "Encodes a text prompt using a CLIP model into an embedding that can be used to guide the diffusion model towards generating specific images."
 
-    def encode(self, clip, text):
+    def encode(self, clip, text, cache=False):
         if clip is None:
             raise RuntimeError("ERROR: clip input is invalid: None\n\nIf the clip is from a checkpoint loader node your checkpoint does not contain a valid clip or text encoder model.")
-        tokens = clip.tokenize(text)
-        return (clip.encode_from_tokens_scheduled(tokens), )
+        return (encode_cached(clip, text) if cache else encode(clip, text), )
     
+class CLIPTextEncodeListFormatter(ComfyNodeABC):
+    @classmethod
+    def INPUT_TYPES(s) -> InputTypeDict:
+        return {
+            "required": {
+                "text": (IO.STRING, {"forceInput": True, "tooltip": "The list of text prompts to be encoded."}),
+                "clip": (IO.CLIP, {"tooltip": "The CLIP model used for encoding the text."}),
+                "action": (ENCODE_LIST_ACTIONS, {"default": "format_prompt", "tooltip": "Applied to every prompt before encoding."}),
+            },
+            "optional": {
+                "cache": (IO.BOOLEAN, {"default": False, "tooltip": "Reuse the conditioning when the same text was already encoded by this CLIP. Memory is limited by CONDITIONING_CACHE_MB in settings.json."}),
+            }
+        }
+    INPUT_IS_LIST = True
+    RETURN_TYPES = (IO.CONDITIONING,)
+    OUTPUT_IS_LIST = (True,)
+    OUTPUT_TOOLTIPS = ("A list of conditionings, one per prompt, in the same order.",)
+    FUNCTION = "encode"
+
+    CATEGORY = "prompt_formatter"
+    DESCRIPTION = "Formats and encodes a whole list of prompts in one run. Identical prompts are formatted and encoded once."
+
+    def encode(self, text, clip, action, cache=(False,)):
+        clip, action, cache = clip[0], action[0], cache[0]
+        if clip is None:
+            raise RuntimeError("ERROR: clip input is invalid: None\n\nIf the clip is from a checkpoint loader node your checkpoint does not contain a valid clip or text encoder model.")
+        if action != "none":
+            text = format_list(text, action)
+
+        # ComfyUI's CLIP encodes one prompt per call, so identical prompts are what can be shared
+        conditionings = {}
+        for prompt in dict.fromkeys(text):
+            conditionings[prompt] = encode_cached(clip, prompt) if cache else encode(clip, prompt)
+        return ([conditionings[prompt] for prompt in text], )
+
 class TextOnlyFormatter:
     @classmethod
     def INPUT_TYPES(s):
@@ -81,6 +388,52 @@ class TextOnlyFormatter:
     def passthrough(self, text):
         return (text,)
 
+class TextListFormatter:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "text": (IO.STRING, {"forceInput": True, "tooltip": "The list of text prompts to format."}),
+                "action": (list(ACTIONS), {"default": "format_prompt", "tooltip": "Applied to every prompt."}),
+            }
+        }
+
+    INPUT_IS_LIST = True
+    RETURN_TYPES = (IO.STRING,)
+    OUTPUT_IS_LIST = (True,)
+    OUTPUT_TOOLTIPS = ("The formatted prompts, in the same order.",)
+    FUNCTION = "format"
+
+    CATEGORY = "prompt_formatter"
+    DESCRIPTION = "Formats a whole list of prompts in one run. Identical prompts are formatted once."
+
+    def format(self, text, action):
+        return (format_list(text, action[0]),)
+
+class TextWildcardFormatter:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "text": (IO.STRING, {"multiline": True, "dynamicPrompts": False, "tooltip": "A template with {a|b|c} choices, expanded here instead of by the frontend."}),
+                "action": (ENCODE_LIST_ACTIONS, {"default": "format_prompt", "tooltip": "Applied to every variant."}),
+                "mode": (WILDCARD_MODES, {"default": "enumerate", "tooltip": "enumerate: the first variants in order. sample: random variants without repeats, chosen by the seed."}),
+                "count": (IO.INT, {"default": 8, "min": 1, "max": WILDCARD_MAX_COUNT, "tooltip": "Number of variants to output, at most the number the template has."}),
+                "seed": (IO.INT, {"default": 0, "min": 0, "max": 0xffffffffffffffff, "tooltip": "Seed of the sample."}),
+            }
+        }
+
+    RETURN_TYPES = (IO.STRING,)
+    OUTPUT_IS_LIST = (True,)
+    OUTPUT_TOOLTIPS = ("The variants, formatted.",)
+    FUNCTION = "expand"
+
+    CATEGORY = "prompt_formatter"
+    DESCRIPTION = "Expands a {a|b} wildcard template into a list of variants without building every combination, and formats them sharing the work on their common lines."
+
+    def expand(self, text, action, mode, count, seed):
+        return (expand_formatted(text, count, action, mode, seed)[1],)
+
 class TextAppendFormatter:
     @classmethod
     def INPUT_TYPES(s):
@@ -89,41 +442,44 @@ class TextAppendFormatter:
                 "string1": ("STRING", {"default": "", "forceInput": True, "tooltip": "First string."}),
                 "string2": ("STRING", {"default": "", "forceInput": True, "tooltip": "String to append."}),
                 "comma": ("BOOLEAN", {"default": True, "tooltip": "Add comma between strings."}),
-                "dedupe": ("BOOLEAN", {"default": True, "tooltip": "Prevents appending tokens from string2 if they already exist in string1."}),
+                "dedupe": ("BOOLEAN", {"default": True, "tooltip": "Prevents appending tokens from string2 if they already exist in string1. Tags are compared as set by DEDUPE_POLICY in settings.json."}),
             }
         }
 
-    RETURN_TYPES = ("STRING",)
+    RETURN_TYPES = ("STRING", "STRING")
+    RETURN_NAMES = ("STRING", "removed")
+    OUTPUT_TOOLTIPS = ("The combined string.", "Tokens of string2 left out as duplicates, comma-separated.")
     FUNCTION = "combine"
     CATEGORY = "prompt_formatter"
     DESCRIPTION = "Appends two strings together cleanly, removing unnecessary commas, spaces, or other artifacts."
 
     def combine(self, string1, string2, comma, dedupe):
-        appendstr = string2
-
-        # Dedupe string2 tokens
-        if dedupe and string1 and string2:
-            set1 = {token.strip() for token in string1.split(',') if token.strip()}
-            set2 = string2.split(',')
-            filtered_tokens = []
-            for token in set2:
-                if token.strip() not in set1:
-                    filtered_tokens.append(token)
-
-            appendstr = ",".join(filtered_tokens)
+        combined, removed = append_pair(string1, string2, comma, dedupe, get_config().DEDUPE_POLICY)
+        return (combined, ", ".join(removed))
 
-        if not appendstr.strip(' ,'):
-            return (string1,)
-
-        s1_rstrip = string1.rstrip(' ,')
-        s2_lstrip = appendstr.lstrip(' ,')
-
-        # Empty string handling
-        if not s1_rstrip:
-             return (s2_lstrip,)
-        if not s2_lstrip:
-             return (string1,)
+class TextAppendManyFormatter:
+    @classmethod
+    def INPUT_TYPES(s):
+        # Inputs past the first unconnected one are hidden by the frontend and added as links are made
+        return {
+            "required": {
+                "comma": ("BOOLEAN", {"default": True, "tooltip": "Add comma between strings."}),
+                "dedupe": ("BOOLEAN", {"default": True, "tooltip": "Prevents appending tokens that already exist in the strings before them. Tags are compared as set by DEDUPE_POLICY in settings.json."}),
+            },
+            "optional": {
+                f"string{i}": ("STRING", {"default": "", "forceInput": True, "tooltip": f"String {i}, appended after the ones before it."})
+                for i in range(1, APPEND_MAX_INPUTS + 1)
+            }
+        }
 
-        combined = f"{s1_rstrip}{', ' if comma else ' '}{s2_lstrip}"
+    RETURN_TYPES = ("STRING", "STRING")
+    RETURN_NAMES = ("STRING", "removed")
+    OUTPUT_TOOLTIPS = ("The combined string.", "Tokens left out as duplicates, comma-separated.")
+    FUNCTION = "combine"
+    CATEGORY = "prompt_formatter"
+    DESCRIPTION = "Appends any number of strings in one pass, with the same result as chaining Append String nodes."
 
-        return (combined,)
+    def combine(self, comma, dedupe, **strings):
+        fragments = [strings[f"string{i}"] for i in range(1, APPEND_MAX_INPUTS + 1) if strings.get(f"string{i}") is not None]
+        combined, removed = append_all(fragments, comma, dedupe, get_config().DEDUPE_POLICY)
+        return (combined, ", ".join(removed))
@@ -1,20 +1,49 @@
 import re
+import time
+from bisect import bisect_left
 import unicodedata
 
-from .app_config import BRACKET2WEIGHT, COLLAPSE_LINEBREAKS, CONV_SPACE_UNDERSCORE, BLACKLISTED_TAGS
+from .app_config import DEFAULT_CONFIG, get_config
+from .cache import LazyPattern, LRUCache
+from .dedupe import TagDeduper
+from .stats import StageTimings
+from .tag_index import resolve_aliases, dictionary_tags
+from .clip_tokens import chunk_prompt
+from .disk_cache import disk_get, disk_put
+from .weights import has_weight, remove_weight_one, weight_blocks, weight_suffix
 
 # Bracket handling
 brackets_opening = set("([{")
 brackets_closing = set(")]}")
 bracket_pairs = dict(zip("([{", ")]}"))
 bracket_pairs_reverse = dict(zip(")]}", "([{"))
-bracket_pattern = r'(?<!\\)(?:\([^)]*\)|\[[^\]]*\])(?=(?:\s*(?:,|BREAK|<[^>]+>)|\s*$))'
 
-# Regular expression patterns
-re_break = re.compile(r"\s*BREAK\s*")
-re_angle_bracket = re.compile(r"<[^>]+>")
-re_brackets = re.compile(r'([([{<])|([)\]}>])')
-re_brackets_open = re.compile(r"(?<!\\)(\(+|\[+)")
+# Regular expression patterns. The HTTP routes format any text they're sent,
+# so every stage has to run in linear time: no pattern may rescan the same
+# text from many start positions (see strip_around, angle_blocks, dedupe_parts).
+re_angle_bracket = LazyPattern(r"<[^>]+>")
+re_brackets = LazyPattern(r'([([{<])|([)\]}>])')
+re_bracket_gap = LazyPattern(r"([)\]}>])([([{<])")
+re_weight_marks = LazyPattern(r"[()\[\]{}:|]")
+re_comma_angle = LazyPattern(r',\s*(<)')
+# Only tried from the start of a run of spaces and commas (or right after the previous BREAK)
+re_newline_break = LazyPattern(r"(?:(?<![^\n])|(?<=BREAK)|(?![\s,]))([^\n])(?:[^\S\n]|,)*\n[\s,]*BREAK")
+re_break_newline = LazyPattern(r"BREAK[\s,]*\n[\s,]*")
+re_space_run = LazyPattern(r" +")
+re_lone_underscore = LazyPattern(r"(?<!_)_(?!_)")
+re_angle_mark = LazyPattern(r"[<>]")
+
+# Deduplication splits lines on separators and bracket groups, see dedupe_parts
+re_dedupe_event = LazyPattern(r"[,(\[<]|BREAK")
+re_whitespace = LazyPattern(r"\s*")
+closer_patterns = {closer: LazyPattern(re.escape(closer)) for closer in ")]>"}
+
+# Results of format_prompt and convert_tags, keyed by text and the settings they depend on
+format_cache = LRUCache(DEFAULT_CONFIG["CACHE_SIZE"])
+convert_cache = LRUCache(DEFAULT_CONFIG["CACHE_SIZE"])
+
+# Per-stage timings, only recorded while STAGE_TIMING is enabled
+stage_timings = StageTimings()
 
 """
 Functions
@@ -26,22 +55,28 @@ def get_bracket_opening(c: str):
 def normalize_characters(data: str):
     return unicodedata.normalize("NFKC", data)
 
-def remove_whitespace_excessive(prompt: str):
+def remove_whitespace_excessive(prompt: str, config):
     lines = prompt.split("\n")
-    cleaned_lines = [" ".join(line.split()).strip() for line in lines if not COLLAPSE_LINEBREAKS or line.strip()]
+    cleaned_lines = [" ".join(line.split()).strip() for line in lines if not config.COLLAPSE_LINEBREAKS or line.strip()]
     return "\n".join(cleaned_lines)
 
 def align_brackets(prompt: str):
     return re_brackets.sub(lambda m: m.group(1) or m.group(2), prompt)
 
-def space_and(prompt: str):
-    def helper(match: re.Match):
-        return " ".join(match.groups())
+def strip_around(prompt: str, separator: str, replacement: str):
+    # Same as re.sub(rf"\s*{separator}\s*", replacement, prompt), which would
+    # rescan every whitespace run from each of its characters
+    if separator not in prompt:
+        return prompt
+    parts = prompt.split(separator)
+    inner = [part.strip() for part in parts[1:-1]]
+    return replacement.join([parts[0].rstrip(), *inner, parts[-1].lstrip()])
 
-    return re.sub(r"(.*?)\s*(AND)\s*(.*?)", helper, prompt)
+def space_and(prompt: str):
+    return strip_around(prompt, "AND", " AND ")
 
-def align_commas(prompt: str):
-    if COLLAPSE_LINEBREAKS:
+def align_commas(prompt: str, config):
+    if config.COLLAPSE_LINEBREAKS:
         if "BREAK" in prompt:
             parts = prompt.split("BREAK")
             n = len(parts)
@@ -53,8 +88,8 @@ def align_commas(prompt: str):
                 else:
                     parts[i] = parts[i].strip(" ,")
             prompt = " BREAK ".join(parts).strip()
-            prompt = re.sub(r"([^\n])[\s,]*\n[\s,]*BREAK", lambda m: f"{m.group(1)}\nBREAK", prompt)
-            prompt = re.sub(r"BREAK[\s,]*\n[\s,]*", "BREAK\n", prompt)
+            prompt = re_newline_break.sub(lambda m: f"{m.group(1)}\nBREAK", prompt)
+            prompt = re_break_newline.sub("BREAK\n", prompt)
         segments = [seg.strip() for seg in prompt.split(',') if seg.strip()]
         return ", ".join(segments)
     lines = prompt.splitlines()
@@ -92,269 +127,391 @@ def remove_mismatched_brackets(prompt: str):
 
     return "".join(result)
 
+def angle_blocks(prompt: str):
+    # re_angle_bracket.finditer(prompt), but a "<" after the last ">" isn't searched
+    # from, every one of them would scan to the end of the prompt
+    return re_angle_bracket.finditer(prompt, 0, prompt.rfind(">") + 1)
+
 def space_brackets(prompt: str):
     def helper(match: re.Match):
         return " ".join(match.groups())
 
-    parts = re.split(r'(<[^>]+>)', prompt)
+    parts = []
+    previous_position = 0
+    for match in angle_blocks(prompt):
+        parts.append(prompt[previous_position:match.start()])
+        parts.append(match.group())
+        previous_position = match.end()
+    parts.append(prompt[previous_position:])
     for i in range(len(parts)):
         if not parts[i].startswith('<'):
-            parts[i] = re.sub(r"([)\]}>])([([{<])", helper, parts[i])
+            parts[i] = re_bracket_gap.sub(helper, parts[i])
 
     return ''.join(parts)
 
 def align_alternating(prompt: str):
-    return re.sub(r"\s*(\|)\s*", lambda match: match.group(1), prompt)
+    return strip_around(prompt, "|", "|")
 
-def bracket_to_weights(prompt: str):
-    if not BRACKET2WEIGHT:
+def bracket_to_weights(prompt: str, config):
+    if not config.BRACKET2WEIGHT:
         return prompt
-    
-    # Identify regions enclosed within angle brackets
-    excluded_regions = []
-    for match in re_angle_bracket.finditer(prompt):
-        excluded_regions.append((match.start(), match.end()))
-
-    # Split the prompt into sections that are not within angle brackets
-    segments = []
+
+    # Process the sections that are not within angle brackets separately
+    pieces = []
     previous_position = 0
-    for start, end in excluded_regions:
-        segments.append(prompt[previous_position:start])
-        previous_position = end
-    segments.append(prompt[previous_position:])
-
-    # Process each segment separately
-    updated_segments = []
-    for segment in segments:
-        depths, gradients, brackets = get_mappings(segment)
-        pos = 0
-        ret = segment
-
-        while pos < len(ret):
-            if ret[pos] in brackets_opening:
-                open_bracketing = re_brackets_open.match(ret, pos)
-                if open_bracketing:
-                    consecutive = len(open_bracketing.group(0))
-                    gradient_search = "".join(
-                        map(
-                            str,
-                            reversed(
-                                range(
-                                    int(depths[pos]) - 1,
-                                    int(depths[pos]) + consecutive
-                                ),
-                            )
-                        )
-                    )
-                    is_square_brackets = "[" in open_bracketing.group(0)
-
-                    insert_at, weight, valid_consecutive = get_weight(
-                        ret,
-                        gradients,
-                        depths,
-                        brackets,
-                        open_bracketing.end(),
-                        consecutive,
-                        gradient_search,
-                        is_square_brackets,
-                    )
-
-                    if weight:
-                        # If weight already exists, ignore
-                        current_weight = re.search(
-                            r"(?<=:)(\d+.?\d*|\d*.?\d+)(?=[)\]]$)",
-                            ret[:insert_at + 1]
-                        )
-                        if current_weight:
-                            ret = (
-                                ret[:open_bracketing.start()]
-                                + "("
-                                + ret[
-                                    open_bracketing.start() + valid_consecutive : insert_at
-                                ]
-                                + ")"
-                                + ret[insert_at + consecutive :]
-                            )
-                        else:
-                            ret = (
-                                ret[:open_bracketing.start()]
-                                + "("
-                                + ret[
-                                    open_bracketing.start() + valid_consecutive : insert_at
-                                ]
-                                + f":{weight:.2f}".rstrip("0").rstrip(".")
-                                + ")"
-                                + ret[insert_at + consecutive :]
-                            )
-
-                    depths, gradients, brackets = get_mappings(ret)
-                    pos += 1
-
-            match = re.search(r"(?<!\\)[([]", ret[pos:])
-
-            if not match:  # no more potential weight brackets to parse
-                break
-
-            pos += match.start()
-        updated_segments.append(ret)
-
-    # Reassemble the final prompt with the excluded regions
-    final_prompt = ""
-    for i, segment in enumerate(updated_segments):
-        final_prompt += segment
-        if i < len(excluded_regions):
-            final_prompt += prompt[excluded_regions[i][0]:excluded_regions[i][1]]
+    for match in angle_blocks(prompt):
+        pieces.append(weight_segment(prompt[previous_position:match.start()]))
+        pieces.append(match.group())
+        previous_position = match.end()
+    pieces.append(weight_segment(prompt[previous_position:]))
+    final_prompt = "".join(pieces)
 
     # Remove round brackets with weight 1
-    final_prompt = re.sub(r'(?<!\\)\(([^:]+):1(?:\.0*)?\)', r'\1', final_prompt)
+    final_prompt = remove_weight_one(final_prompt)
 
     return final_prompt
 
-def depth_and_gradient(s: str):
-    depth = 0
-    depth_map = []
-    gradient = []
-    for c in s:
-        if c in brackets_opening:
-            depth += 1
-            gradient.append('^')
-        elif c in brackets_closing:
-            depth -= 1
-            gradient.append('v')
+def weight_segment(segment: str):
+    marks = [
+        (m.start(), m.group(), m.start() > 0 and segment[m.start() - 1] == "\\")
+        for m in re_weight_marks.finditer(segment)
+    ]
+    blocks = weight_blocks(marks)
+    if not blocks:
+        return segment
+
+    def chars_before(i):
+        for j in range(i - 1, -1, -1):
+            yield segment[j]
+
+    # Collect every replacement first, then rebuild the segment once
+    replacements = {}
+    for openers, closers, is_square_brackets in blocks:
+        if has_weight(chars_before(closers[0])):
+            replacements[closers[0]] = ")"
         else:
-            gradient.append('-')
-        depth_map.append(str(depth))
-    return ''.join(depth_map), ''.join(gradient)
-
-def get_mappings(s: str):
-    depth_map, gradient = depth_and_gradient(s)
-    brackets = ''.join(c if c in "[]()<>" else " " for c in s)
-    return depth_map, gradient, brackets
-
-def calculate_weight(d: str, is_square_brackets: bool):
-    return 1 / 1.1 ** int(d) if is_square_brackets else 1 * 1.1 ** int(d)
-
-def get_weight(
-    prompt: str,
-    map_gradient: list,
-    map_depth: list,
-    map_brackets: list,
-    pos: int,
-    ctv: int,
-    gradient_search: str,
-    is_square_brackets: bool = False,
-):
-    """Returns 0 if bracket was recognized as prompt editing, alternation, or composable."""
-    # CURRENTLY DOES NOT TAKE INTO ACCOUNT COMPOSABLE?? DO WE EVEN NEED TO?
-    # E.G. [a AND B :1.2] == (a AND B:1.1) != (a AND B:1.1) ????
-    while pos + ctv <= len(prompt):
-        if ctv == 0:
-            return prompt, 0, 1
-        a, b = pos, pos + ctv
-        if prompt[a] in ":|" and is_square_brackets:
-            if map_depth[-2] == map_depth[a]:
-                return prompt, 0, 1
-            if map_depth[a] in gradient_search:
-                gradient_search = gradient_search.replace(map_depth[a], "")
-                ctv -= 1
-        elif map_gradient[a:b] == "v" * ctv and map_depth[a - 1 : b] == gradient_search:
-            return a, calculate_weight(ctv, is_square_brackets), ctv
-        elif "v" == map_gradient[a] and map_depth[a - 1 : b - 1] in gradient_search:
-            narrowing = map_gradient[a:b].count("v")
-            gradient_search = gradient_search[narrowing:]
-            ctv -= 1
-        pos += 1
-
-    msg = f"Somehow weight index searching has gone outside of prompt length with prompt: {prompt}"
-    raise Exception(msg)
-
-def space_to_underscore(prompt: str):
-    if CONV_SPACE_UNDERSCORE == "None":
+            replacements[closers[0]] = weight_suffix(len(openers), is_square_brackets) + ")"
+        replacements[openers[0]] = "("
+        for pos in openers[1:] + closers[1:]:
+            replacements[pos] = ""
+
+    pieces = []
+    previous_position = 0
+    for pos in sorted(replacements):
+        pieces.append(segment[previous_position:pos])
+        pieces.append(replacements[pos])
+        previous_position = pos + 1
+    pieces.append(segment[previous_position:])
+    return "".join(pieces)
+
+def space_to_underscore(prompt: str, config):
+    if config.CONV_SPACE_UNDERSCORE == "None":
         return prompt
-    elif CONV_SPACE_UNDERSCORE == "Spaces to underscores":
-        match = re.compile(r"(?<!BREAK) +(?!BREAK|[^<]*>)")
-        replace = "_"
-    elif CONV_SPACE_UNDERSCORE == "Underscores to spaces":
-        match = re.compile(r"(?<!BREAK|_)_(?!_|BREAK|[^<]*>)")
-        replace = " "
+    elif config.CONV_SPACE_UNDERSCORE == "Spaces to underscores":
+        convert = spaces_to_underscores
+    elif config.CONV_SPACE_UNDERSCORE == "Underscores to spaces":
+        convert = underscores_to_spaces
 
     tokens = [t.strip() for t in prompt.split(",")]
-    tokens = [re.sub(match, replace, t) for t in tokens]
+    tokens = [convert(t) for t in tokens]
 
     return ",".join(tokens)
 
-def dedupe_tokens(prompt: str):
-    # Define separators and dedupe pattern
-    separators = [',', re_break.pattern, r'<[^>]+>']
-    dedupe_pattern = re.compile(f'({bracket_pattern}|(?:{"|".join(separators)}))')
-    
-    lines = prompt.splitlines()
-    processed_lines = []
-    seen = set()
-    
-    for line in lines:
-        # If no separator is found, leave the line unchanged.
-        if not re.search(f'(?:{"|".join(separators)})', line):
-            processed_lines.append(line)
+def inside_angle(text: str):
+    # Tells, for positions asked in increasing order, whether the next "<" or ">"
+    # is a ">". Same as the lookahead [^<]*> without rescanning the text every time.
+    marks = [(match.start(), match.group()) for match in re_angle_mark.finditer(text)]
+    index = 0
+
+    def check(position: int):
+        nonlocal index
+        while index < len(marks) and marks[index][0] < position:
+            index += 1
+        return index < len(marks) and marks[index][1] == ">"
+
+    return check
+
+def spaces_to_underscores(token: str):
+    # Replaces r"(?<!BREAK) +(?!BREAK|[^<]*>)" with "_"
+    if "BREAK" not in token and ">" not in token:
+        return re_space_run.sub("_", token)
+    inside = inside_angle(token)
+
+    def helper(match: re.Match):
+        start, end = match.span()
+        if inside(end):
+            return match.group()
+        # Right after BREAK the run is matched from its second space, right before it up to its last one
+        skip = token.endswith("BREAK", 0, start)
+        keep = token.startswith("BREAK", end)
+        if end - start - skip - keep <= 0:
+            return match.group()
+        return " " * skip + "_" + " " * keep
+
+    return re_space_run.sub(helper, token)
+
+def underscores_to_spaces(token: str):
+    # Replaces r"(?<!BREAK)(?<!_)_(?!_|BREAK|[^<]*>)" with " "
+    if "BREAK" not in token and ">" not in token:
+        return re_lone_underscore.sub(" ", token)
+    inside = inside_angle(token)
+
+    def helper(match: re.Match):
+        start = match.start()
+        if token.endswith("BREAK", 0, start) or token.startswith("BREAK", start + 1) or inside(start):
+            return "_"
+        return " "
+
+    return re_lone_underscore.sub(helper, token)
+
+def dedupe_parts(line: str):
+    """
+    Yields (start, end, is_group) for the separators (",", BREAK with the
+    whitespace around it, angle blocks) and bracket groups of a line. A bracket
+    group runs to the first closer after its opening bracket and is only one
+    when a separator or the end of the line follows it.
+
+    These are the matches of the pattern
+    (?<!\\)(?:\([^)]*\)|\[[^\]]*\])(?=\s*(?:,|BREAK|<[^>]+>)|\s*$)|,|\s*BREAK\s*|<[^>]+>
+    found in linear time: the closer positions are looked up instead of
+    searched again from every opening bracket.
+    """
+    positions = {}
+    follows = {}
+
+    def next_closer(closer: str, start: int):
+        if closer not in positions:
+            positions[closer] = [match.start() for match in closer_patterns[closer].finditer(line)]
+        found = positions[closer]
+        i = bisect_left(found, start)
+        return found[i] if i < len(found) else -1
+
+    def separator_follows(start: int):
+        if start not in follows:
+            i = re_whitespace.match(line, start).end()
+            follows[start] = (
+                i == len(line) or line[i] == "," or line.startswith("BREAK", i)
+                or (line[i] == "<" and next_closer(">", i + 1) > i + 1)
+            )
+        return follows[start]
+
+    position = 0
+    for match in re_dedupe_event.finditer(line):
+        start = match.start()
+        if start < position:
             continue
-        
-        # Split the line while preserving tokens.
-        parts = [p for p in dedupe_pattern.split(line) if p is not None]
-        result = []
-        
-        for part in parts:
-            normalized = part.strip()
-            if not normalized:
+        event = match.group()
+        if event == ",":
+            end = start + 1
+        elif event == "BREAK":
+            # The whitespace before BREAK belongs to it
+            while start > position and line[start - 1].isspace():
+                start -= 1
+            end = re_whitespace.match(line, match.end()).end()
+        elif event == "<":
+            if (end := next_closer(">", start + 1) + 1) <= start + 2:
+                continue
+        else:
+            if start and line[start - 1] == "\\":
+                continue
+            closer = next_closer(")" if event == "(" else "]", start + 1)
+            if closer == -1 or not separator_follows(closer + 1):
                 continue
+            yield start, closer + 1, True
+            position = closer + 1
+            continue
+        yield start, end, False
+        position = end
+
+def dedupe_tokens(prompt: str, config):
+    return dedupe_report(prompt, config.DEDUPE_POLICY)[0]
+
+def dedupe_line_parts(line: str, deduper: TagDeduper):
+    """
+    Splits a line the way dedupe_report offers it: a list of (text, tag, key)
+    with tag and key None for the separators, or None for a line without
+    separators, which is left unchanged. Empty tags are left out.
+    """
+    if "," not in line and "BREAK" not in line and next(angle_blocks(line), None) is None:
+        return None
+
+    parts = []
+
+    def add_tag(part: str):
+        if normalized := part.strip():
+            parts.append((part, normalized, deduper.key(normalized)))
+
+    # Tags sit between separators, bracket groups are tags of their own
+    position = 0
+    for part_start, part_end, is_group in dedupe_parts(line):
+        add_tag(line[position:part_start])
+        if is_group:
+            add_tag(line[part_start:part_end])
+        else:
+            parts.append((f" {line[part_start:part_end].strip()} ", None, None))
+        position = part_end
+    add_tag(line[position:])
+    return parts
+
+def dedupe_report(prompt: str, policy: str = "Exact", deduper: TagDeduper = None, line_parts=dedupe_line_parts):
+    # Returns the prompt without duplicate tags and the tags removed. A deduper
+    # passed in carries the tags seen in earlier prompts over to this one.
+    if deduper is None:
+        deduper = TagDeduper(policy)
+    base = deduper.sealed
+    pieces = []
+    lines = []
+
+    for line in prompt.splitlines():
+        start = len(pieces)
+        # If no separator is found, leave the line unchanged.
+        if (parts := line_parts(line, deduper)) is None:
+            pieces.append(line)
+            lines.append((start, None))
+            continue
 
-            # Check if this part is one of the separators.
-            if any(re.fullmatch(sep, normalized) for sep in separators):
-                if normalized == "BREAK":
-                    result.append(" BREAK ")
-                elif re.fullmatch(r'<[^>]+>', normalized):
-                    result.append(f" {normalized} ")
-                else:
-                    result.append(f" {normalized} ")
-            else:
-                if normalized not in seen:
-                    seen.add(normalized)
-                    result.append(part)
-        
-        output = ''.join(result)
-        output = re_break.sub(r' BREAK ', output).strip()
+        for part, tag, key in parts:
+            if tag is None:
+                pieces.append(part)
+                continue
+            kept, replaced = deduper.offer(tag, base + len(pieces), key)
+            if kept:
+                pieces.append(part)
+            if replaced is not None:
+                pieces[replaced - base] = ""
+        lines.append((start, len(pieces)))
+
+    # Earlier pieces can still be emptied by a stronger tag, so lines are joined last
+    processed_lines = []
+    for start, end in lines:
+        if end is None:
+            processed_lines.append(pieces[start])
+            continue
+        output = ''.join(pieces[start:end])
+        output = strip_around(output, "BREAK", " BREAK ").strip()
         processed_lines.append(' '.join(output.split()))
-    
-    return '\n'.join(processed_lines).strip()
+
+    removed = deduper.removed
+    deduper.removed = []
+    deduper.sealed = base + len(pieces)
+    return '\n'.join(processed_lines).strip(), removed
 
 def comma_before_bracket(prompt: str):
-    return re.sub(r',\s*(<)', r' \1', prompt)
+    return re_comma_angle.sub(r' \1', prompt)
 
-def format_prompt(prompt):
+# Stages of format_prompt in order, and whether they take the config
+PIPELINE = (
     # Clean up the string
-    prompt = normalize_characters(prompt)
-    prompt = remove_mismatched_brackets(prompt)
+    (normalize_characters, False),
+    (remove_mismatched_brackets, False),
+    (resolve_aliases, True),
 
     # Remove duplicates
-    prompt = dedupe_tokens(prompt)
+    (dedupe_tokens, True),
 
     # Clean up whitespace for cool beans
-    prompt = remove_whitespace_excessive(prompt)
-    prompt = space_to_underscore(prompt)
-    prompt = align_brackets(prompt)
-    prompt = space_and(prompt) # for proper compositing alignment on colons
-    prompt = space_brackets(prompt)
-    prompt = align_commas(prompt)
-    prompt = align_alternating(prompt)
-    prompt = bracket_to_weights(prompt)
-    prompt = comma_before_bracket(prompt)
+    (remove_whitespace_excessive, True),
+    (space_to_underscore, True),
+    (align_brackets, False),
+    (space_and, False), # for proper compositing alignment on colons
+    (space_brackets, False),
+    (align_commas, True),
+    (align_alternating, False),
+    (bracket_to_weights, True),
+    (comma_before_bracket, False),
+    (chunk_prompt, True), # must stay last, it plans BREAKs over the whole prompt
+)
+
+def format_prompt(prompt, **overrides):
+    # Overrides replace settings.json values for this call only, e.g. BRACKET2WEIGHT=False
+    return format_prompt_cached(prompt, get_config(**overrides))
+
+def format_prompt_cached(prompt, config):
+    format_cache.resize(config.CACHE_SIZE)
+    key = (prompt, config.format_key)
+    if (formatted := format_cache.get(key)) is None:
+        formatted = disk_get("format_prompt", prompt, config, config.format_key)
+        if formatted is None:
+            formatted = format_prompt_uncached(prompt, config)
+            disk_put("format_prompt", prompt, config, config.format_key, formatted)
+        format_cache.put(key, formatted)
+    return formatted
+
+class FormatTimeout(TimeoutError):
+    """Raised when formatting a prompt takes longer than FORMAT_TIMEOUT."""
+
+def format_deadline(config):
+    # The perf_counter() time formatting has to be done by, None without a FORMAT_TIMEOUT
+    return time.perf_counter() + config.FORMAT_TIMEOUT if config.FORMAT_TIMEOUT else None
+
+def check_deadline(deadline, config):
+    # Stages are linear, so checking between them keeps a call close to its timeout
+    if deadline is not None and time.perf_counter() > deadline:
+        raise FormatTimeout(f"Formatting took longer than {config.FORMAT_TIMEOUT} s")
+
+def run_stages(prompt: str, stages, config, deadline=None):
+    for stage, configured in stages:
+        prompt = stage(prompt, config) if configured else stage(prompt)
+        check_deadline(deadline, config)
+    return prompt
+
+def format_prompt_uncached(prompt, config):
+    if config.STAGE_TIMING:
+        return format_prompt_timed(prompt, config)
+
+    return run_stages(prompt, PIPELINE, config, format_deadline(config))
+
+def format_prompt_timed(prompt, config):
+    # Same as format_prompt_uncached, recording every stage in stage_timings
+    start = time.perf_counter()
+    original_length = len(prompt)
+    deadline = format_deadline(config)
 
+    for stage, configured in PIPELINE:
+        check_deadline(deadline, config)
+        stage_start = time.perf_counter()
+        output = stage(prompt, config) if configured else stage(prompt)
+        stage_timings.record(stage.__name__, time.perf_counter() - stage_start, len(prompt), len(output))
+        prompt = output
+
+    stage_timings.record("format_prompt", time.perf_counter() - start, original_length, len(prompt))
+    return prompt
+
+def format_prompt_deduped(prompt, config, deduper: TagDeduper):
+    # The pipeline with dedupe_tokens sharing the tags deduper has seen in earlier prompts
+    deadline = format_deadline(config)
+    for stage, configured in PIPELINE:
+        if stage is dedupe_tokens:
+            prompt = dedupe_report(prompt, config.DEDUPE_POLICY, deduper)[0]
+        else:
+            prompt = stage(prompt, config) if configured else stage(prompt)
+        check_deadline(deadline, config)
     return prompt
 
-def convert_tags(prompt):
-    remove_parens = str.maketrans({"(": "", ")": ""})
+def convert_tags(prompt, **overrides):
+    return convert_tags_cached(prompt, get_config(**overrides))
+
+def convert_tags_cached(prompt, config):
+    convert_cache.resize(config.CACHE_SIZE)
+    key = (prompt, config.convert_key)
+    if (converted := convert_cache.get(key)) is None:
+        converted = disk_get("convert_tags", prompt, config, config.convert_key)
+        if converted is None:
+            start = time.perf_counter()
+            converted = convert_tags_uncached(prompt, config)
+            if config.STAGE_TIMING:
+                stage_timings.record("convert_tags", time.perf_counter() - start, len(prompt), len(converted))
+            disk_put("convert_tags", prompt, config, config.convert_key, converted)
+        convert_cache.put(key, converted)
+    return converted
+
+def convert_tags_uncached(prompt, config):
+    blacklist = config.blacklist
     output_lines = []
+    deadline = format_deadline(config)
 
     for line in prompt.splitlines(keepends=True):
+        check_deadline(deadline, config)
         # Skip special cases
         if not line.strip() or "BREAK" in line or "," in line or (("(" in line or ")" in line) and "_" not in line):
             output_lines.append(line)
@@ -362,10 +519,9 @@ def convert_tags(prompt):
 
         # Process tags
         raw_tags = line.strip().split()
-        filtered_tags = [
-            tag for tag in raw_tags
-            if not any(pat.fullmatch(tag.translate(remove_parens)) for pat in BLACKLISTED_TAGS)
-        ]
+        if config.tag_index is not None:
+            raw_tags = dictionary_tags(raw_tags, config)
+        filtered_tags = [tag for tag in raw_tags if tag not in blacklist]
 
         # Format tags: replace underscores & escape parentheses
         formatted_tags = [
@@ -384,3 +540,61 @@ def convert_tags(prompt):
         output_lines.append(result + ("\n" if line.endswith("\n") else ""))
 
     return "".join(output_lines)
+
+"""
+Streaming
+"""
+
+def iter_lines(source):
+    # Lines of an iterable of strings or a text file, without line endings
+    for line in source:
+        yield line.rstrip("\r\n")
+
+def iter_records(source, records: str):
+    # Yields each record as a string, and None for a blank line between paragraphs
+    if records == "line":
+        yield from iter_lines(source)
+        return
+    if records != "paragraph":
+        raise ValueError(f"records must be 'line' or 'paragraph', not {records!r}")
+
+    paragraph = []
+    for line in iter_lines(source):
+        if line.strip():
+            paragraph.append(line)
+            continue
+        if paragraph:
+            yield "\n".join(paragraph)
+            paragraph = []
+        yield None
+    if paragraph:
+        yield "\n".join(paragraph)
+
+def format_prompt_iter(source, records="line", carry_seen=False, **overrides):
+    """
+    Formats a document of any size record by record and yields the output
+    lines, so memory is bounded by the largest record. A record is a line, or
+    with records="paragraph" a block of lines up to a blank line, and comes
+    out as format_prompt formats it; blank lines between paragraphs are kept.
+
+    With carry_seen, tags seen in earlier records are removed from later ones
+    as if the document were one prompt, and the seen tags are kept for the
+    whole run. Earlier records are already out by then, so under the
+    "Strongest" policy a stronger repeat in a later record is dropped rather
+    than replacing the first occurrence.
+    """
+    config = get_config(**overrides)
+    deduper = TagDeduper(config.DEDUPE_POLICY) if carry_seen else None
+    for record in iter_records(source, records):
+        if record is None:
+            yield ""
+        elif deduper is None:
+            yield from format_prompt_cached(record, config).split("\n")
+        else:
+            yield from format_prompt_deduped(record, config, deduper).split("\n")
+
+def convert_tags_iter(source, **overrides):
+    # convert_tags works line by line, so a document streams one line at a time
+    config = get_config(**overrides)
+    for line in iter_lines(source):
+        yield convert_tags_cached(line, config)
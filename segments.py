@@ -0,0 +1,288 @@
+import hashlib
+
+from .app_config import get_config
+from .cache import LazyPattern, LRUCache
+from .clip_tokens import chunk_prompt
+from .disk_cache import disk_get, disk_put
+from .prompt_formatter import (
+    PIPELINE, check_deadline, dedupe_line_parts, dedupe_report, format_cache, format_deadline, normalize_characters,
+    remove_mismatched_brackets, run_stages
+)
+from .tag_index import resolve_aliases
+
+# Incremental format_prompt for the editor: the prompt is cut into segments
+# that format independently of each other, and every segment's result is
+# memoized by its content. A one-line edit then only reformats the segment
+# holding that line.
+#
+# normalize_characters, remove_mismatched_brackets and dedupe_tokens still run
+# over the whole prompt, since bracket matching and the set of seen tags cross
+# lines, but their per-line work is memoized too: a line is cleaned on its
+# own once, and only the brackets it shares with other lines are matched again,
+# and the tags dedupe_tokens splits a line into are kept with their keys, so
+# only the seen set is replayed in order. The remaining stages run per segment. A line break is only cut where
+# none of those stages can look across it:
+# - both lines are non-empty,
+# - every bracket opened before the cut is closed before it, with matching types,
+# - the first line doesn't end with "|" "AND" "BREAK" and the second doesn't
+#   start with one of those, "," or "<",
+# - every "<" and ">" of the prompt forms an angle block within its line.
+# A line ending with "," is merged into the next one by align_commas when
+# COLLAPSE_LINEBREAKS is on, so those segments are joined with ", " instead of
+# a line break. The joined results are checked against the same edge rules,
+# and the prompt is formatted as a whole if any of them fails.
+
+PRE_STAGES = PIPELINE[:4]
+# chunk_prompt packs tags across segments, it runs on the joined result
+SEGMENT_STAGES = PIPELINE[4:-1]
+
+SEGMENT_CACHE_SIZE = 4096
+LINE_STORE_SIZE = 16384
+LINE_MEMO_SIZE = 16384
+
+EDGE_END = (",", "|", "AND", "BREAK")
+EDGE_START = (",", "|", "AND", "BREAK", "<")
+
+re_angle_block = LazyPattern(r"<[^<>\n]+>")
+re_angle_mark = LazyPattern(r"[<>]")
+re_bracket_char = LazyPattern(r"[()\[\]{}]")
+re_open_weight_group = LazyPattern(r"(?<!\\)\([^:]*\Z")
+brackets_opening = set("([{")
+bracket_pairs = dict(zip(")]}", "([{"))
+
+# Formatted segments, keyed by segment text and the settings they depend on
+segment_cache = LRUCache(SEGMENT_CACHE_SIZE)
+# Lines sent by editors, keyed by their id
+line_store = LRUCache(LINE_STORE_SIZE)
+# line_brackets of lines
+bracket_lines = LRUCache(LINE_MEMO_SIZE)
+# dedupe_line_parts of lines, keyed by line and dedupe policy
+dedupe_lines = LRUCache(LINE_MEMO_SIZE)
+
+"""
+Segmentation
+"""
+
+def segment_id(text: str):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+def cut_joiner(before: str, after: str, config):
+    # What the formatted segments are joined with if the prompt can be cut between these lines, else None
+    before, after = before.strip(), after.strip()
+    if not before or not after or after.startswith(EDGE_START):
+        return None
+    # An underscore at the cut becomes a space the whole prompt keeps next to the line break
+    if config.CONV_SPACE_UNDERSCORE == "Underscores to spaces" and (before.rstrip(" ,").endswith("_") or after.startswith("_")):
+        return None
+    if not before.endswith(","):
+        return None if before.endswith(EDGE_END) else "\n"
+
+    core = before.rstrip(" ,")
+    if not core or core.endswith(EDGE_END):
+        return None
+    if config.COLLAPSE_LINEBREAKS:
+        return ", "
+    # space_to_underscore strips the line break after a comma
+    return "\n" if config.CONV_SPACE_UNDERSCORE == "None" else None
+
+def split_segments(prompt: str, config):
+    # Returns the segments and what to join each one with the next
+    lines = prompt.split("\n")
+    if any(("<" in line or ">" in line) and re_angle_mark.search(re_angle_block.sub("", line)) for line in lines):
+        return [prompt], []
+
+    segments = []
+    joiners = []
+    current = []
+    stack = []
+    balanced = True
+    for i, line in enumerate(lines):
+        current.append(line)
+        for match in re_bracket_char.finditer(line):
+            c = match.group()
+            if c in bracket_pairs:
+                if stack and stack[-1] == bracket_pairs[c]:
+                    stack.pop()
+                else:
+                    balanced = False
+            else:
+                stack.append(c)
+
+        if balanced and not stack and i + 1 < len(lines):
+            if (joiner := cut_joiner(line, lines[i + 1], config)) is not None:
+                segments.append("\n".join(current))
+                joiners.append(joiner)
+                current = []
+    segments.append("\n".join(current))
+    return segments, joiners
+
+def joins_cleanly(outputs: list, joiners: list, config):
+    for before, after, joiner in zip(outputs, outputs[1:], joiners):
+        if before != before.strip() or after != after.strip():
+            return False
+        # align_commas drops the comma a ", " join stands for
+        if cut_joiner(before + ("," if joiner == ", " else ""), after, config) != joiner:
+            return False
+        # The weight 1 cleanup could match from an unweighted "(" across the cut
+        if config.BRACKET2WEIGHT and re_open_weight_group.search(before):
+            return False
+    return True
+
+"""
+Whole-prompt stages
+"""
+
+def line_brackets(line: str):
+    """
+    remove_mismatched_brackets of a line on its own, except for the brackets
+    that depend on the lines around it: closers met while no bracket of the
+    line is open, and openers the line leaves open. Returns the cleaned line,
+    or the text between those brackets and the brackets.
+    """
+    out = []
+    stack = []
+    closers = []
+    for c in line:
+        if c in brackets_opening:
+            stack.append(len(out))
+        elif c in bracket_pairs:
+            if not stack:
+                closers.append(len(out))
+            elif out[stack[-1]] == bracket_pairs[c]:
+                stack.pop()
+            else:
+                continue
+        out.append(c)
+    if not closers and not stack:
+        return line if len(out) == len(line) else "".join(out)
+
+    # Closers can only be met before the first opener left open
+    slots = closers + stack
+    chunks = ["".join(out[a + 1:b]) for a, b in zip([-1] + slots, slots + [len(out)])]
+    return chunks, [out[i] for i in slots]
+
+def remove_mismatched_lines(prompt: str):
+    # Same as remove_mismatched_brackets, with the work of every line memoized:
+    # only the brackets a line shares with others are matched again
+    lines = []
+    stack = []
+    for line in prompt.split("\n"):
+        if (result := bracket_lines.get(line)) is None:
+            result = line_brackets(line)
+            bracket_lines.put(line, result)
+        if isinstance(result, str):
+            lines.append(result)
+            continue
+        chunks, brackets = result
+        kept = [False] * len(brackets)
+        for i, c in enumerate(brackets):
+            if c not in bracket_pairs:
+                stack.append((kept, i, c))
+            elif stack and stack[-1][2] == bracket_pairs[c]:
+                opener_kept, j, _ = stack.pop()
+                opener_kept[j] = kept[i] = True
+        lines.append((chunks, brackets, kept))
+
+    pieces = []
+    for i, line in enumerate(lines):
+        if i:
+            pieces.append("\n")
+        if isinstance(line, str):
+            pieces.append(line)
+            continue
+        chunks, brackets, kept = line
+        pieces.append(chunks[0])
+        for chunk, c, keep in zip(chunks[1:], brackets, kept):
+            if keep:
+                pieces.append(c)
+            pieces.append(chunk)
+    return "".join(pieces)
+
+def memoized_line_parts(line: str, deduper):
+    key = (line, deduper.policy)
+    if (parts := dedupe_lines.get(key)) is None:
+        # Lines without separators are memoized as an empty tuple
+        parts = dedupe_line_parts(line, deduper) or ()
+        dedupe_lines.put(key, parts)
+    return parts or None
+
+def run_pre_stages(prompt: str, config, deadline=None):
+    # PRE_STAGES with their per-line work memoized
+    prompt = normalize_characters(prompt)
+    prompt = remove_mismatched_lines(prompt)
+    prompt = resolve_aliases(prompt, config)
+    check_deadline(deadline, config)
+    prompt = dedupe_report(prompt, config.DEDUPE_POLICY, line_parts=memoized_line_parts)[0]
+    check_deadline(deadline, config)
+    return prompt
+
+"""
+Formatting
+"""
+
+def format_segmented(prompt: str, config):
+    deadline = format_deadline(config)
+    prompt = run_pre_stages(prompt, config, deadline)
+
+    segments, joiners = split_segments(prompt, config)
+    outputs = []
+    for segment in segments:
+        key = (segment, config.format_key)
+        if (formatted := segment_cache.get(key)) is None:
+            formatted = run_stages(segment, SEGMENT_STAGES, config, deadline)
+            segment_cache.put(key, formatted)
+        outputs.append(formatted)
+
+    if joiners and not joins_cleanly(outputs, joiners, config):
+        return chunk_prompt(run_stages(prompt, SEGMENT_STAGES, config, deadline), config)
+
+    pieces = [outputs[0]]
+    for joiner, formatted in zip(joiners, outputs[1:]):
+        pieces.append(joiner)
+        pieces.append(formatted)
+    return chunk_prompt("".join(pieces), config)
+
+def format_prompt_segmented(prompt, **overrides):
+    # Same result as format_prompt, sharing its cache
+    config = get_config(**overrides)
+    key = (prompt, config.format_key)
+    if (formatted := format_cache.get(key)) is None:
+        formatted = disk_get("format_prompt", prompt, config, config.format_key)
+        if formatted is None:
+            formatted = format_segmented(prompt, config)
+            disk_put("format_prompt", prompt, config, config.format_key, formatted)
+        format_cache.put(key, formatted)
+    return formatted
+
+def format_lines(lines: list, known=(), **overrides):
+    """
+    Formats a prompt sent as lines, each either {"text": ...} or the id of a
+    line sent before. Returns the ids of the input lines and the formatted
+    prompt as lines, leaving out the text of those whose id is in known. Ids
+    the server no longer has are returned as missing, and the client resends
+    those lines as text.
+    """
+    texts = []
+    line_ids = []
+    missing = []
+    for line in lines:
+        if isinstance(line, dict):
+            text = line["text"]
+            line_id = segment_id(text)
+            line_store.put(line_id, text)
+        elif (text := line_store.get(line)) is None:
+            missing.append(line)
+            continue
+        else:
+            line_id = line
+        texts.append(text)
+        line_ids.append(line_id)
+
+    if missing:
+        return {"success": False, "missing": missing}
+
+    segments = []
+    for text in format_prompt_segmented("\n".join(texts), **overrides).split("\n"):
+        output_id = segment_id(text)
+        segments.append({"id": output_id} if output_id in known else {"id": output_id, "text": text})
+    return {"success": True, "line_ids": line_ids, "segments": segments}
@@ -0,0 +1,60 @@
+import threading
+from collections import deque
+
+# Number of most recent durations kept per stage for percentiles
+WINDOW_SIZE = 1000
+
+
+def percentile(ordered: list, fraction: float):
+    # Nearest-rank percentile of an already sorted list
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+class StageTimings:
+    """Thread-safe per-stage wall time, call count and text length counters."""
+
+    def __init__(self, window_size: int = WINDOW_SIZE):
+        self.window_size = window_size
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, input_length: int, output_length: int):
+        with self.lock:
+            if (entry := self.stages.get(stage)) is None:
+                entry = self.stages[stage] = {
+                    "calls": 0,
+                    "total_seconds": 0.0,
+                    "input_chars": 0,
+                    "output_chars": 0,
+                    "recent": deque(maxlen=self.window_size),
+                }
+            entry["calls"] += 1
+            entry["total_seconds"] += seconds
+            entry["input_chars"] += input_length
+            entry["output_chars"] += output_length
+            entry["recent"].append(seconds)
+
+    def clear(self):
+        with self.lock:
+            self.stages.clear()
+
+    def stats(self):
+        with self.lock:
+            snapshot = {stage: (dict(entry), sorted(entry["recent"])) for stage, entry in self.stages.items()}
+
+        result = {}
+        for stage, (entry, recent) in snapshot.items():
+            result[stage] = {
+                "calls": entry["calls"],
+                "total_ms": entry["total_seconds"] * 1e3,
+                "mean_ms": entry["total_seconds"] * 1e3 / entry["calls"],
+                "p50_ms": percentile(recent, 0.50) * 1e3,
+                "p95_ms": percentile(recent, 0.95) * 1e3,
+                "p99_ms": percentile(recent, 0.99) * 1e3,
+                "input_chars": entry["input_chars"],
+                "output_chars": entry["output_chars"],
+            }
+        return result
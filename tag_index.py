@@ -0,0 +1,247 @@
+import logging
+import mmap
+import os
+import struct
+
+from .cache import LazyPattern
+
+# Optional tag dictionary: a CSV of booru tags (name, category, post count,
+# "comma,separated,aliases", the format used by tag autocomplete extensions)
+# compiled once into a binary index next to it. The index is memory-mapped,
+# so opening it costs nothing per process and lookups binary search it in place.
+#
+# Index layout, little endian:
+#   header   magic, key count, size of the string blob
+#   records  one per key sorted by key bytes: string offset, string length,
+#            category, alias flag, index of the canonical tag's record
+#   strings  UTF-8 keys, lowercase with underscores
+
+INDEX_MAGIC = b"PFTAGS01"
+HEADER = struct.Struct("<8sII")
+RECORD = struct.Struct("<IHBBI")
+INDEX_SUFFIX = ".idx"
+LOOKUP_MEMO_SIZE = 65536
+# Longer keys are skipped, record lengths are 16 bit
+MAX_KEY_LENGTH = 4096
+
+# Danbooru categories, other numbers are kept as they are
+CATEGORY_NAMES = {0: "general", 1: "artist", 3: "copyright", 4: "character", 5: "meta"}
+
+# Runs of tag text between separators and brackets, angle blocks are skipped
+re_tag_run = LazyPattern(r"(<[^<>]*>)|((?:\\[()\[\]]|[^,()\[\]{}<>|:\n\\])+)")
+re_escaped_bracket = LazyPattern(r"\\([()\[\]])")
+re_unescaped_bracket = LazyPattern(r"(?<!\\)([()])")
+
+"""
+Building
+"""
+
+def tag_key(tag: str):
+    # Dictionary key of a tag as written in a prompt: "Character \(Series\)" -> "character_(series)"
+    return "_".join(re_escaped_bracket.sub(r"\1", tag).lower().split())
+
+def read_csv(path: str):
+    # Returns {key: (category, canonical key or None for a tag itself)}
+    import csv  # only needed when the index is rebuilt
+
+    entries = {}
+    aliases = []
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or not row[0].strip() or not row[1].strip().isdigit():
+                continue
+            key = tag_key(row[0])
+            if len(key) > MAX_KEY_LENGTH:
+                continue
+            category = int(row[1])
+            entries[key] = (category, None)
+            if len(row) >= 4:
+                aliases.extend((alias, key, category) for alias in map(tag_key, row[3].split(",")) if 0 < len(alias) <= MAX_KEY_LENGTH)
+    # A real tag always wins over an alias with the same name
+    for alias, key, category in aliases:
+        if alias not in entries:
+            entries[alias] = (category, key)
+    return entries
+
+def compile_index(csv_path: str):
+    entries = read_csv(csv_path)
+    keys = sorted(entries, key=lambda key: key.encode("utf-8"))
+    position = {key: i for i, key in enumerate(keys)}
+
+    records = bytearray()
+    strings = bytearray()
+    for key in keys:
+        encoded = key.encode("utf-8")
+        category, canonical = entries[key]
+        target = position[canonical] if canonical is not None else position[key]
+        records += RECORD.pack(len(strings), len(encoded), min(category, 255), canonical is not None, target)
+        strings += encoded
+
+    return HEADER.pack(INDEX_MAGIC, len(keys), len(strings)) + records + strings
+
+def build_index(csv_path: str, index_path: str):
+    import tempfile  # only needed when the index is rebuilt
+
+    data = compile_index(csv_path)
+    # A temporary file of its own, processes rebuilding at once each replace the index with a complete one
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(index_path) + ".", suffix=".tmp", dir=os.path.dirname(index_path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, index_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+"""
+Lookup
+"""
+
+class TagIndex:
+    """Tag dictionary index, memory-mapped or in memory, see the layout above."""
+
+    def __init__(self, data, stamp):
+        self.data = data
+        # Identifies this build of the index in cache keys
+        self.stamp = stamp
+        magic, self.count, strings_size = HEADER.unpack_from(self.data, 0)
+        self.strings_start = HEADER.size + self.count * RECORD.size
+        if magic != INDEX_MAGIC or self.strings_start + strings_size != len(self.data):
+            raise ValueError("not a tag dictionary index")
+        self.memo = {}
+
+    def record(self, i: int):
+        return RECORD.unpack_from(self.data, HEADER.size + i * RECORD.size)
+
+    def key_at(self, i: int):
+        offset, length = self.record(i)[:2]
+        start = self.strings_start + offset
+        return self.data[start:start + length]
+
+    def find(self, key: bytes):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < self.count and self.key_at(low) == key else None
+
+    def lookup(self, tag: str):
+        # Returns (canonical key, category, whether tag is an alias), or None for an unknown tag
+        if (found := self.memo.get(tag)) is None:
+            found = False
+            if key := tag_key(tag):
+                if (i := self.find(key.encode("utf-8"))) is not None:
+                    _, _, category, alias, target = self.record(i)
+                    found = (self.key_at(target).decode("utf-8"), category, bool(alias))
+            if len(self.memo) >= LOOKUP_MEMO_SIZE:
+                self.memo.clear()
+            self.memo[tag] = found
+        return found or None
+
+    def __len__(self):
+        return self.count
+
+def index_path_for(csv_path: str):
+    return csv_path + INDEX_SUFFIX
+
+def open_tag_index(index_path: str):
+    with open(index_path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        stat = os.fstat(f.fileno())
+    try:
+        return TagIndex(data, (stat.st_mtime_ns, stat.st_size))
+    except ValueError:
+        data.close()
+        raise ValueError(f"{index_path} is not a tag dictionary index")
+
+def load_tag_index(csv_path: str):
+    # Compiles the index when it is missing or older than the CSV, then maps it
+    index_path = index_path_for(csv_path)
+    csv_stat = os.stat(csv_path)
+    try:
+        stale = os.stat(index_path).st_mtime_ns < csv_stat.st_mtime_ns
+    except OSError:
+        stale = True
+    if stale:
+        try:
+            build_index(csv_path, index_path)
+        except OSError as e:
+            # Read-only folder, the index is rebuilt in memory by every process
+            logging.warning(f"[Prompt Formatter] Couldn't write {index_path}, keeping the tag index in memory: {e}")
+            return TagIndex(compile_index(csv_path), (csv_stat.st_mtime_ns, csv_stat.st_size))
+    return open_tag_index(index_path)
+
+"""
+Prompts
+"""
+
+def category_name(category: int):
+    return CATEGORY_NAMES.get(category, str(category))
+
+def written_like(canonical: str, original: str):
+    # The canonical tag in the style of the original: spaces or underscores, escaped parentheses
+    text = canonical if "_" in original and " " not in original.strip() else canonical.replace("_", " ")
+    return re_unescaped_bracket.sub(r"\\\1", text)
+
+def resolve_aliases(prompt: str, config):
+    # Replaces every tag that is an alias in the tag dictionary with its canonical tag
+    tag_index = config.tag_index
+    if tag_index is None or not config.TAG_ALIASES:
+        return prompt
+
+    def replace(match):
+        text = match.group(2)
+        if text is None or not (tag := text.strip()) or (found := tag_index.lookup(tag)) is None or not found[2]:
+            return match.group()
+        start = text.index(tag)
+        return text[:start] + written_like(found[0], tag) + text[start + len(tag):]
+
+    return re_tag_run.sub(replace, prompt)
+
+def dictionary_tags(tags: list, config):
+    # Tags of a convert_tags line after the dictionary settings: aliases resolved,
+    # unknown tags and tags outside TAG_CATEGORIES dropped
+    tag_index = config.tag_index
+    kept = []
+    for tag in tags:
+        if (found := tag_index.lookup(tag)) is None:
+            if config.TAG_UNKNOWN != "Remove":
+                kept.append(tag)
+            continue
+        canonical, category, alias = found
+        if config.TAG_CATEGORIES and category_name(category) not in config.TAG_CATEGORIES:
+            continue
+        kept.append(canonical if alias and config.TAG_ALIASES else tag)
+    return kept
+
+def check_tags(prompt: str, config):
+    """
+    Looks up every tag of the prompt in the tag dictionary. Returns the tags it
+    doesn't know, the aliases with their canonical tags, and the categories of
+    the known tags, or None without a dictionary.
+    """
+    tag_index = config.tag_index
+    if tag_index is None:
+        return None
+    unknown = []
+    aliases = {}
+    categories = {}
+    for match in re_tag_run.finditer(prompt):
+        if (text := match.group(2)) is None or not (tag := text.strip()) or tag in ("BREAK", "AND"):
+            continue
+        if (found := tag_index.lookup(tag)) is None:
+            # Weights and prompt editing steps are numbers, not tags
+            if not tag.replace(".", "", 1).isdigit():
+                unknown.append(tag)
+            continue
+        canonical, category, alias = found
+        if alias:
+            aliases[tag] = written_like(canonical, tag)
+        categories[tag] = category_name(category)
+    return {"unknown": unknown, "aliases": aliases, "categories": categories}
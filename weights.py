@@ -0,0 +1,106 @@
+from .cache import LazyPattern
+
+# Weight helpers of bracket_to_weights: planning which bracket runs become a
+# weight, the weight each depth stands for, and the linear-time replacements
+# of the patterns the stage used to run.
+
+brackets_opening = set("([{")
+brackets_closing = set(")]}")
+
+re_weight_one_end = LazyPattern(r":1(?:\.0*)?\)")
+
+# Deeper bracket nesting gets the same weight, 1.1 ** d overflows a float past ~7400
+MAX_WEIGHT_DEPTH = 1000
+
+def calculate_weight(d: int, is_square_brackets: bool):
+    d = min(d, MAX_WEIGHT_DEPTH)
+    return 1 / 1.1 ** d if is_square_brackets else 1 * 1.1 ** d
+
+def weight_suffix(d: int, is_square_brackets: bool):
+    return f":{calculate_weight(d, is_square_brackets):.2f}".rstrip("0").rstrip(".")
+
+def remove_weight_one(prompt: str):
+    # Same as re.sub(r'(?<!\\)\(([^:]+):1(?:\.0*)?\)', r'\1', prompt) in linear time.
+    # The group can only open after the colon before its ":1)", so the text
+    # between two colons is searched once instead of from every "(".
+    pieces = []
+    position = 0
+    previous_end = 0
+    for match in re_weight_one_end.finditer(prompt):
+        colon = match.start()
+        start = max(previous_end, prompt.rfind(":", previous_end, colon) + 1)
+        # The group needs a character between "(" and the colon
+        opening = prompt.find("(", start, colon - 1) if start < colon - 1 else -1
+        while opening > 0 and prompt[opening - 1] == "\\":
+            opening = prompt.find("(", opening + 1, colon - 1)
+        if opening != -1:
+            pieces.append(prompt[position:opening])
+            pieces.append(prompt[opening + 1:colon])
+            position = match.end()
+        previous_end = match.end()
+    pieces.append(prompt[position:])
+    return "".join(pieces)
+
+def has_weight(chars):
+    # Same as (?<=:)(\d+.?\d*|\d*.?\d+)(?=[)\]]$), chars walks back from the closer
+    c = next(chars, "")
+    digits = 0
+    while c.isdecimal():
+        digits += 1
+        c = next(chars, "")
+    if c == ":" and digits:
+        return True
+    if not c or c == "\n":
+        return False
+    c = next(chars, "")
+    while c.isdecimal():
+        digits += 1
+        c = next(chars, "")
+    return c == ":" and digits > 0
+
+def weight_blocks(marks: list):
+    """Plans bracket_to_weights in a single pass.
+
+    marks holds (position, char, escaped) for every bracket, ":" and "|" of a
+    segment, in order. Consecutive "(" or "[" form a run, and a run is split
+    into blocks wherever its closing brackets stop being consecutive. "[...]"
+    groups holding ":" or "|" directly are prompt editing or alternation and
+    are never weighted. Returns (openers, closers, is_square_brackets) for
+    every block, closers innermost first.
+    """
+    stack = []
+    closer = {}
+    editing = set()
+    runs = []
+    for pos, c, escaped in marks:
+        if c in brackets_opening:
+            stack.append(pos)
+            if c == "{":
+                continue
+            if runs and runs[-1][0] == c and runs[-1][-1] == pos - 1:
+                runs[-1].append(pos)
+            elif not escaped:
+                runs.append([c, pos])
+        elif c in brackets_closing:
+            if stack:
+                closer[stack.pop()] = pos
+        elif stack:
+            editing.add(stack[-1])
+
+    blocks = []
+    for c, *run in runs:
+        is_square_brackets = c == "["
+        block = []
+        for pos in run + [None]:
+            split = (
+                pos is None
+                or pos not in closer
+                or (is_square_brackets and pos in editing)
+                or (block and closer[pos] + 1 != closer[block[-1]])
+            )
+            if split and block:
+                blocks.append((block, [closer[p] for p in reversed(block)], is_square_brackets))
+                block = []
+            if pos in closer and not (is_square_brackets and pos in editing):
+                block.append(pos)
+    return blocks
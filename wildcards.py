@@ -0,0 +1,202 @@
+import random
+import sys
+from bisect import bisect_right
+from math import prod
+
+from .app_config import get_config
+from .cache import LazyPattern, LRUCache
+from .prompt_formatter import convert_tags_uncached
+from .segments import format_segmented
+
+# Wildcard templates: "{red|blue|green} hair, {1girl|2girls}" stands for every
+# combination of its choices. A template is parsed once into a tree, and its
+# variants are numbered 0..total-1 in the order of itertools.product (the last
+# choice changes fastest). A variant is built from its number alone, so any
+# number of them can be enumerated or sampled without holding the others.
+#
+# Braces without a "|" at their own level are kept as they are, "{word}" is
+# emphasis in some prompt styles. Escaped "\{", "\}" and "\|" are plain text.
+#
+# Variants are formatted without the format caches and the disk cache, so a
+# few thousand sampled variants don't push out the prompts formatted again.
+# Formatting is segmented, which only shares work between whole lines: a line
+# without choices comes from the segment cache after the first variant, a line
+# holding a choice is formatted in full for every variant, the text around the
+# choice included. The text between choices can't be formatted once on its
+# own, stages like dedupe and bracket weights depend on the whole line.
+
+WILDCARD_ACTIONS = {
+    "format_prompt": format_segmented,
+    "convert_tags": convert_tags_uncached,
+}
+
+TEMPLATE_CACHE_SIZE = 64
+# Deeper braces are kept as text
+MAX_WILDCARD_DEPTH = 64
+
+re_wildcard_event = LazyPattern(r"\\.|[{}|]")
+
+# Parsed templates, keyed by text
+template_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+
+"""
+Parsing
+"""
+
+class Choice:
+    """One of several sequences, each a list of strings and Choices."""
+    __slots__ = ("options", "counts", "offsets", "total")
+
+    def __init__(self, options: list):
+        self.options = options
+        self.counts = [sequence_total(option) for option in options]
+        # Variant number each option starts at
+        self.offsets = [0]
+        for count in self.counts[:-1]:
+            self.offsets.append(self.offsets[-1] + count)
+        self.total = sum(self.counts)
+
+def sequence_total(parts: list):
+    return prod(part.total for part in parts if isinstance(part, Choice))
+
+def append_text(parts: list, text: str):
+    if not text:
+        return
+    if parts and isinstance(parts[-1], str):
+        parts[-1] += text
+    else:
+        parts.append(text)
+
+def add_part(parts: list, part):
+    if isinstance(part, str):
+        append_text(parts, part)
+    else:
+        parts.append(part)
+
+def add_literal_group(parts: list, options: list, closed: bool):
+    # Braces that aren't a choice are kept as text, with the choices inside them
+    append_text(parts, "{")
+    for i, option in enumerate(options):
+        if i:
+            append_text(parts, "|")
+        for part in option:
+            add_part(parts, part)
+    if closed:
+        append_text(parts, "}")
+
+def parse_template(text: str):
+    # Returns the template as a list of strings and Choices
+    stack = [[[]]]
+    position = 0
+    for match in re_wildcard_event.finditer(text):
+        event = match.group()
+        if len(event) == 2:
+            continue
+        options = stack[-1]
+        append_text(options[-1], text[position:match.start()])
+        position = match.end()
+        if event == "{" and len(stack) <= MAX_WILDCARD_DEPTH:
+            stack.append([[]])
+        elif event == "|" and len(stack) > 1:
+            options.append([])
+        elif event == "}" and len(stack) > 1:
+            stack.pop()
+            parts = stack[-1][-1]
+            if len(options) > 1:
+                parts.append(Choice(options))
+            else:
+                add_literal_group(parts, options, closed=True)
+        else:
+            append_text(options[-1], event)
+    append_text(stack[-1][-1], text[position:])
+
+    # Braces left open are text
+    while len(stack) > 1:
+        options = stack.pop()
+        add_literal_group(stack[-1][-1], options, closed=False)
+    return stack[0][0]
+
+"""
+Expansion
+"""
+
+class Template:
+    """A parsed wildcard template, its variants are built on demand."""
+
+    def __init__(self, text: str):
+        self.parts = parse_template(text)
+        self.total = sequence_total(self.parts)
+
+    def build(self, parts: list, index: int, out: list):
+        # Mixed radix: the last choice is the lowest digit
+        digits = []
+        for part in reversed(parts):
+            if isinstance(part, Choice):
+                index, digit = divmod(index, part.total)
+                digits.append(digit)
+        for part in parts:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+            digit = digits.pop()
+            i = bisect_right(part.offsets, digit) - 1
+            self.build(part.options[i], digit - part.offsets[i], out)
+
+    def variant(self, index: int):
+        if not 0 <= index < self.total:
+            raise IndexError(f"variant {index} out of {self.total}")
+        out = []
+        self.build(self.parts, index, out)
+        return "".join(out)
+
+    def indices(self, count: int, mode: str = "enumerate", seed: int = 0, offset: int = 0):
+        # Numbers of the variants to build: in order from offset, or a seeded sample without repeats
+        if mode == "enumerate":
+            return range(min(offset, self.total), min(offset + count, self.total))
+        if mode == "sample":
+            rng = random.Random(seed)
+            if self.total <= sys.maxsize:
+                return rng.sample(range(self.total), min(count, self.total))
+            # Too many to sample from a range, repeats are drawn again
+            chosen = {}
+            while len(chosen) < count:
+                chosen.setdefault(rng.randrange(self.total))
+            return list(chosen)
+        raise ValueError(f"Unknown wildcard mode: {mode}")
+
+    def expand(self, count: int, mode: str = "enumerate", seed: int = 0, offset: int = 0):
+        for index in self.indices(count, mode, seed, offset):
+            yield self.variant(index)
+
+def get_template(text: str):
+    if (template := template_cache.get(text)) is None:
+        template = Template(text)
+        template_cache.put(text, template)
+    return template
+
+def expand_formatted(text: str, count: int, action="format_prompt", mode="enumerate", seed=0, offset=0, max_chars=None, **overrides):
+    """
+    Expands a wildcard template into count variants and formats each with
+    action ("none" leaves them as they are). Returns the number of variants the
+    template has and the list of formatted ones. Raises ValueError once the
+    variants exceed max_chars in total. Only whole lines without choices are
+    formatted once for all the variants.
+    """
+    template = get_template(text)
+    func = WILDCARD_ACTIONS.get(action)
+    config = get_config(**overrides)
+    formatted = {}
+    results = []
+    total_chars = 0
+    for variant in template.expand(count, mode, seed, offset):
+        total_chars += len(variant)
+        if max_chars is not None and total_chars > max_chars:
+            raise ValueError(f"variants exceed {max_chars} characters")
+        if func is None:
+            results.append(variant)
+            continue
+        # Different choices can still spell the same prompt
+        if (result := formatted.get(variant)) is None:
+            result = formatted[variant] = func(variant, config)
+        results.append(result)
+    return template.total, results